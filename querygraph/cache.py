@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# =============================================
+# Result Cache Class
+# ---------------------------------------------
+
+class ResultCache(object):
+    """
+    Thread-safe cache of query results, keyed by connector identity,
+    rendered query and fields. Memory use is bounded in bytes: when a new
+    result does not fit, the least recently used results are evicted.
+    Cached dataframes are shared between executions and must be treated
+    as read-only; graph executions return a copy of a result held by the
+    cache.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total (deep) in-memory size of the cached dataframes.
+    default_ttl : float or None
+        Number of seconds a result stays valid, for nodes that do not set
+        their own 'cache_ttl'. None means results never expire.
+
+    """
+
+    def __init__(self, max_bytes, default_ttl=None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @classmethod
+    def key(cls, db_interface, rendered_query, fields=None):
+        return db_interface.identity, cls._hashable(rendered_query), tuple(fields) if fields is not None else None
+
+    @classmethod
+    def _hashable(cls, query):
+        """ Hashable equivalent of a query - structured queries are made of dicts and lists. """
+        if isinstance(query, dict):
+            return ('{}',) + tuple(sorted((cls._hashable(key), cls._hashable(value)) for key, value in query.items()))
+        if isinstance(query, (list, tuple)):
+            return tuple(cls._hashable(item) for item in query)
+        return query
+
+    def get(self, key):
+        """ Return the cached dataframe for 'key', or None if there is no valid entry. """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                self.num_bytes -= entry[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, df, ttl=None):
+        """
+        Cache a query result. Results larger than 'max_bytes' are not cached.
+
+        Parameters
+        ----------
+        key : tuple
+            Key returned by 'ResultCache.key'.
+        df : DataFrame
+            The query result.
+        ttl : float or None
+            Number of seconds the result stays valid. Defaults to 'default_ttl'.
+
+        """
+        num_bytes = int(df.memory_usage(index=True, deep=True).sum())
+        if num_bytes > self.max_bytes:
+            return
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            previous_entry = self._entries.pop(key, None)
+            if previous_entry is not None:
+                self.num_bytes -= previous_entry[1]
+            while self._entries and self.num_bytes + num_bytes > self.max_bytes:
+                _, (_, evicted_bytes, _) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted_bytes
+                self.evictions += 1
+            self._entries[key] = (df, num_bytes, expires)
+            self.num_bytes += num_bytes
+
+    def holds(self, df):
+        """ Whether 'df' itself (not an equal dataframe) is one of the cached results. """
+        with self._lock:
+            return any(entry[0] is df for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        """ Return the cache's counters as a dictionary. """
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self.num_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
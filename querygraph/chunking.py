@@ -0,0 +1,54 @@
+import threading
+
+
+# =============================================
+# Adaptive Chunk Size Class
+# ---------------------------------------------
+
+class AdaptiveChunkSize(object):
+    """
+    Number of dependent parameter values rendered into a single chunk query.
+    The size starts at 'max_size' and is adjusted after every chunk query so
+    that a chunk takes roughly 'target_latency' seconds to execute, without
+    ever exceeding 'max_size' - which is what keeps queries under the
+    database's packet/parse/document limits.
+
+    Parameters
+    ----------
+    max_size : int
+        Largest number of values rendered into one query.
+    min_size : int or None
+        Smallest chunk size. Defaults to 1% of 'max_size'.
+    target_latency : float
+        Desired execution time of a single chunk query, in seconds.
+    initial_size : int or None
+        Chunk size to start with - e.g. the size a previous execution
+        settled on. Defaults to 'max_size'.
+
+    """
+
+    # Weight of the newest observation in the smoothed chunk size.
+    SMOOTHING = 0.5
+
+    def __init__(self, max_size, min_size=None, target_latency=1.0, initial_size=None):
+        self.max_size = int(max_size)
+        self.min_size = int(min_size) if min_size is not None else max(1, self.max_size // 100)
+        self.target_latency = target_latency
+        self._size = self.max_size
+        if initial_size is not None:
+            self._size = int(min(self.max_size, max(self.min_size, initial_size)))
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._size
+
+    def observe(self, num_values, latency):
+        """ Record that a chunk query over 'num_values' values took 'latency' seconds. """
+        if num_values <= 0:
+            return
+        values_per_second = num_values / max(latency, 1e-3)
+        ideal_size = values_per_second * self.target_latency
+        with self._lock:
+            smoothed_size = (1 - self.SMOOTHING) * self._size + self.SMOOTHING * ideal_size
+            self._size = int(min(self.max_size, max(self.min_size, smoothed_size)))
@@ -0,0 +1,56 @@
+from querygraph import exceptions
+from querygraph.utils import optional_import
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = optional_import.NotInstalled(name='pyarrow')
+
+
+# =============================================
+# Arrow Tables
+# ---------------------------------------------
+
+def _conversion_errors():
+    # ArrowTypeError is a TypeError; older pyarrow versions raise plain TypeErrors and OverflowErrors too.
+    return pa.ArrowInvalid, TypeError, OverflowError
+
+
+def table_from_columns(columns, names):
+    """
+    Build a pyarrow Table from lists of Python values, one per column, as
+    fetched from a DB-API cursor. Column types are inferred by Arrow from
+    the whole column; columns of Nones only are null typed. Columns that
+    Arrow can't type (e.g. mixing numbers and strings) raise an
+    ExecutionError.
+
+    """
+    try:
+        return pa.Table.from_arrays([pa.array(column) for column in columns], names=list(names))
+    except _conversion_errors(), e:
+        raise exceptions.ExecutionError("Couldn't convert query result into an Arrow table: %s" % e)
+
+
+def table_from_df(df):
+    """ Convert a dataframe into a pyarrow Table, dropping its index. """
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except _conversion_errors(), e:
+        raise exceptions.ExecutionError("Couldn't convert dataframe into an Arrow table: %s" % e)
+
+
+def rename_columns(table, names):
+    """ Return a pyarrow Table with the columns of 'table' (not copied) under new names. """
+    return pa.Table.from_arrays(table.columns, names=list(names))
+
+
+def table_to_df(table):
+    """ Convert a pyarrow Table into a dataframe. """
+    return table.to_pandas()
+
+
+def concat_tables(tables):
+    """ Concatenate pyarrow Tables with the same schema, without copying their columns. """
+    if len(tables) == 1:
+        return tables[0]
+    return pa.concat_tables(tables)
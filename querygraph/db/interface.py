@@ -1,7 +1,14 @@
+import sys
 from abc import abstractmethod
+from contextlib import contextmanager
+
+import pandas as pd
 
 from querygraph import exceptions
 from querygraph.utils.deserializer import Deserializer
+from querygraph import predicates
+from querygraph import columnar
+from querygraph.db import pool
 
 
 class DatabaseInterface(object):
@@ -24,11 +31,59 @@ class DatabaseInterface(object):
     fields_accepted : bool
         ...
     deserialize_query : bool
-        ...
+        Whether queries are Python structures (e.g. Mongo DB filter dicts)
+        rather than text. Query templates are then rendered directly into
+        structures where possible; queries passed as text are deserialized.
+    supports_range_predicates : bool
+        Whether queries accept SQL range predicates ('<col> BETWEEN <a> AND <b>'),
+        so that dependent parameter key sets can be shipped as ranges.
+    supports_temp_tables : bool
+        Whether '_execute_query' accepts a 'temp_tables' argument, uploading
+        dependent parameter key sets to session temporary tables before
+        running the query.
+    supports_projection : bool
+        Whether text queries can be wrapped in a 'SELECT <columns> FROM (<query>)'
+        projection (see 'project'), so that only the columns the query graph
+        needs are fetched.
+    supports_filters : bool
+        Whether row filters can be pushed down into queries (see 'predicate'
+        and 'filter'). By default, text queries are wrapped in a
+        'SELECT * FROM (<query>) WHERE <condition>' filter.
+    supports_batches : bool
+        Whether query results can be fetched incrementally, in record
+        batches (see 'execute_query_batches'). Other connectors return
+        their whole result as a single batch.
+    supports_arrow : bool
+        Whether query results are built into Arrow tables directly from
+        DB-API fetches (see 'execute_query_arrow'), rather than converted
+        from dataframes. Requires the 'pyarrow' package.
+    supports_async : bool
+        Whether '_execute_query_async' is backed by a native asynchronous
+        driver and returns without waiting for the query. Otherwise it runs
+        the query on the calling thread, and concurrent queries (e.g. chunk
+        queries) are dispatched on threads by the caller.
+    exclusive_connections : bool
+        Whether a connection can only be used by one thread at a time (e.g.
+        DB-API connections), so that the connection pool hands out one
+        connection per thread. Otherwise connections are thread-safe clients
+        (which usually pool connections themselves) and a single one is
+        shared by all threads.
 
+    Connections are pooled (see 'pool'): queries use a connection from the
+    pool shared by all interfaces with the same identity, which is reset
+    (see '_reset_conn') and returned to the pool once the query is done.
 
     """
 
+    # DB-API placeholder used when bulk inserting keys into temporary tables.
+    TEMP_TABLE_PLACEHOLDER = '%s'
+
+    # Quote character of identifiers in projections.
+    IDENTIFIER_QUOTE = '"'
+
+    # Number of rows fetched at a time when building Arrow tables from DB-API cursors.
+    ARROW_FETCH_SIZE = 10000
+
     def __init__(self,
                  name,
                  db_type,
@@ -36,7 +91,15 @@ class DatabaseInterface(object):
                  execution_exception,
                  type_converter,
                  fields_accepted=False,
-                 deserialize_query=False):
+                 deserialize_query=False,
+                 supports_range_predicates=False,
+                 supports_temp_tables=False,
+                 supports_projection=False,
+                 supports_filters=False,
+                 supports_batches=False,
+                 supports_arrow=False,
+                 supports_async=False,
+                 exclusive_connections=True):
         self.name = name
         self.db_type = db_type
         self.conn_exception = conn_exception
@@ -44,9 +107,53 @@ class DatabaseInterface(object):
         self.type_converter = type_converter
         self.fields_accepted = fields_accepted
         self.deserialize_query = deserialize_query
+        self.supports_range_predicates = supports_range_predicates
+        self.supports_temp_tables = supports_temp_tables
+        self.supports_projection = supports_projection
+        self.supports_filters = supports_filters
+        self.supports_batches = supports_batches
+        self.supports_arrow = supports_arrow
+        self.supports_async = supports_async
+        self.exclusive_connections = exclusive_connections
         self.deserialize = Deserializer()
 
+    @property
+    def identity(self):
+        """
+        Hashable identity of the database the interface queries - its type
+        and connection parameters, but not the connector's name. Used to key
+        cached query results and connection pools.
+
+        """
+        params = sorted((attr, value) for attr, value in vars(self).items()
+                        if isinstance(value, (basestring, int, long, float, bool)) and attr != 'name')
+        return (self.db_type,) + tuple(params)
+
+    def quote_identifier(self, identifier):
+        quote = self.IDENTIFIER_QUOTE
+        return quote + identifier.replace(quote, quote * 2) + quote
+
+    def project(self, query, columns):
+        """ Wrap a text query so that it only returns the given columns. """
+        query = query.strip().rstrip(';').rstrip()
+        return "SELECT %s FROM (%s) AS qg_projection" % (", ".join(self.quote_identifier(column)
+                                                                   for column in columns), query)
+
+    def predicate(self, compiled_expression):
+        """
+        Translate a boolean CompiledExpression into a condition of the
+        database's query language. Raises UnsupportedPredicate if it can't be.
+
+        """
+        return predicates.sql_predicate(compiled_expression.root, quote_identifier=self.quote_identifier)
+
+    def filter(self, query, conditions):
+        """ Wrap a query so that it only returns the rows satisfying all the given conditions. """
+        query = query.strip().rstrip(';').rstrip()
+        return "SELECT * FROM (%s) AS qg_filter WHERE %s" % (query, " AND ".join(conditions))
+
     def conn(self):
+        """ Open a new connection, outside of the connection pool. """
         try:
             return self._conn()
         except self.conn_exception:
@@ -56,9 +163,82 @@ class DatabaseInterface(object):
     def _conn(self):
         pass
 
+    # =============================================
+    # Connection Pooling
+    # ---------------------------------------------
+
+    @property
+    def pool(self):
+        """ The connection pool shared by the interfaces with the same identity (see 'pool.shared_pool'). """
+        return pool.shared_pool(self)
+
+    def configure_pool(self, **options):
+        """
+        Change the settings of the interface's connection pool: 'min_size',
+        'max_size', 'max_idle_time', 'health_check_interval' and
+        'acquire_timeout' (see 'pool.ConnectionPool'). The settings apply to
+        every interface sharing the pool.
+
+        """
+        self.pool.configure(**options)
+
+    def pooled_conn(self):
+        """ Acquire a connection from the pool. Closing it returns it to the pool (see 'pool.PooledConnection'). """
+        connection_pool = self.pool
+        return pool.PooledConnection(connection_pool, connection_pool.acquire(), db_interface=self)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager acquiring a connection from the pool and returning it
+        when the block exits. If the block raises, the connection is health
+        checked before it's reused.
+
+        """
+        connector = self.pooled_conn()
+        try:
+            yield connector
+        except Exception:
+            connector.close(suspect=True)
+            raise
+        finally:
+            connector.close()
+
+    def _close_conn(self, connector):
+        """ Close a connection. """
+        connector.close()
+
+    def _check_conn(self, connector):
+        """ Health check of an idle connection. The default runs 'SELECT 1' on a DB-API connection. """
+        cursor = connector.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        return True
+
+    def _reset_conn(self, connector, temp_table_names):
+        """
+        Return a connection to a clean state before it goes back to the
+        pool. The default rolls back the DB-API connection's transaction
+        and drops the session temporary tables created on it. Shared clients
+        (see 'exclusive_connections') aren't reset.
+
+        """
+        if not self.exclusive_connections:
+            return
+        connector.rollback()
+        if temp_table_names:
+            cursor = connector.cursor()
+            for table_name in temp_table_names:
+                cursor.execute("DROP TABLE IF EXISTS %s" % table_name)
+            cursor.close()
+            connector.commit()
+
     def execute_query(self, query, *args, **kwargs):
         try:
-            if self.deserialize_query:
+            if self.deserialize_query and isinstance(query, basestring):
                 query = self.deserialize(query)
             return self._execute_query(query, *args, **kwargs)
         except self.execution_exception, e:
@@ -68,6 +248,138 @@ class DatabaseInterface(object):
     def _execute_query(self, *args, **kwargs):
         pass
 
+    def execute_query_batches(self, query, batch_size, *args, **kwargs):
+        """
+        Generator counterpart of 'execute_query', yielding the query result as
+        dataframes of at most 'batch_size' rows. The query runs when the
+        first batch is requested.
+
+        """
+        try:
+            if self.deserialize_query and isinstance(query, basestring):
+                query = self.deserialize(query)
+            for df in self._execute_query_batches(query, batch_size, *args, **kwargs):
+                yield df
+        except self.execution_exception, e:
+            raise exceptions.ExecutionError("%s" % e)
+
+    def _execute_query_batches(self, query, batch_size, *args, **kwargs):
+        """
+        Batched query hook. Connectors that support batches override this;
+        the default yields the whole result of '_execute_query'.
+
+        """
+        yield self._execute_query(query, *args, **kwargs)
+
+    @staticmethod
+    def _fetch_batches(connector, cursor, query, batch_size):
+        """
+        Execute a query on a DB-API cursor and yield its result in dataframes
+        of at most 'batch_size' rows, fetched as they are requested. The
+        connection is closed once the result is exhausted or the generator
+        is closed.
+
+        """
+        try:
+            cursor.execute(query)
+            # The description of server side cursors (e.g. Postgres named cursors) is only set by a fetch.
+            rows = cursor.fetchmany(batch_size)
+            columns = [column[0] for column in cursor.description]
+            while rows:
+                yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            connector.close()
+
+    def execute_query_arrow(self, query, *args, **kwargs):
+        """ Counterpart of 'execute_query' returning the query result as a pyarrow Table. """
+        try:
+            if self.deserialize_query and isinstance(query, basestring):
+                query = self.deserialize(query)
+            return self._execute_query_arrow(query, *args, **kwargs)
+        except self.execution_exception, e:
+            raise exceptions.ExecutionError("%s" % e)
+
+    def _execute_query_arrow(self, query, *args, **kwargs):
+        """
+        Arrow query hook. Connectors that support Arrow override this; the
+        default converts the dataframe returned by '_execute_query'.
+
+        """
+        return columnar.table_from_df(self._execute_query(query, *args, **kwargs))
+
+    @staticmethod
+    def _fetch_table(connector, cursor, query, batch_size):
+        """
+        Execute a query on a DB-API cursor and return its result as a pyarrow
+        Table. Rows are fetched 'batch_size' at a time and appended to
+        per-column lists, so no intermediate dataframe of Python objects is
+        built. The connection is closed afterwards.
+
+        """
+        try:
+            cursor.execute(query)
+            # The description of server side cursors is only set by a fetch (see '_fetch_batches').
+            rows = cursor.fetchmany(batch_size)
+            names = [column[0] for column in cursor.description]
+            columns = [list() for _ in names]
+            while rows:
+                for column, values in zip(columns, zip(*rows)):
+                    column.extend(values)
+                rows = cursor.fetchmany(batch_size)
+            return columnar.table_from_columns(columns, names)
+        finally:
+            connector.close()
+
+    def execute_query_async(self, query, callback, errback, *args, **kwargs):
+        """
+        Non-blocking counterpart of 'execute_query'. 'callback' is called with the
+        resulting dataframe, and 'errback' with an exception info tuple.
+
+        """
+        def _errback(exc_info):
+            if isinstance(exc_info[1], self.execution_exception):
+                exc_info = (exceptions.ExecutionError, exceptions.ExecutionError("%s" % exc_info[1]), exc_info[2])
+            errback(exc_info)
+
+        try:
+            if self.deserialize_query and isinstance(query, basestring):
+                query = self.deserialize(query)
+        except Exception:
+            _errback(sys.exc_info())
+            return
+        self._execute_query_async(query, callback, _errback, *args, **kwargs)
+
+    def _execute_query_async(self, query, callback, errback, *args, **kwargs):
+        """
+        Asynchronous query hook. Connectors with a native asynchronous driver
+        override this (see 'supports_async'); the default runs '_execute_query'
+        on the calling thread, which is expected to belong to a bounded executor.
+
+        """
+        try:
+            df = self._execute_query(query, *args, **kwargs)
+        except Exception:
+            errback(sys.exc_info())
+        else:
+            callback(df)
+
+    def _create_temp_tables(self, connector, temp_tables):
+        """
+        Create and fill the session temporary tables of the given TempTableSemiJoins
+        on an open DB-API connection. They are dropped when the connection closes
+        or, for pooled connections, when it's returned to the pool.
+
+        """
+        cursor = connector.cursor()
+        for temp_table in temp_tables:
+            if isinstance(connector, pool.PooledConnection):
+                connector.temp_table_names.append(temp_table.table_name)
+            cursor.execute("CREATE TEMPORARY TABLE %s (k %s)" % (temp_table.table_name, temp_table.key_type))
+            cursor.executemany("INSERT INTO %s (k) VALUES (%s)" % (temp_table.table_name, self.TEMP_TABLE_PLACEHOLDER),
+                               [(key,) for key in temp_table.keys])
+        cursor.close()
+
     @abstractmethod
     def execute_insert_query(self, *args, **kwargs):
         pass
\ No newline at end of file
@@ -1,19 +1,271 @@
 import datetime
+import re
+import threading
+from collections import OrderedDict
 
 import pandas as pd
 from cassandra.cluster import Cluster
 from cassandra.connection import ConnectionException
 from cassandra import ReadFailure
 
+from querygraph import exceptions
 from querygraph.db.interface import DatabaseInterface
 from querygraph.db.type_converter import TypeConverter
 
 
-def pandas_factory(colnames, rows):
-    return pd.DataFrame(rows, columns=colnames)
+# =============================================
+# Columnar Pages
+# ---------------------------------------------
 
+def columnar_factory(colnames, rows):
+    """ Row factory returning a page of rows as its column names and a list of values per column. """
+    if not rows:
+        return list(colnames), [list() for _ in colnames]
+    return list(colnames), [list(column) for column in zip(*rows)]
+
+
+class ColumnarPages(object):
+    """
+    Thread-safe accumulator of result pages (see 'columnar_factory'),
+    appended to one list of values per column, so that a result of any
+    number of pages is built into a single dataframe at the end.
+
+    """
+
+    def __init__(self):
+        self.colnames = None
+        self.columns = None
+        self._lock = threading.Lock()
+
+    def add(self, page):
+        colnames, columns = page
+        with self._lock:
+            if self.colnames is None:
+                self.colnames = colnames
+                self.columns = [list() for _ in colnames]
+            for values, page_values in zip(self.columns, columns):
+                values.extend(page_values)
+
+    def to_df(self):
+        if self.colnames is None:
+            return pd.DataFrame()
+        return pd.DataFrame(OrderedDict(zip(self.colnames, self.columns)), columns=self.colnames)
+
+
+def fetch_pages(response_future, pages, callback, errback):
+    """
+    Add every page of a ResponseFuture's result to a ColumnarPages, then
+    call 'callback' with no arguments - or 'errback' with the exception if
+    a page can't be fetched or added. Pages are requested one at a time, as
+    the previous one arrives.
+
+    """
+    def page_callback(page):
+        # Exceptions raised in callbacks are only logged by the driver.
+        try:
+            pages.add(page)
+            has_more_pages = response_future.has_more_pages
+            if has_more_pages:
+                response_future.start_fetching_next_page()
+        except Exception, e:
+            errback(e)
+            return
+        if not has_more_pages:
+            callback()
+
+    response_future.add_callbacks(callback=page_callback, errback=errback)
+
+
+# =============================================
+# Token Range Scans
+# ---------------------------------------------
+
+# Token bounds of the Murmur3 partitioner. Ranges are (start, end]; no partition has the minimum token.
+MIN_TOKEN = -2 ** 63
+
+MAX_TOKEN = 2 ** 63 - 1
+
+# Queries that can be split over token ranges: a plain select from a single table.
+SCAN_QUERY_RE = re.compile(r"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+(?P<table>[\w\"]+(?:\.[\w\"]+)?)"
+                           r"(?:\s+WHERE\s+(?P<where>.+?))?(?P<allow_filtering>\s+ALLOW\s+FILTERING)?\s*;?\s*$",
+                           re.IGNORECASE | re.DOTALL)
+
+# Clauses and selectors whose results can't be computed per token range and concatenated.
+UNSPLITTABLE_RE = re.compile(r"\b(?:LIMIT|ORDER\s+BY|GROUP\s+BY|TOKEN\s*\(|COUNT\s*\(|SUM\s*\(|AVG\s*\(|MIN\s*\(|"
+                             r"MAX\s*\()", re.IGNORECASE)
+
+
+def split_token_ring(ring_tokens, splits_per_range):
+    """
+    Split the token ring into (start, end] ranges: the ranges between the
+    ring's consecutive tokens - each owned by a single replica set - each
+    split into 'splits_per_range' ranges of about equal width.
+
+    """
+    bounds = sorted(set([MIN_TOKEN] + [token for token in ring_tokens if MIN_TOKEN < token < MAX_TOKEN] +
+                        [MAX_TOKEN]))
+    token_ranges = list()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        num_splits = max(1, min(splits_per_range, end - start))
+        split_bounds = [start + (end - start) * i // num_splits for i in range(num_splits)] + [end]
+        token_ranges.extend(zip(split_bounds[:-1], split_bounds[1:]))
+    return token_ranges
+
+
+class TokenRangeScan(object):
+    """
+    Executes a query over the token ranges of the ring concurrently - at
+    most 'max_in_flight' range queries at a time - paging within each range,
+    and assembles the pages into a single dataframe (see 'ColumnarPages').
+    Pages are added as they arrive, so rows aren't in token order.
+
+    Parameters
+    ----------
+    session : cassandra.cluster.Session
+        The session, whose row factory is 'columnar_factory'.
+    query : str
+        The query, with '?' markers for the start and end tokens of a range.
+    token_ranges : list
+        List of (start, end] token ranges.
+    max_in_flight : int
+        Maximum number of range queries executed at once.
+
+    """
+
+    def __init__(self, session, query, token_ranges, max_in_flight):
+        self.session = session
+        self.query = query
+        self.token_ranges = list(token_ranges)
+        self.max_in_flight = max_in_flight
+        self.pages = ColumnarPages()
+        self._remaining = list(reversed(self.token_ranges))
+        self._num_in_flight = 0
+        self._error = None
+        self._finished = False
+        self._lock = threading.Lock()
+        self._statement = None
+        self._callback = None
+        self._errback = None
+
+    def start(self, callback, errback):
+        """
+        Start the scan without blocking. 'callback' is called with the
+        resulting dataframe, or 'errback' with the exception of the first
+        range query that fails - once the range queries in flight are done.
+
+        """
+        self._callback = callback
+        self._errback = errback
+        self._statement = self.session.prepare(self.query)
+        if not self.token_ranges:
+            self._finish()
+        for _ in range(min(self.max_in_flight, len(self._remaining))):
+            self._start_next()
+
+    def execute(self, timeout=None):
+        """
+        Run the scan and return the resulting dataframe. If it takes more
+        than 'timeout' seconds (None means no limit), no more range queries
+        are started and an ExecutionError is raised.
+
+        """
+        done = threading.Event()
+        outcome = dict()
+
+        def callback(df):
+            outcome['df'] = df
+            done.set()
+
+        def errback(exc):
+            outcome['error'] = exc
+            done.set()
+
+        self.start(callback=callback, errback=errback)
+        if not done.wait(timeout):
+            error = exceptions.ExecutionError("Token range scan timed out after %s seconds." % timeout)
+            with self._lock:
+                if self._error is None:
+                    self._error = error
+            raise error
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['df']
+
+    def _start_next(self):
+        with self._lock:
+            if self._error is not None or not self._remaining:
+                return
+            start, end = self._remaining.pop()
+            self._num_in_flight += 1
+        try:
+            response_future = self.session.execute_async(self._statement, (start, end))
+        except Exception, e:
+            self._range_done(error=e)
+            return
+        fetch_pages(response_future, self.pages, callback=self._range_done,
+                    errback=lambda exc: self._range_done(error=exc))
+
+    def _range_done(self, error=None):
+        with self._lock:
+            self._num_in_flight -= 1
+            if error is not None and self._error is None:
+                self._error = error
+            finished = self._num_in_flight == 0 and (self._error is not None or not self._remaining)
+        if finished:
+            self._finish()
+        else:
+            # Started on the driver's executor: callbacks of queries that complete at once would otherwise recurse.
+            self.session.submit(self._start_next)
+
+    def _finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        if self._error is None:
+            try:
+                df = self.pages.to_df()
+            except Exception, e:
+                self._error = e
+            else:
+                self._callback(df)
+                return
+        self._errback(self._error)
+
+
+# =============================================
+# Cassandra Interface
+# ---------------------------------------------
 
 class Cassandra(DatabaseInterface):
+    """
+    Apache Cassandra interface. Results are fetched in pages of 'fetch_size'
+    rows. Full table and range queries - a plain select from a single
+    table whose WHERE clause doesn't restrict the partition key - are split
+    over the token ranges of the ring and executed concurrently, at most
+    'scan_concurrency' range queries at a time (see 'TokenRangeScan').
+    Other queries (e.g. single partition queries, aggregates or queries
+    with a LIMIT) are executed as they are.
+
+    Parameters
+    ----------
+    fetch_size : int
+        Number of rows per page.
+    scan_concurrency : int
+        Maximum number of range queries executed at once.
+    splits_per_range : int
+        Number of range queries per range between consecutive tokens of the ring.
+    scan_timeout : float or None
+        Maximum number of seconds a blocking token range scan may take.
+        None means no limit.
+
+    """
+
+    DEFAULT_FETCH_SIZE = 5000
+
+    DEFAULT_SCAN_CONCURRENCY = 16
+
+    DEFAULT_SPLITS_PER_RANGE = 1
 
     TYPE_CONVERTER = TypeConverter(
         type_converters={
@@ -24,30 +276,116 @@ class Cassandra(DatabaseInterface):
         }
     )
 
-    def __init__(self, name, contact_point, port, keyspace):
+    def __init__(self, name, contact_point, port, keyspace, fetch_size=DEFAULT_FETCH_SIZE,
+                 scan_concurrency=DEFAULT_SCAN_CONCURRENCY, splits_per_range=DEFAULT_SPLITS_PER_RANGE,
+                 scan_timeout=None):
         self.contact_point = contact_point
         self.port = port
         self.keyspace = keyspace
+        self.fetch_size = int(fetch_size)
+        self.scan_concurrency = int(scan_concurrency)
+        self.splits_per_range = int(splits_per_range)
+        self.scan_timeout = float(scan_timeout) if scan_timeout is not None else None
         DatabaseInterface.__init__(self,
                                    name=name,
                                    db_type='Apache Cassandra',
                                    conn_exception=ConnectionException,
                                    execution_exception=ReadFailure,
-                                   type_converter=self.TYPE_CONVERTER)
+                                   type_converter=self.TYPE_CONVERTER,
+                                   supports_async=True,
+                                   exclusive_connections=False)
 
     def _conn(self):
         cluster = Cluster([self.contact_point])
         session = cluster.connect(self.keyspace)
-        session.row_factory = pandas_factory
-        session.default_fetch_size = None
+        session.row_factory = columnar_factory
+        session.default_fetch_size = self.fetch_size
         return session
 
+    def _check_conn(self, session):
+        session.execute("SELECT release_version FROM system.local")
+        return True
+
+    def _close_conn(self, session):
+        session.cluster.shutdown()
+
+    def token_range_scan(self, session, query):
+        """ Return a TokenRangeScan executing the query, or None if the query can't be split over token ranges. """
+        match = SCAN_QUERY_RE.match(query)
+        if match is None or UNSPLITTABLE_RE.search(match.group('select') + " " + (match.group('where') or "")):
+            return None
+        metadata = session.cluster.metadata
+        if not metadata.partitioner or not metadata.partitioner.endswith('Murmur3Partitioner'):
+            return None
+        keyspace, table = self._table_name(match.group('table'))
+        try:
+            table_metadata = metadata.keyspaces[keyspace].tables[table]
+        except KeyError:
+            return None
+        partition_key = [column.name for column in table_metadata.partition_key]
+        where = match.group('where')
+        # Token restrictions can't be combined with restrictions of the partition key.
+        if where is not None and any(re.search(r"(?<![\w\"])\"?%s\"?(?![\w\"])" % re.escape(column), where,
+                                               re.IGNORECASE) for column in partition_key):
+            return None
+
+        token = "token(%s)" % ", ".join('"%s"' % column.replace('"', '""') for column in partition_key)
+        token_restriction = "%s > ? AND %s <= ?" % (token, token)
+        where = "%s AND %s" % (where, token_restriction) if where is not None else token_restriction
+        scan_query = "SELECT %s FROM %s WHERE %s%s" % (match.group('select'), match.group('table'), where,
+                                                        match.group('allow_filtering') or "")
+        ring_tokens = [token.value for token in metadata.token_map.ring] if metadata.token_map is not None else []
+        return TokenRangeScan(session=session, query=scan_query,
+                              token_ranges=split_token_ring(ring_tokens, self.splits_per_range),
+                              max_in_flight=self.scan_concurrency)
+
+    def _table_name(self, table_name):
+        """ Return the keyspace and table of a (possibly keyspace qualified and quoted) table name. """
+        names = [name[1:-1].replace('""', '"') if name.startswith('"') else name.lower()
+                 for name in table_name.split('.')]
+        return (self.keyspace, names[0]) if len(names) == 1 else (names[0], names[1])
+
     def _execute_query(self, query):
-        session = self.conn()
-        rows = session.execute(query)
-        df = rows._current_rows
-        return df
+        with self.connection() as session:
+            scan = self.token_range_scan(session, query)
+            if scan is not None:
+                return scan.execute(timeout=self.scan_timeout)
+            pages = ColumnarPages()
+            result = session.execute(query)
+            pages.add(result._current_rows)
+            while result.has_more_pages:
+                result.fetch_next_page()
+                pages.add(result._current_rows)
+        return pages.to_df()
+
+    def _execute_query_async(self, query, callback, errback):
+        session = self.pooled_conn()
+        pages = ColumnarPages()
+
+        def _callback(df=None):
+            if df is None:
+                try:
+                    df = pages.to_df()
+                except Exception, e:
+                    _errback(e)
+                    return
+            session.close()
+            callback(df)
+
+        def _errback(e):
+            session.close(suspect=True)
+            errback((type(e), e, None))
+
+        try:
+            scan = self.token_range_scan(session, query)
+            if scan is not None:
+                scan.start(callback=_callback, errback=_errback)
+            else:
+                fetch_pages(session.execute_async(query), pages, callback=_callback, errback=_errback)
+        except Exception:
+            session.close(suspect=True)
+            raise
 
     def execute_insert_query(self, query):
-        session = self.conn()
-        session.execute(query)
\ No newline at end of file
+        with self.connection() as session:
+            session.execute(query)
@@ -6,6 +6,7 @@ from pandas.io.json import json_normalize
 
 from querygraph.db.interface import DatabaseInterface
 from querygraph.db.type_converter import TypeConverter
+from querygraph import predicates
 
 
 class ElasticSearch(DatabaseInterface):
@@ -22,6 +23,14 @@ class ElasticSearch(DatabaseInterface):
         },
         container_converters={
             'list': lambda x: '[%s]' % ", ".join(str(y) for y in x)
+        },
+        value_converters={
+            'datetime':
+                {
+                    datetime.datetime: lambda x: x,
+                    pd.Timestamp: lambda x: x.to_pydatetime(),
+                    datetime.date: lambda x: datetime.datetime(x.year, x.month, x.day)
+                }
         }
     )
 
@@ -36,17 +45,36 @@ class ElasticSearch(DatabaseInterface):
                                    conn_exception=elasticsearch.ConnectionError,
                                    execution_exception=elasticsearch.ElasticsearchException,
                                    type_converter=self.TYPE_CONVERTER,
-                                   deserialize_query=True)
+                                   fields_accepted=True,
+                                   deserialize_query=True,
+                                   supports_filters=True,
+                                   exclusive_connections=False)
 
     def _conn(self):
         return elasticsearch.Elasticsearch([{'host': self.host, 'port': int(self.port)}])
 
+    def _check_conn(self, es):
+        return es.ping()
+
+    def _close_conn(self, es):
+        es.transport.close()
+
+    def predicate(self, compiled_expression):
+        return predicates.elastic_search_predicate(compiled_expression.root)
+
+    def filter(self, query, conditions):
+        """ Add the conditions to the query as 'bool' filter clauses. """
+        if isinstance(query, basestring):
+            query = self.deserialize(query)
+        return {'bool': {'must': [query], 'filter': list(conditions)}}
+
     def _execute_query(self, query, fields):
-        es = self.conn()
-        df = json_normalize(es.search(index=self.index, body={"query": query, "_source": fields})['hits']['hits'])
+        with self.connection() as es:
+            response = es.search(index=self.index, body={"query": query, "_source": fields})
+        df = json_normalize(response['hits']['hits'])
         df.rename(columns={'_source.%s' % field_name: field_name for field_name in fields}, inplace=True)
         return df[fields]
 
     def execute_insert_query(self, id, data):
-        es = self.conn()
-        es.index(index=self.index, doc_type=self.doc_type, id=id, body=data)
\ No newline at end of file
+        with self.connection() as es:
+            es.index(index=self.index, doc_type=self.doc_type, id=id, body=data)
\ No newline at end of file
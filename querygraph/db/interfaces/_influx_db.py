@@ -34,15 +34,20 @@ class InfluxDb(DatabaseInterface):
                                    db_type="InfluxDB",
                                    conn_exception=Exception,
                                    execution_exception=Exception,
-                                   type_converter=TypeConverter())
+                                   type_converter=TypeConverter(),
+                                   exclusive_connections=False)
 
     def _conn(self):
         conn = DataFrameClient(self.host, self.port, self.user, self.password, self.db_name)
         return conn
 
+    def _check_conn(self, conn):
+        conn.ping()
+        return True
+
     def _execute_query(self, query):
-        conn = self.conn()
-        df = conn.query(query)
+        with self.connection() as conn:
+            df = conn.query(query)
         return df
 
     def execute_insert_query(self, query):
@@ -1,4 +1,5 @@
 import datetime
+import itertools
 
 import pymongo
 from pymongo import errors
@@ -6,6 +7,7 @@ import pandas as pd
 
 from querygraph.db.interface import DatabaseInterface
 from querygraph.db.type_converter import TypeConverter
+from querygraph import predicates
 
 
 class MongoDb(DatabaseInterface):
@@ -22,6 +24,14 @@ class MongoDb(DatabaseInterface):
         },
         container_converters={
             'list': lambda x: '[%s]' % ", ".join(str(y) for y in x)
+        },
+        value_converters={
+            'datetime':
+                {
+                    datetime.datetime: lambda x: x,
+                    pd.Timestamp: lambda x: x.to_pydatetime(),
+                    datetime.date: lambda x: datetime.datetime(x.year, x.month, x.day)
+                }
         }
     )
 
@@ -36,22 +46,51 @@ class MongoDb(DatabaseInterface):
                                    conn_exception=pymongo.errors.ConnectionFailure,
                                    execution_exception=pymongo.errors.OperationFailure,
                                    type_converter=self.TYPE_CONVERTER,
-                                   deserialize_query=True)
+                                   fields_accepted=True,
+                                   deserialize_query=True,
+                                   supports_filters=True,
+                                   supports_batches=True,
+                                   exclusive_connections=False)
 
     def _conn(self):
         return pymongo.MongoClient(host=self.host, port=int(self.port))
 
+    def _check_conn(self, client):
+        client.admin.command('ping')
+        return True
+
+    def predicate(self, compiled_expression):
+        return predicates.mongo_predicate(compiled_expression.root)
+
+    def filter(self, query, conditions):
+        """ Merge the conditions into the query filter. """
+        if isinstance(query, basestring):
+            query = self.deserialize(query)
+        conditions = ([query] if query else []) + list(conditions)
+        return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
     def _execute_query(self, query, fields):
-        client = self.conn()
-        db = client[self.db_name]
-        collection = db[self.collection]
-        projection_fields = {k: 1 for k in fields}
-        results = collection.find(query, projection_fields)
-        df = pd.DataFrame(list(results))
+        with self.connection() as client:
+            db = client[self.db_name]
+            collection = db[self.collection]
+            projection_fields = {k: 1 for k in fields} if fields else None
+            results = collection.find(query, projection_fields)
+            df = pd.DataFrame(list(results))
         return df
 
+    def _execute_query_batches(self, query, batch_size, fields):
+        with self.connection() as client:
+            collection = client[self.db_name][self.collection]
+            projection_fields = {k: 1 for k in fields} if fields else None
+            results = collection.find(query, projection_fields, batch_size=batch_size)
+            while True:
+                records = list(itertools.islice(results, batch_size))
+                if not records:
+                    break
+                yield pd.DataFrame(records)
+
     def execute_insert_query(self, data):
-        client = self.conn()
-        db = client[self.db_name]
-        collection = db[self.collection]
-        result = collection.insert_many(data)
\ No newline at end of file
+        with self.connection() as client:
+            db = client[self.db_name]
+            collection = db[self.collection]
+            result = collection.insert_many(data)
\ No newline at end of file
@@ -24,9 +24,8 @@ class MsSql(DatabaseInterface):
         return conn
 
     def _execute_query(self, query):
-        conn = self.conn()
-        df = pd.read_sql(query, conn)
-        return df
+        with self.connection() as conn:
+            return pd.read_sql(query, conn)
 
     def execute_insert_query(self, *args, **kwargs):
         pass
\ No newline at end of file
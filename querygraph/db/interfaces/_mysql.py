@@ -8,6 +8,8 @@ from querygraph.db.type_converter import TypeConverter
 
 class MySql(DatabaseInterface):
 
+    IDENTIFIER_QUOTE = '`'
+
     TYPE_CONVERTER = TypeConverter(
         type_converters={
             'bool':
@@ -30,22 +32,40 @@ class MySql(DatabaseInterface):
                                    db_type='MySql',
                                    conn_exception=mysql.connector.DatabaseError,
                                    execution_exception=mysql.connector.ProgrammingError,
-                                   type_converter=TypeConverter())
+                                   type_converter=TypeConverter(),
+                                   supports_range_predicates=True,
+                                   supports_temp_tables=True,
+                                   supports_projection=True,
+                                   supports_filters=True,
+                                   supports_batches=True,
+                                   supports_arrow=True)
 
     def _conn(self):
         return mysql.connector.connect(user=self.user, password=self.password,
                                        host=self.host,
                                        database=self.db_name)
 
-    def _execute_query(self, query):
-        connector = self.conn()
-        df = pd.read_sql_query(query, connector)
-        connector.close()
-        return df
+    def _execute_query(self, query, temp_tables=None):
+        with self.connection() as connector:
+            if temp_tables:
+                self._create_temp_tables(connector, temp_tables)
+            return pd.read_sql_query(query, connector)
+
+    def _execute_query_batches(self, query, batch_size, temp_tables=None):
+        connector = self.pooled_conn()
+        if temp_tables:
+            self._create_temp_tables(connector, temp_tables)
+        # Unbuffered cursors read rows from the server as they are fetched.
+        return self._fetch_batches(connector, connector.cursor(buffered=False), query, batch_size)
+
+    def _execute_query_arrow(self, query, temp_tables=None):
+        connector = self.pooled_conn()
+        if temp_tables:
+            self._create_temp_tables(connector, temp_tables)
+        return self._fetch_table(connector, connector.cursor(buffered=False), query, self.ARROW_FETCH_SIZE)
 
     def execute_insert_query(self, query):
-        conn = self.conn()
-        cur = conn.cursor()
-        cur.execute(query)
-        cur.close()
-        conn.close()
\ No newline at end of file
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            cur.close()
\ No newline at end of file
@@ -19,16 +19,21 @@ class Neo4j(DatabaseInterface):
                                    db_type='Neo4j',
                                    conn_exception=py2neo.database.status.Unauthorized,
                                    execution_exception=py2neo.database.status.DatabaseError,
-                                   type_converter=self.TYPE_CONVERTER)
+                                   type_converter=self.TYPE_CONVERTER,
+                                   exclusive_connections=False)
 
     def _conn(self):
         return py2neo.Graph(bolt=True, host=self.host, user=self.user, password=self.password)
 
+    def _check_conn(self, graph):
+        graph.run("RETURN 1")
+        return True
+
     def _execute_query(self, query):
-        graph = self.conn()
-        df = pd.DataFrame(graph.data(query))
+        with self.connection() as graph:
+            df = pd.DataFrame(graph.data(query))
         return df
 
     def execute_insert_query(self, query):
-        graph = self.conn()
-        graph.run(query)
+        with self.connection() as graph:
+            graph.run(query)
@@ -30,7 +30,13 @@ class Postgres(DatabaseInterface):
                                    db_type='Postgres',
                                    conn_exception=psycopg2.OperationalError,
                                    execution_exception=psycopg2.DatabaseError,
-                                   type_converter=self.TYPE_CONVERTER)
+                                   type_converter=self.TYPE_CONVERTER,
+                                   supports_range_predicates=True,
+                                   supports_temp_tables=True,
+                                   supports_projection=True,
+                                   supports_filters=True,
+                                   supports_batches=True,
+                                   supports_arrow=True)
 
     def _conn(self):
         return psycopg2.connect("dbname='%s' user='%s' host='%s' password='%s' port='%s'" % (self.db_name,
@@ -39,16 +45,28 @@ class Postgres(DatabaseInterface):
                                                                                              self.password,
                                                                                              self.port))
 
-    def _execute_query(self, query):
-        connector = self.conn()
-        df = pd.read_sql_query(query, connector)
-        connector.close()
-        return df
+    def _execute_query(self, query, temp_tables=None):
+        with self.connection() as connector:
+            if temp_tables:
+                self._create_temp_tables(connector, temp_tables)
+            return pd.read_sql_query(query, connector)
+
+    def _execute_query_batches(self, query, batch_size, temp_tables=None):
+        connector = self.pooled_conn()
+        if temp_tables:
+            self._create_temp_tables(connector, temp_tables)
+        # A named cursor is a server side cursor: rows are only sent as they are fetched.
+        return self._fetch_batches(connector, connector.cursor(name='querygraph_batches'), query, batch_size)
+
+    def _execute_query_arrow(self, query, temp_tables=None):
+        connector = self.pooled_conn()
+        if temp_tables:
+            self._create_temp_tables(connector, temp_tables)
+        return self._fetch_table(connector, connector.cursor(name='querygraph_batches'), query, self.ARROW_FETCH_SIZE)
 
     def execute_insert_query(self, query):
-        conn = self.conn()
-        cur = conn.cursor()
-        cur.execute(query)
-        conn.commit()
-        cur.close()
-        conn.close()
\ No newline at end of file
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            conn.commit()
+            cur.close()
\ No newline at end of file
@@ -8,6 +8,8 @@ from querygraph.db.type_converter import TypeConverter
 
 class Sqlite(DatabaseInterface):
 
+    TEMP_TABLE_PLACEHOLDER = '?'
+
     TYPE_CONVERTER = TypeConverter(
         type_converters={
             'bool':
@@ -26,21 +28,39 @@ class Sqlite(DatabaseInterface):
                                    db_type='Sqlite',
                                    conn_exception=Exception,
                                    execution_exception=sqlite3.OperationalError,
-                                   type_converter=self.TYPE_CONVERTER)
+                                   type_converter=self.TYPE_CONVERTER,
+                                   supports_range_predicates=True,
+                                   supports_temp_tables=True,
+                                   supports_projection=True,
+                                   supports_filters=True,
+                                   supports_batches=True,
+                                   supports_arrow=True)
 
     def _conn(self):
-        return sqlite3.connect(self.host)
+        # Pooled connections are used by one thread at a time, but not always the thread that opened them.
+        return sqlite3.connect(self.host, check_same_thread=False)
+
+    def _execute_query(self, query, temp_tables=None):
+        with self.connection() as connector:
+            if temp_tables:
+                self._create_temp_tables(connector, temp_tables)
+            return pd.read_sql_query(query, connector)
+
+    def _execute_query_batches(self, query, batch_size, temp_tables=None):
+        connector = self.pooled_conn()
+        if temp_tables:
+            self._create_temp_tables(connector, temp_tables)
+        return self._fetch_batches(connector, connector.cursor(), query, batch_size)
 
-    def _execute_query(self, query):
-        connector = self.conn()
-        df = pd.read_sql_query(query, connector)
-        connector.close()
-        return df
+    def _execute_query_arrow(self, query, temp_tables=None):
+        connector = self.pooled_conn()
+        if temp_tables:
+            self._create_temp_tables(connector, temp_tables)
+        return self._fetch_table(connector, connector.cursor(), query, self.ARROW_FETCH_SIZE)
 
     def execute_insert_query(self, query):
-        connector = self.conn()
-        c = connector.cursor()
-        c.execute(query)
-        connector.commit()
-        c.close()
-        connector.close()
+        with self.connection() as connector:
+            c = connector.cursor()
+            c.execute(query)
+            connector.commit()
+            c.close()
@@ -0,0 +1,513 @@
+import atexit
+import os
+import threading
+import time
+import weakref
+from collections import deque
+
+from querygraph import exceptions
+
+
+# =============================================
+# Connection Pool Classes
+# ---------------------------------------------
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of connections, each used by one thread at a time
+    (e.g. DB-API connections).
+
+    Connections are reused most recently released first, so that the
+    connections that are no longer needed sit idle and are closed once
+    they have been idle for 'max_idle_time' seconds - down to 'min_size'
+    connections - by a timer thread started when a connection is released.
+    An idle connection that hasn't been checked for
+    'health_check_interval' seconds is health checked before being handed
+    out, and replaced if it fails.
+
+    Parameters
+    ----------
+    connect : callable
+        Opens a new connection.
+    close : callable
+        Closes a connection. Errors are ignored.
+    is_healthy : callable or None
+        Returns whether a connection is still usable. Errors count as unhealthy.
+    min_size : int
+        Number of connections kept open (see 'warm_up').
+    max_size : int
+        Maximum number of open connections. Threads acquiring a connection
+        when that many are in use wait for one to be released.
+    max_idle_time : float or None
+        Number of seconds after which idle connections beyond 'min_size' are
+        closed. None means never.
+    health_check_interval : float or None
+        Minimum number of seconds between health checks of a connection.
+        None means connections are never checked.
+    acquire_timeout : float or None
+        Maximum number of seconds to wait for a connection, after which a
+        ConnectionError is raised. None means wait indefinitely.
+
+    """
+
+    # Seconds the eviction timer waits beyond 'max_idle_time', so that the connections are past it.
+    EVICTION_DELAY = 0.01
+
+    def __init__(self, connect, close, is_healthy=None, min_size=0, max_size=8, max_idle_time=300.0,
+                 health_check_interval=30.0, acquire_timeout=None):
+        self.connect = connect
+        self.close_connection = close
+        self.is_healthy = is_healthy
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        # Idle connections, as [connection, last released, last checked], least recently released first.
+        self._idle = deque()
+        self._num_in_use = 0
+        self._num_opening = 0
+        self._closed = False
+        self._eviction_timer = None
+        self._condition = threading.Condition(threading.Lock())
+        self._counters = dict.fromkeys(('created', 'closed', 'acquired', 'reused', 'waits', 'evicted',
+                                        'health_checks', 'unhealthy', 'discarded'), 0)
+        self._wait_time = 0.0
+
+    def configure(self, **options):
+        """ Change the pool's settings (see the class' parameters). """
+        with self._condition:
+            for option, value in options.items():
+                if option not in ('min_size', 'max_size', 'max_idle_time', 'health_check_interval',
+                                  'acquire_timeout'):
+                    raise TypeError("Unknown connection pool option '%s'." % option)
+                setattr(self, option, value)
+            self._cancel_eviction()
+            self._schedule_eviction()
+            self._condition.notify_all()
+
+    @property
+    def size(self):
+        """ Number of open connections, idle or in use. """
+        return len(self._idle) + self._num_in_use + self._num_opening
+
+    def acquire(self):
+        """ Return a connection for the calling thread's exclusive use, until it's released. """
+        self.evict_idle()
+        deadline = time.time() + self.acquire_timeout if self.acquire_timeout is not None else None
+        with self._condition:
+            waited = False
+            wait_start = time.time()
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._num_in_use += 1
+                    break
+                if self.size < self.max_size:
+                    entry = None
+                    self._num_opening += 1
+                    break
+                timeout = deadline - time.time() if deadline is not None else None
+                if timeout is not None and timeout <= 0:
+                    raise exceptions.ConnectionError("Timed out waiting for one of the %s pooled connections."
+                                                     % self.max_size)
+                waited = True
+                self._condition.wait(timeout)
+            if waited:
+                self._counters['waits'] += 1
+                self._wait_time += time.time() - wait_start
+            self._counters['acquired'] += 1
+        if entry is None:
+            return self._open()
+        connection = self._checked(entry)
+        if connection is None:
+            # The idle connection failed its health check: its slot is used for a new one.
+            with self._condition:
+                self._num_in_use -= 1
+                self._num_opening += 1
+            return self._open()
+        with self._condition:
+            self._counters['reused'] += 1
+        return connection
+
+    def _open(self):
+        """ Open a connection in a slot reserved by 'acquire'. """
+        try:
+            connection = self.connect()
+        except Exception:
+            with self._condition:
+                self._num_opening -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._num_opening -= 1
+            self._num_in_use += 1
+            self._counters['created'] += 1
+        return connection
+
+    def _checked(self, entry):
+        """ Return the connection of an idle entry, or None if it fails its health check (it's then closed). """
+        connection, last_released, last_checked = entry
+        if self.is_healthy is None or self.health_check_interval is None:
+            return connection
+        if time.time() - last_checked < self.health_check_interval:
+            return connection
+        try:
+            healthy = self.is_healthy(connection)
+        except Exception:
+            healthy = False
+        with self._condition:
+            self._counters['health_checks'] += 1
+            if not healthy:
+                self._counters['unhealthy'] += 1
+        if healthy:
+            entry[2] = time.time()
+            return connection
+        self._close(connection)
+        return None
+
+    def release(self, connection, discard=False, suspect=False):
+        """
+        Return a connection to the pool - or close it, if 'discard'. Suspect
+        connections (e.g. used by a failed query) are health checked before
+        they're reused.
+
+        """
+        with self._condition:
+            self._num_in_use -= 1
+            if discard:
+                self._counters['discarded'] += 1
+            elif not self._closed:
+                now = time.time()
+                self._idle.append([connection, now, 0.0 if suspect else now])
+                self._schedule_eviction()
+            self._condition.notify()
+        if discard or self._closed:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            self.close_connection(connection)
+        except Exception:
+            pass
+        with self._condition:
+            self._counters['closed'] += 1
+
+    def warm_up(self):
+        """ Open connections until the pool holds 'min_size' of them. """
+        while True:
+            with self._condition:
+                if self.size >= min(self.min_size, self.max_size):
+                    return
+                self._num_opening += 1
+            connection = self._open()
+            self.release(connection)
+
+    def evict_idle(self):
+        """ Close the connections beyond 'min_size' that have been idle for more than 'max_idle_time'. """
+        if self.max_idle_time is None:
+            return
+        evicted = list()
+        with self._condition:
+            now = time.time()
+            while self._idle and self.size > self.min_size and now - self._idle[0][1] > self.max_idle_time:
+                evicted.append(self._idle.popleft()[0])
+            self._counters['evicted'] += len(evicted)
+        for connection in evicted:
+            self._close(connection)
+
+    def _idle_since(self):
+        """ Release time of the connection 'evict_idle' would close first, or None if there's none. """
+        if self._idle and self.size > self.min_size:
+            return self._idle[0][1]
+        return None
+
+    def _schedule_eviction(self):
+        """
+        Start a timer running 'evict_idle' once the next idle connection
+        has been idle for 'max_idle_time', unless one is already pending.
+        Called holding the pool's lock.
+
+        """
+        if self.max_idle_time is None or self._closed or self._eviction_timer is not None:
+            return
+        idle_since = self._idle_since()
+        if idle_since is None:
+            return
+        delay = max(idle_since + self.max_idle_time - time.time(), 0.0) + self.EVICTION_DELAY
+        self._eviction_timer = threading.Timer(delay, self._evict_on_timer)
+        self._eviction_timer.daemon = True
+        self._eviction_timer.start()
+
+    def _cancel_eviction(self):
+        if self._eviction_timer is not None:
+            self._eviction_timer.cancel()
+            self._eviction_timer = None
+
+    def _evict_on_timer(self):
+        with self._condition:
+            self._eviction_timer = None
+        self.evict_idle()
+        with self._condition:
+            self._schedule_eviction()
+
+    def close(self):
+        """ Close the idle connections. Connections in use are closed when they're released. """
+        with self._condition:
+            idle = [entry[0] for entry in self._idle]
+            self._idle.clear()
+            self._closed = True
+            self._cancel_eviction()
+        for connection in idle:
+            self._close(connection)
+
+    def metrics(self):
+        """
+        Return a dictionary of the pool's current size ('size', 'idle',
+        'in_use') and counters since it was created: connections 'created',
+        'closed', 'evicted' for being idle, 'discarded' after errors,
+        'health_checks' and 'unhealthy' connections found by them, and
+        connections 'acquired', 'reused' and acquisitions that had to wait
+        ('waits', 'wait_time' in seconds).
+
+        """
+        with self._condition:
+            metrics = dict(self._counters)
+            metrics.update(size=self.size, idle=len(self._idle), in_use=self._num_in_use, wait_time=self._wait_time)
+        return metrics
+
+
+class SharedConnection(ConnectionPool):
+    """
+    Pool of a single connection shared by all threads at once, for clients
+    that are thread-safe and pool connections themselves (e.g. a Mongo DB
+    client). The client is opened on first use, health checked like a
+    pooled connection, and closed once nobody has used it for
+    'max_idle_time' seconds (unless 'min_size' is positive).
+
+    Takes the parameters of ConnectionPool; 'max_size' and 'acquire_timeout'
+    are ignored.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        ConnectionPool.__init__(self, *args, **kwargs)
+        self._entry = None
+        self._open_lock = threading.Lock()
+
+    @property
+    def size(self):
+        return 1 if self._entry is not None else 0
+
+    def acquire(self):
+        self.evict_idle()
+        with self._open_lock:
+            entry = self._entry
+            if entry is not None:
+                connection = self._checked(entry)
+                if connection is None:
+                    # The unhealthy client is closed; threads still using it get errors.
+                    with self._condition:
+                        self._entry = None
+            else:
+                connection = None
+            if connection is None:
+                connection = self.connect()
+                now = time.time()
+                with self._condition:
+                    self._entry = [connection, now, now]
+                    self._counters['created'] += 1
+            else:
+                with self._condition:
+                    self._counters['reused'] += 1
+            with self._condition:
+                self._num_in_use += 1
+                self._counters['acquired'] += 1
+            return connection
+
+    def release(self, connection, discard=False, suspect=False):
+        with self._condition:
+            self._num_in_use -= 1
+            is_current = self._entry is not None and self._entry[0] is connection
+            if is_current:
+                self._entry[1] = time.time()
+                if suspect:
+                    self._entry[2] = 0.0
+            if discard:
+                self._counters['discarded'] += 1
+                if is_current:
+                    self._entry = None
+            self._schedule_eviction()
+        if discard:
+            self._close(connection)
+
+    def warm_up(self):
+        if self.min_size > 0:
+            self.release(self.acquire())
+
+    def evict_idle(self):
+        if self.max_idle_time is None:
+            return
+        with self._condition:
+            entry = self._entry
+            if (entry is None or self.min_size > 0 or self._num_in_use > 0 or
+                    time.time() - entry[1] <= self.max_idle_time):
+                return
+            self._entry = None
+            self._counters['evicted'] += 1
+        self._close(entry[0])
+
+    def _idle_since(self):
+        if self._entry is not None and self.min_size <= 0 and self._num_in_use == 0:
+            return self._entry[1]
+        return None
+
+    def close(self):
+        with self._condition:
+            entry = self._entry
+            self._entry = None
+            self._cancel_eviction()
+        if entry is not None:
+            self._close(entry[0])
+
+    def metrics(self):
+        with self._condition:
+            metrics = dict(self._counters)
+            metrics.update(size=self.size, idle=int(self._entry is not None and self._num_in_use == 0),
+                           in_use=self._num_in_use, wait_time=self._wait_time)
+        return metrics
+
+
+# =============================================
+# Pooled Connection Class
+# ---------------------------------------------
+
+class _Lease(object):
+    """
+    A connection acquired from a pool, until it's returned - held by a
+    PooledConnection, and by the weak reference that returns the connection
+    if the PooledConnection is garbage collected without being closed.
+
+    """
+
+    def __init__(self, pool, connection, db_interface):
+        self.pool = pool
+        self.connection = connection
+        self.db_interface = db_interface
+        self.temp_table_names = list()
+        self.collect_ref = None
+
+    def release(self, suspect=False, discard=False):
+        connection = self.connection
+        if connection is None:
+            return
+        self.connection = None
+        _lease_refs.discard(self.collect_ref)
+        if discard:
+            self.pool.release(connection, discard=True)
+            return
+        try:
+            self.db_interface._reset_conn(connection, self.temp_table_names)
+        except Exception:
+            self.pool.release(connection, discard=True)
+        else:
+            self.pool.release(connection, suspect=suspect)
+
+    def collected(self, collect_ref):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+# Weak references to the PooledConnections whose connection hasn't been returned - kept here, so that they
+# outlive the PooledConnections and their callbacks are called.
+_lease_refs = set()
+
+
+class PooledConnection(object):
+    """
+    Proxy of a connection acquired from a pool, behaving like the connection
+    except that 'close' resets it (see 'DatabaseInterface._reset_conn') and
+    returns it to the pool - to be health checked before it's reused if
+    'suspect'. Connections that fail to reset are closed. Connections that
+    are never closed (e.g. by a batch generator that's never iterated) are
+    returned once the proxy is garbage collected - by a weak reference
+    callback, as a '__del__' method would keep proxies in reference cycles
+    from being collected.
+
+    Session temporary tables created on the connection are listed in
+    'temp_table_names', so that they're dropped before it's reused.
+
+    """
+
+    def __init__(self, pool, connection, db_interface):
+        self._lease = _Lease(pool, connection, db_interface)
+        self._lease.collect_ref = weakref.ref(self, self._lease.collected)
+        _lease_refs.add(self._lease.collect_ref)
+        self.temp_table_names = self._lease.temp_table_names
+
+    def __getattr__(self, item):
+        return getattr(self._lease.connection, item)
+
+    @property
+    def connection(self):
+        """ The underlying connection - None once released. """
+        return self._lease.connection
+
+    def close(self, suspect=False):
+        self._lease.release(suspect=suspect)
+
+    def discard(self):
+        """ Close the underlying connection instead of returning it to the pool. """
+        self._lease.release(discard=True)
+
+
+# =============================================
+# Shared Pools
+# ---------------------------------------------
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def shared_pool(db_interface):
+    """
+    Return the connection pool of a database interface. Interfaces with the
+    same identity (database type and connection parameters - see
+    'DatabaseInterface.identity') share a pool, so several graphs - or
+    several connectors of one graph - querying the same database reuse
+    each other's connections. Pools aren't shared with forked processes.
+
+    The pools stay open for the life of the process - their idle
+    connections are closed after 'max_idle_time' seconds - and are closed
+    at exit, or earlier by 'close_pools'.
+
+    """
+    key = (os.getpid(), db_interface.identity)
+    with _pools_lock:
+        if key not in _pools:
+            pool_cls = ConnectionPool if db_interface.exclusive_connections else SharedConnection
+            _pools[key] = pool_cls(connect=db_interface.conn,
+                                   close=db_interface._close_conn,
+                                   is_healthy=db_interface._check_conn)
+        return _pools[key]
+
+
+def close_pools():
+    """
+    Close the idle connections of every shared pool (connections in use are
+    closed when they're released) and forget the pools, so that later
+    queries open new ones. Called at exit. The connections of pools opened
+    before a fork are left to the process that opened them.
+
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [pool for (pool_pid, identity), pool in _pools.items() if pool_pid == pid]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_pools)
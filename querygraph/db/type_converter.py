@@ -4,6 +4,7 @@ import copy
 from collections import defaultdict
 
 import numpy as np
+import pandas as pd
 
 from querygraph import exceptions
 
@@ -24,6 +25,10 @@ class TypeConverter(object):
         A dictionary mapping container render types (e.g. 'list')
         to a converter (callable) that returns a value that can be
         used in a database query.
+    value_converters : dict or None
+        Like 'type_converters', but for structured queries (see
+        'to_python'): the converters return the Python value to place in
+        the query structure rather than its text representation.
 
     """
 
@@ -95,6 +100,69 @@ class TypeConverter(object):
         }
     }
 
+    # Python values equivalent to the text rendered by GENERIC_TYPE_CONVERTERS, once deserialized.
+    GENERIC_VALUE_CONVERTERS = {
+        'int': {
+            int: lambda x: x,
+            long: lambda x: x,
+            np.int64: lambda x: int(x),
+            np.int32: lambda x: int(x),
+            np.int16: lambda x: int(x),
+            np.int8: lambda x: int(x),
+            np.float64: lambda x: int(x),
+            np.float32: lambda x: int(x),
+            np.float16: lambda x: int(x),
+            float: lambda x: int(x),
+            str: lambda x: int(x),
+            bool: lambda x: 1 if x else 0
+        },
+        'float': {
+            int: lambda x: float(x),
+            long: lambda x: float(x),
+            np.int64: lambda x: float(x),
+            np.int32: lambda x: float(x),
+            np.int16: lambda x: float(x),
+            np.int8: lambda x: float(x),
+            np.float64: lambda x: float(x),
+            np.float32: lambda x: float(x),
+            np.float16: lambda x: float(x),
+            float: lambda x: x,
+            str: lambda x: float(x)
+        },
+        'str': {
+            str: lambda x: x,
+            unicode: lambda x: x,
+            bool: lambda x: str(x),
+            float: lambda x: str(x),
+            int: lambda x: str(x),
+            datetime.datetime: lambda x: x.strftime('%Y-%m-%d %H:%M:%S'),
+            pd.Timestamp: lambda x: x.strftime('%Y-%m-%d %H:%M:%S'),
+            datetime.date: lambda x: x.strftime('%Y-%m-%d'),
+            datetime.time: lambda x: x.strftime('%H:%M:%S'),
+        },
+        'datetime': {
+            datetime.datetime: lambda x: x.strftime('%Y-%m-%d %H:%M:%S'),
+            pd.Timestamp: lambda x: x.strftime('%Y-%m-%d %H:%M:%S'),
+            datetime.date: lambda x: x.strftime('%Y-%m-%d'),
+            str: lambda x: x,
+            unicode: lambda x: x,
+        },
+        'date': {
+            datetime.datetime: lambda x: x.strftime('%Y-%m-%d'),
+            pd.Timestamp: lambda x: x.strftime('%Y-%m-%d'),
+            datetime.date: lambda x: x.strftime('%Y-%m-%d'),
+            str: lambda x: x,
+            unicode: lambda x: x,
+        },
+        'time': {
+            datetime.datetime: lambda x: x.strftime('%H:%M:%S'),
+            pd.Timestamp: lambda x: x.strftime('%H:%M:%S'),
+            datetime.time: lambda x: x.strftime('%H:%M:%S'),
+            str: lambda x: x,
+            unicode: lambda x: x,
+        }
+    }
+
     GENERIC_CONTAINER_CONVERTERS = {
         # Container type 'list'
         # Parameter string: '<parameter_expression> -> list:<render_type>'
@@ -104,13 +172,16 @@ class TypeConverter(object):
         'tuple': lambda x: '(%s)' % ", ".join(str(y) for y in x)
     }
 
-    def __init__(self, type_converters=None, container_converters=None):
+    def __init__(self, type_converters=None, container_converters=None, value_converters=None):
         self.db_specific_converters = type_converters
         self.db_specific_container_converters = container_converters
+        self.db_specific_value_converters = value_converters
         self.type_converters = defaultdict(dict)
         self.container_converters = defaultdict(dict)
+        self.value_converters = defaultdict(dict)
         self._setup_type_converters()
         self._setup_container_converters()
+        self._setup_value_converters()
 
     def _convert_atomic_value(self, rendered_type, python_value):
         self._check_conversion_inputs(rendered_type, python_value)
@@ -124,6 +195,27 @@ class TypeConverter(object):
         else:
             return self._convert_atomic_value(rendered_type=rendered_type, python_value=python_value)
 
+    def to_python(self, rendered_type, python_value, container_type=None):
+        """
+        Convert an evaluated parameter value into the Python value placed in
+        a structured (e.g. Mongo DB or ElasticSearch) query. Containers are
+        converted into lists.
+
+        """
+        if container_type is not None:
+            self._container_type_check(container_type)
+            return [self._to_python_atomic(rendered_type, x) for x in python_value]
+        return self._to_python_atomic(rendered_type, python_value)
+
+    def _to_python_atomic(self, rendered_type, python_value):
+        if rendered_type not in self.value_converters:
+            raise exceptions.TypeConversionError("The given render type '%s' is not supported." % rendered_type)
+        if type(python_value) not in self.value_converters[rendered_type]:
+            raise exceptions.TypeConversionError("Dont know how to convert Python"
+                                                 "value of type '%s' to render type '%s'" % (type(python_value),
+                                                                                             rendered_type))
+        return self.value_converters[rendered_type][type(python_value)](python_value)
+
     def _container_type_check(self, container_type):
         if container_type not in self.supported_container_types:
             raise exceptions.TypeConversionError("Unsupported container type: '%s'." % container_type)
@@ -182,10 +274,14 @@ class TypeConverter(object):
                     raise exceptions.TypeConverterException
                 self.container_converters[container_type] = converter
 
-
-
-
-
-
-
-
+    def _setup_value_converters(self):
+        for render_type, converter_dict in self.GENERIC_VALUE_CONVERTERS.items():
+            self.value_converters[render_type] = dict(converter_dict)
+        if self.db_specific_value_converters is not None:
+            for render_type, converter_dict in self.db_specific_value_converters.items():
+                for input_type, converter in converter_dict.items():
+                    if not isinstance(input_type, type):
+                        raise exceptions.TypeConverterException
+                    if not callable(converter):
+                        raise exceptions.TypeConverterException
+                    self.value_converters[render_type][input_type] = converter
@@ -68,6 +68,10 @@ class DisconnectedNodes(GraphException):
     pass
 
 
+class ExecutionTimeout(GraphException):
+    pass
+
+
 # =================================================
 # Join Context Exceptions
 # -------------------------------------------------
@@ -1,9 +1,17 @@
+import multiprocessing
+import sys
+from multiprocessing.pool import ThreadPool
 
 from querygraph import exceptions
 from querygraph.language.compiler import QGLCompiler
 from querygraph.query_node import QueryNode
 from querygraph.manipulation.set import ManipulationSet
 from querygraph.execution_log import ExecutionLog
+from querygraph.chunking import AdaptiveChunkSize
+from querygraph.scheduler import ExecutionScheduler, ExecutionFuture, shared_pool
+from querygraph import stats
+from querygraph import lineage
+from querygraph import columnar
 
 
 # =================================================
@@ -22,11 +30,60 @@ class QueryGraph(object):
         Query Graph Language string to compile containing graph logic.
     use_threads : bool
         Whether or not to use threads when execution query.
+    max_workers : int
+        Maximum number of query nodes executed concurrently when using
+        threads.
+    manipulation_processes : int
+        Number of worker processes to execute large manipulation sets in.
+        If 0, manipulation sets are executed on the thread that retrieved
+        the node's data. The pool is created up front, before any execution
+        threads exist, and is released by 'close' - or on leaving the graph's
+        'with' block.
+    param_chunk_size : int or None
+        If given, a dependent parameter rendering a container of more values
+        than this is split into chunk queries that are executed concurrently
+        and whose results are concatenated. The chunk size shrinks (never
+        grows beyond this value) to keep each chunk query near
+        'AdaptiveChunkSize.target_latency'. Only use this for graphs whose
+        chunked queries filter on the parameter without aggregating.
+    stats_store : ExecutionStatsStore or None
+        If given, every successful execution records per-node statistics
+        in the store, and the statistics of previous executions of the same
+        graph are used to start the longest critical path first, size the
+        worker pool and pick the initial chunk sizes.
+    result_cache : ResultCache or None
+        If given, node query results are cached in it, so that identical
+        queries on the same connector are not re-executed. It may be shared
+        by several graphs. Set a node's 'cache_ttl' to override the cache's
+        default TTL for that node.
+    join_memory_budget : int or None
+        If given, joins whose dataframes take more than this many bytes
+        are done out of core, spilling hash partitions of both dataframes
+        to disk (see 'grace_join').
+    spill_dir : str or None
+        Directory of the spill files of out of core joins. Defaults to the
+        system's temporary directory.
 
     """
 
-    def __init__(self, qgl_str=None, use_threads=True):
+    DEFAULT_MAX_WORKERS = 8
+
+    # Number of root rows per batch in streamed executions (see 'execute_iter').
+    DEFAULT_BATCH_SIZE = 10000
+
+    def __init__(self, qgl_str=None, use_threads=True, max_workers=DEFAULT_MAX_WORKERS, manipulation_processes=0,
+                 param_chunk_size=None, stats_store=None, result_cache=None, join_memory_budget=None, spill_dir=None):
         self.use_threads = use_threads
+        self.max_workers = max_workers
+        self.param_chunk_size = param_chunk_size
+        self.stats_store = stats_store
+        self.result_cache = result_cache
+        self.join_memory_budget = join_memory_budget
+        self.spill_dir = spill_dir
+        self.node_stats = dict()
+        self.process_pool = None
+        if manipulation_processes:
+            self.process_pool = multiprocessing.Pool(processes=manipulation_processes)
         self.nodes = dict()
         self.num_edges = 0
         self.log = ExecutionLog(stdout_print=True)
@@ -63,6 +120,11 @@ class QueryGraph(object):
     def num_nodes(self):
         return len(self.nodes.keys())
 
+    @property
+    def fingerprint(self):
+        """ Fingerprint identifying the graph's structure in the statistics store. """
+        return stats.graph_fingerprint(self.root_node)
+
     @property
     def root_node(self):
         """ Return the root QueryNode instance - the node with no parent."""
@@ -133,10 +195,11 @@ class QueryGraph(object):
 
     def _parallel_execute(self, independent_param_vals):
         """
-        Execution the QueryGraph in 'parallel'. For each node generation
-        contained in the graph, this requires:
-
-            ...
+        Execute the QueryGraph in 'parallel'. Nodes are run on a bounded pool
+        of worker threads, and each node's children are dispatched as soon as
+        the node finishes. Each node's children are joined with it as soon as
+        they have all finished and joined their own children, so folding
+        overlaps with queries that are still running.
 
         Parameters
         ----------
@@ -145,41 +208,338 @@ class QueryGraph(object):
             use in template rendering.
 
         """
-        threads = list()
-        root_thread = self.root_node.root_execution_thread(threads=threads,
-                                                           independent_param_vals=independent_param_vals)
-        root_thread.start()
-        threads.append(root_thread)
-        # Wait until all threads have been created.
-        while len(threads) < self.num_nodes:
-            # Keep checking threads for any errors to prevent this becoming an infinite loop.
-            for t in threads:
-                if t.has_error:
-                    raise exceptions.QueryGraphException("Execution exception in thread: %s" % t.exception)
-            pass
-        for thread in threads:
-            thread.join()
-        self.root_node.fold_children()
+        max_workers = self.max_workers
+        estimated_parallelism = stats.parallelism(self.root_node, self.node_stats)
+        if estimated_parallelism is not None:
+            max_workers = max(1, min(max_workers, estimated_parallelism))
+        scheduler = ExecutionScheduler(root_node=self.root_node, log=self.log, max_workers=max_workers,
+                                       priorities=self._priorities())
+        scheduler.execute(independent_param_vals=independent_param_vals)
 
     def _pre_execution_checks(self):
         if not self.is_spanning_tree:
             self.log.graph_error(msg="Can't execute graph because there are disconnected nodes.")
             raise exceptions.DisconnectedNodes("Can't execute graph because there are disconnected nodes.")
 
+    def _prepare_nodes(self):
+        if self.stats_store is not None:
+            self.node_stats = self.stats_store.node_stats(self.fingerprint)
+        for query_node in self.nodes.values():
+            query_node.process_pool = self.process_pool
+            query_node.execution_stats = dict()
+            if self.result_cache is not None:
+                query_node.result_cache = self.result_cache
+            query_node.join_context.memory_budget = self.join_memory_budget
+            query_node.join_context.spill_dir = self.spill_dir
+            if self.param_chunk_size is not None and query_node.adaptive_chunk_size is None:
+                previous_chunk_size = self.node_stats.get(query_node.name, dict()).get('chunk_size')
+                query_node.adaptive_chunk_size = AdaptiveChunkSize(max_size=self.param_chunk_size,
+                                                                   initial_size=previous_chunk_size)
+        lineage.push_down_projections(self.root_node)
+        lineage.push_down_filters(self.root_node)
+        for query_node in self:
+            if query_node.projection is not None:
+                self.log.node_info(source_node=query_node.name,
+                                   msg="Query narrowed to columns: %s." % ", ".join(query_node.projection))
+            if query_node.source_conditions:
+                self.log.node_info(source_node=query_node.name,
+                                   msg="Pushed %s filter(s) down into the query." % len(query_node.source_conditions))
+
+    def _priorities(self):
+        if not self.node_stats:
+            return None
+        return stats.critical_paths(self.root_node, self.node_stats)
+
+    def _record_stats(self):
+        """ Record the statistics of the latest execution in the graph's statistics store. """
+        if self.stats_store is None:
+            return
+        node_stats = dict()
+        for query_node in self.nodes.values():
+            node_stats[query_node.name] = dict(query_node.execution_stats)
+            if node_stats[query_node.name] and query_node.adaptive_chunk_size is not None:
+                node_stats[query_node.name]['chunk_size'] = query_node.adaptive_chunk_size.value
+        self.stats_store.record(self.fingerprint, node_stats)
+
     def _execute(self, independent_param_vals):
         for query_node in self:
             query_node.retrieve_dataframe(independent_param_vals=independent_param_vals)
         self.root_node.fold_children()
 
+    def execute_async(self, **independent_param_vals):
+        """
+        Start executing the QueryGraph without blocking the calling thread, and
+        return an ExecutionFuture that resolves to the folded root dataframe.
+
+        Nodes run on a bounded pool shared by all asynchronous executions, and
+        their queries go through the connectors' asynchronous hook, so that
+        connectors with a native asynchronous driver do not occupy a pool
+        thread while waiting on the database. Only one execution of a given
+        QueryGraph instance should be in flight at a time.
+
+        """
+        self.log.graph_info(msg="Starting async execution on query graph with %s nodes." % self.num_nodes)
+        self._pre_execution_checks()
+        self._prepare_nodes()
+        future = ExecutionFuture()
+        pool = shared_pool()
+        scheduler = ExecutionScheduler(root_node=self.root_node, log=self.log, max_workers=self.max_workers,
+                                       pool=pool, async_queries=True, priorities=self._priorities())
+
+        def resolve(finished_scheduler):
+            if finished_scheduler.exc_info is not None:
+                future.set_exc_info(finished_scheduler.exc_info)
+                return
+            try:
+                self._record_stats()
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(self._result())
+
+        scheduler.start(independent_param_vals=independent_param_vals, callback=resolve)
+        return future
+
+    def prepare(self):
+        """
+        Return a PreparedGraph that executes this graph - compiled once, with
+        its connectors and query templates - many times, possibly from
+        several threads at once.
+
+        """
+        return PreparedGraph(query_graph=self)
+
+    @property
+    def db_interfaces(self):
+        """ Dictionary mapping the names of the graph's connectors to the connectors. """
+        return {query_node.db_interface.name: query_node.db_interface for query_node in self.nodes.values()}
+
+    def warm_up_pools(self):
+        """ Open the connections the pools of the graph's connectors keep open (see 'ConnectionPool.warm_up'). """
+        for db_interface in self.db_interfaces.values():
+            db_interface.pool.warm_up()
+
+    def pool_metrics(self):
+        """
+        Return a dictionary mapping the names of the graph's connectors to
+        the metrics of their connection pools (see 'ConnectionPool.metrics').
+        Connectors sharing a pool report the same metrics.
+
+        """
+        return {name: db_interface.pool.metrics() for name, db_interface in self.db_interfaces.items()}
+
+    def close(self):
+        """
+        Release the graph's manipulation process pool, if it has one. The
+        connection pools of the graph's connectors are shared with other
+        graphs, and aren't closed (see 'pool.close_pools').
+
+        """
+        if self.process_pool is not None:
+            self.process_pool.terminate()
+            self.process_pool.join()
+            self.process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def execute(self, **independent_param_vals):
         self.log.graph_info(msg="Starting execution on query graph using "
                                 "threads with %s nodes. THREADS_ENABLED = %s" % (self.num_nodes, self.use_threads))
         self._pre_execution_checks()
+        self._prepare_nodes()
         if self.use_threads:
             self._parallel_execute(independent_param_vals)
         else:
             self._execute(independent_param_vals)
-        return self.root_node.df
+        self._record_stats()
+        return self._result()
+
+    def _result(self):
+        """
+        The root node's dataframe - copied if it's a query result held by the
+        result cache, which later executions are served from.
+
+        """
+        df = self.root_node.df
+        if self.result_cache is not None and self.result_cache.holds(df):
+            df = df.copy()
+        return df
+
+    @property
+    def is_arrow_native(self):
+        """
+        Whether the graph's result is its root node's query result as is - a
+        single node without manipulations - so that 'execute_arrow' can
+        return the Arrow table fetched by the connector.
+
+        """
+        return self.num_nodes == 1 and not self.root_node.manipulation_set
+
+    def execute_arrow(self, **independent_param_vals):
+        """
+        Execute the QueryGraph and return its result as a pyarrow Table
+        (requires the 'pyarrow' package).
+
+        If the graph is Arrow native (see 'is_arrow_native'), the table is
+        the one the root node's connector returns (see
+        'DatabaseInterface.execute_query_arrow'), and no dataframe is built
+        at all. Otherwise the graph is executed with 'execute' - joins and
+        manipulations run on dataframes - and the result is converted once,
+        at the end.
+
+        """
+        if not self.is_arrow_native:
+            return columnar.table_from_df(self.execute(**independent_param_vals))
+        self.log.graph_info(msg="Starting Arrow execution on query graph with a single node.")
+        self._pre_execution_checks()
+        self._prepare_nodes()
+        table = self.root_node.retrieve_table(independent_param_vals=independent_param_vals)
+        self._record_stats()
+        return table
+
+    @property
+    def is_streamable(self):
+        """
+        Whether the graph's result can be computed one batch of root rows at
+        a time - i.e. every child of the root is inner or left joined, so
+        that joining each batch and concatenating the results is the same as
+        joining the whole root dataframe, and the manipulation sets of the
+        root's subtrees are key local on their join columns (see
+        'ManipulationSet.key_local'), so that the subtrees' results for a
+        batch's keys don't depend on the other batches' keys.
+
+        """
+        return (all(child.join_context.join_type in ('inner', 'left') for child in self.root_node.children) and
+                all(query_node.manipulation_set.key_local(query_node.join_context.child_cols)
+                    for child in self.root_node.children for query_node in child))
+
+    def execute_iter(self, batch_size=DEFAULT_BATCH_SIZE, **independent_param_vals):
+        """
+        Execute the QueryGraph in streaming mode: a generator yielding the
+        folded result in batches, whose concatenation is the result of
+        'execute'.
+
+        The root node's query result is fetched in record batches of at
+        most 'batch_size' rows (from connectors that support it - see
+        'DatabaseInterface.supports_batches'), and its manipulation set is
+        applied to each batch (see 'ManipulationSet.execute_batches'). The
+        root's subtrees are then executed for each batch - their dependent
+        parameters rendered from the batch's keys - and joined with it,
+        before the joined batch is yielded. The first rows are available
+        once the first batch is joined, and memory use is bounded by the
+        batch size rather than by the size of the root's result.
+
+        Graphs that aren't streamable (see 'is_streamable') are executed as
+        a whole and their result is yielded as one batch. Streamed
+        executions aren't recorded in the statistics store, since the child
+        nodes run once per batch.
+
+        """
+        if not self.is_streamable:
+            self.log.graph_info(msg="Query graph can't be streamed (right or outer joins with the root node, or "
+                                    "manipulations of child nodes that need all their rows).")
+            yield self.execute(**independent_param_vals)
+            return
+        self.log.graph_info(msg="Starting streamed execution on query graph with %s nodes." % self.num_nodes)
+        self._pre_execution_checks()
+        self._prepare_nodes()
+        root_node = self.root_node
+        pool = ThreadPool(processes=max(1, min(self.max_workers, self.num_nodes))) if self.use_threads else None
+        try:
+            for batch_df in root_node.retrieve_batches(independent_param_vals=independent_param_vals,
+                                                       batch_size=batch_size):
+                if batch_df.empty:
+                    continue
+                root_node.df = batch_df
+                for child in root_node.children:
+                    self._execute_subtree(child, independent_param_vals, pool=pool)
+                root_node.join_children()
+                yield root_node.df
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _execute_subtree(self, query_node, independent_param_vals, pool=None):
+        """
+        Execute and fold the subtree of a non-root node, whose parent holds its
+        dataframe - on the given thread pool, or sequentially if it's None.
+
+        """
+        if pool is not None:
+            scheduler = ExecutionScheduler(root_node=query_node, log=self.log, max_workers=self.max_workers,
+                                           pool=pool, priorities=self._priorities())
+            scheduler.execute(independent_param_vals=independent_param_vals)
+        else:
+            for subtree_node in query_node:
+                subtree_node.retrieve_dataframe(independent_param_vals=independent_param_vals)
+            query_node.fold_children()
+
+
+# =================================================
+# Prepared Graph Class
+# -------------------------------------------------
+
+class PreparedGraph(object):
+
+    """
+    A compiled QueryGraph that can be executed many times with different
+    independent parameter values. Each execution runs on a copy of the
+    graph's nodes with its own execution log, so executions may run
+    concurrently from several threads. The copies share the graph's
+    connectors, query templates, join contexts, manipulation sets, chunk
+    sizes, process pool, statistics store and result cache. The connection
+    pools of the graph's connectors are warmed up when it's prepared.
+
+    Parameters
+    ----------
+    query_graph : QueryGraph
+        The compiled graph to execute. It shouldn't be modified afterwards.
+
+    """
+
+    def __init__(self, query_graph):
+        query_graph._pre_execution_checks()
+        query_graph._prepare_nodes()
+        query_graph.warm_up_pools()
+        self.query_graph = query_graph
+
+    def _execution_graph(self):
+        source_graph = self.query_graph
+        query_graph = QueryGraph(use_threads=source_graph.use_threads,
+                                 max_workers=source_graph.max_workers,
+                                 param_chunk_size=source_graph.param_chunk_size,
+                                 stats_store=source_graph.stats_store,
+                                 result_cache=source_graph.result_cache,
+                                 join_memory_budget=source_graph.join_memory_budget,
+                                 spill_dir=source_graph.spill_dir)
+        query_graph.process_pool = source_graph.process_pool
+        for query_node in source_graph.root_node.copy_tree(log=query_graph.log):
+            query_graph.nodes[query_node.name] = query_node
+        query_graph.num_edges = source_graph.num_edges
+        return query_graph
+
+    def execute(self, **independent_param_vals):
+        return self._execution_graph().execute(**independent_param_vals)
+
+    def execute_async(self, **independent_param_vals):
+        return self._execution_graph().execute_async(**independent_param_vals)
+
+    def execute_iter(self, batch_size=QueryGraph.DEFAULT_BATCH_SIZE, **independent_param_vals):
+        return self._execution_graph().execute_iter(batch_size=batch_size, **independent_param_vals)
+
+    def execute_arrow(self, **independent_param_vals):
+        return self._execution_graph().execute_arrow(**independent_param_vals)
 
+    def close(self):
+        self.query_graph.close()
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,3 +1,14 @@
+import math
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from pandas.api import types
+from pandas.api.types import is_extension_array_dtype
+
 from querygraph import exceptions
 
 
@@ -6,6 +17,15 @@ from querygraph import exceptions
 # ---------------------------------------------
 
 class JoinContext(object):
+    """
+    How a child node's dataframe is joined with its parent's.
+
+    If 'memory_budget' is set (in bytes) and the dataframes of a join take
+    more memory than that, the join is done out of core with a grace hash
+    join (see 'grace_join'), spilling to 'spill_dir' (None for the system's
+    temporary directory).
+
+    """
 
     def __init__(self, child_node_name):
         self.child_node_name = child_node_name
@@ -13,6 +33,8 @@ class JoinContext(object):
         self.parent_cols = list()
         self.child_cols = list()
         self._join_type = None
+        self.memory_budget = None
+        self.spill_dir = None
 
     @property
     def join_type(self):
@@ -46,13 +68,482 @@ class JoinContext(object):
     def _rename_duplicates(self, parent_df, child_df):
         pass
 
+    def exceeds_memory_budget(self, parent_df, child_df):
+        if self.memory_budget is None:
+            return False
+        return _memory_usage(parent_df) + _memory_usage(child_df) > self.memory_budget
+
     def apply_join(self, parent_df, child_df):
         self._column_check(parent_df, child_df)
+        if self.exceeds_memory_budget(parent_df, child_df):
+            return grace_join(parent_df, child_df, join_context=self)
         joined_df = parent_df.merge(child_df, how=self.join_type, left_on=self.parent_cols,
                                     right_on=self.child_cols, copy=False)
         return joined_df
 
 
+# =============================================
+# Multi-way Join
+# ---------------------------------------------
+
+# Join types that keep (a subset of) the parent's rows, and so can be folded in one pass.
+FOLDABLE_JOIN_TYPES = ('inner', 'left')
+
+
+def _factorize_keys(parent_df, child_df, join_context):
+    """
+    Return integer codes for the join keys of the parent's and the child's
+    rows - equal codes for equal keys, nulls matching nulls as in 'merge' -
+    and the number of distinct codes.
+
+    """
+    num_parent_rows = len(parent_df.index)
+    combined = None
+    for parent_col, child_col in zip(join_context.parent_cols, join_context.child_cols):
+        codes, uniques = pd.factorize(np.concatenate([parent_df[parent_col].values, child_df[child_col].values]))
+        codes[codes == -1] = len(uniques)
+        if combined is None:
+            combined = codes
+        else:
+            combined = pd.factorize(combined * (len(uniques) + 1) + codes)[0]
+    num_codes = combined.max() + 1 if len(combined) else 0
+    return combined[:num_parent_rows], combined[num_parent_rows:], num_codes
+
+
+def _is_datetimelike(series):
+    return (types.is_datetime64_any_dtype(series) or types.is_timedelta64_dtype(series) or
+            types.is_period_dtype(series))
+
+
+def _check_key_dtypes(parent_df, child_df, join_context):
+    """
+    Raise a ValueError, as 'merge' does, if parent and child key columns
+    hold values that can't be equal - e.g. numbers and strings, or dates
+    and anything else.
+
+    """
+    bool_types = ('integer', 'mixed-integer', 'boolean', 'empty')
+    string_types = ('string', 'unicode', 'mixed', 'bytes', 'empty')
+    for parent_col, child_col in zip(join_context.parent_cols, join_context.child_cols):
+        left, right = parent_df[parent_col], child_df[child_col]
+        if (types.is_dtype_equal(left.dtype, right.dtype) or types.is_categorical_dtype(left) or
+                types.is_categorical_dtype(right)):
+            continue
+        if types.is_numeric_dtype(left) and types.is_numeric_dtype(right):
+            continue
+        left_object, right_object = types.is_object_dtype(left), types.is_object_dtype(right)
+        if (left_object and types.is_bool_dtype(right)) or (types.is_bool_dtype(left) and right_object):
+            continue
+        if (left_object and types.is_numeric_dtype(right)) or (types.is_numeric_dtype(left) and right_object):
+            inferred_left = types.infer_dtype(left, skipna=False)
+            inferred_right = types.infer_dtype(right, skipna=False)
+            if ((inferred_left in bool_types and inferred_right in bool_types) or
+                    (inferred_left in string_types) == (inferred_right in string_types)):
+                continue
+        elif (_is_datetimelike(left) == _is_datetimelike(right) and
+              types.is_datetime64tz_dtype(left) == types.is_datetime64tz_dtype(right)):
+            continue
+        raise ValueError("You are trying to merge on %s and %s columns. If you wish to proceed you should use "
+                         "pd.concat" % (left.dtype, right.dtype))
+
+
+def _probe(left_codes, right_codes, num_codes, how):
+    """
+    Match rows by key code, keeping the order of the left rows. Returns the
+    positions of the matched left and right rows, -1 standing for a left
+    row without a match (left joins).
+
+    """
+    counts = np.bincount(right_codes, minlength=num_codes)
+    match_counts = counts[left_codes]
+    out_counts = np.maximum(match_counts, 1) if how == 'left' else match_counts
+    left_idx = np.repeat(np.arange(len(left_codes)), out_counts)
+    if not len(right_codes):
+        return left_idx, np.full(len(left_idx), -1, dtype=np.intp)
+    order = np.argsort(right_codes, kind='mergesort')
+    starts = np.cumsum(counts) - counts
+    offsets = np.arange(len(left_idx)) - np.repeat(np.cumsum(out_counts) - out_counts, out_counts)
+    right_pos = np.repeat(starts[left_codes], out_counts) + offsets
+    matched = np.repeat(match_counts > 0, out_counts)
+    right_idx = np.where(matched, order[np.minimum(right_pos, len(order) - 1)], -1)
+    return left_idx, right_idx
+
+
+def _take(series, indexer, allow_fill):
+    if is_extension_array_dtype(series.dtype):
+        return series.array.take(indexer, allow_fill=allow_fill)
+    values = pd.api.extensions.take(series.values, indexer, allow_fill=allow_fill)
+    if allow_fill:
+        # Upcast to a dtype that holds nulls even if no row is left without a match.
+        null_dtype = pd.api.extensions.take(series.values[:0], [-1], allow_fill=True).dtype
+        values = values.astype(null_dtype, copy=False)
+    return values
+
+
+def _joined_columns(columns, join_context, child_df, frame):
+    """
+    Return the output columns after joining the child dataframe, given the
+    output columns before, as (frame, column position, name) tuples - named
+    as by 'merge' with a non-empty left dataframe: a child key column named
+    like its parent key column is dropped, and other overlapping columns
+    get the '_x' and '_y' suffixes.
+
+    """
+    dropped = {child_col for parent_col, child_col in zip(join_context.parent_cols, join_context.child_cols)
+               if parent_col == child_col}
+    child_columns = [(frame, i, col) for i, col in enumerate(child_df.columns) if col not in dropped]
+    overlap = {name for _, _, name in columns} & {col for _, _, col in child_columns}
+    return ([(f, i, name + '_x' if name in overlap else name) for f, i, name in columns] +
+            [(f, i, name + '_y' if name in overlap else name) for f, i, name in child_columns])
+
+
+def _parent_key_positions(columns, join_context):
+    """
+    Return the positions of the parent's columns a join is on, given the
+    output columns of the joins before - None if a key column isn't one of
+    the parent's own columns under a unique name.
+
+    """
+    positions = list()
+    for parent_col in join_context.parent_cols:
+        matches = [(frame, i) for frame, i, name in columns if name == parent_col]
+        if len(matches) != 1 or matches[0][0] != 0:
+            return None
+        positions.append(matches[0][1])
+    return positions
+
+
+def _foldable_joins(parent_df, joins):
+    """
+    Return the leading joins that can be folded into the parent in a single
+    pass: inner and left joins on the parent's own columns, within their
+    memory budget. A parent without rows isn't folded into, since 'merge'
+    then keeps the child's key columns instead of the parent's.
+
+    """
+    if not len(parent_df.index):
+        return list()
+    columns = [(0, i, col) for i, col in enumerate(parent_df.columns)]
+    foldable = list()
+    for join_context, child_df in joins:
+        if (join_context.join_type not in FOLDABLE_JOIN_TYPES or
+                _parent_key_positions(columns, join_context) is None or
+                join_context.exceeds_memory_budget(parent_df, child_df)):
+            break
+        foldable.append((join_context, child_df))
+        columns = _joined_columns(columns, join_context, child_df, frame=len(foldable))
+    return foldable
+
+
+def _fold(parent_df, joins):
+    """
+    Fold inner and left joins on the parent's columns (see '_foldable_joins')
+    into the parent in a single pass. Folding stops after a join leaving no
+    rows. Returns the joined dataframe and the number of rows after each
+    join folded.
+
+    Rows are ordered as by 'merge': left joins keep the order of the
+    parent's rows, while inner joins group them by key, in order of the
+    keys' first appearance.
+
+    """
+    # Positions of each frame's rows in the output, and the output columns.
+    indexers = [np.arange(len(parent_df.index))]
+    # Whether a frame had rows without a match - in which case, like with 'merge', its columns are upcast
+    # to hold nulls, even if later joins drop those rows.
+    unmatched = [False]
+    columns = [(0, i, col) for i, col in enumerate(parent_df.columns)]
+    frames = [parent_df]
+    row_counts = list()
+    for join_context, child_df in joins:
+        key_positions = _parent_key_positions(columns, join_context)
+        key_df = parent_df
+        if [parent_df.columns[i] for i in key_positions] != join_context.parent_cols:
+            # Key columns renamed by an earlier join.
+            key_df = parent_df.iloc[:, key_positions]
+            key_df.columns = join_context.parent_cols
+        join_context._column_check(key_df, child_df)
+        _check_key_dtypes(key_df, child_df, join_context)
+        left_codes, right_codes, num_codes = _factorize_keys(key_df, child_df, join_context)
+        left_codes = left_codes[indexers[0]]
+        if join_context.join_type == 'inner':
+            key_order = np.argsort(pd.factorize(left_codes)[0], kind='mergesort')
+            indexers = [indexer[key_order] for indexer in indexers]
+            left_codes = left_codes[key_order]
+        left_idx, right_idx = _probe(left_codes, right_codes, num_codes, how=join_context.join_type)
+        indexers = [indexer[left_idx] for indexer in indexers] + [right_idx]
+        unmatched.append(bool((right_idx == -1).any()))
+        row_counts.append(len(left_idx))
+        frames.append(child_df)
+        columns = _joined_columns(columns, join_context, child_df, frame=len(frames) - 1)
+        if not len(left_idx):
+            break
+
+    data = OrderedDict()
+    for frame, i, name in columns:
+        data[len(data)] = _take(frames[frame].iloc[:, i], indexers[frame], unmatched[frame])
+    joined_df = pd.DataFrame(data, columns=list(data.keys()))
+    # Set afterwards, as column names may repeat.
+    joined_df.columns = [name for frame, i, name in columns]
+    if not len(joined_df.index):
+        # 'merge' gives empty results an empty object index.
+        joined_df.index = pd.Index([])
+    return joined_df, row_counts
+
+
+def multi_join(parent_df, joins):
+    """
+    Join several child dataframes with a parent dataframe, with the same
+    result as joining them one after the other with 'JoinContext.apply_join'.
+
+    Consecutive inner and left joins on the parent's own columns are folded
+    in a single pass: the keys of each child are hashed once, the parent's
+    rows are probed once per child, and the joined dataframe is allocated
+    once, instead of copying the growing parent dataframe for every child.
+    Right and outer joins, joins on columns brought in by an earlier child
+    and joins exceeding their memory budget are applied one at a time with
+    'JoinContext.apply_join'.
+
+    Parameters
+    ----------
+    parent_df : pd.DataFrame
+        The parent's dataframe.
+    joins : list
+        (JoinContext, child dataframe) pairs, in join order.
+
+    Returns
+    -------
+    tuple
+        The joined dataframe, and the number of rows it had after each join.
+
+    """
+    row_counts = list()
+    position = 0
+    while position < len(joins):
+        foldable = _foldable_joins(parent_df, joins[position:])
+        if foldable:
+            parent_df, fold_row_counts = _fold(parent_df, foldable)
+            row_counts.extend(fold_row_counts)
+            position += len(fold_row_counts)
+        else:
+            join_context, child_df = joins[position]
+            parent_df = join_context.apply_join(parent_df=parent_df, child_df=child_df)
+            row_counts.append(len(parent_df.index))
+            position += 1
+    return parent_df, row_counts
+
+
+# =============================================
+# Grace Hash Join
+# ---------------------------------------------
+
+# Bounds on the number of partitions of a grace hash join.
+MIN_PARTITIONS = 2
+
+MAX_PARTITIONS = 1024
+
+# Fraction of the memory budget a partition pair should take, leaving room for the join's hash tables and output.
+PARTITION_BUDGET_FRACTION = 1 / 3.0
+
+
+def _memory_usage(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+# Columns holding the positions of the parent's and the child's rows in the partitions of a grace hash join.
+PARENT_POSITION_COL = '_qg_parent_position'
+
+CHILD_POSITION_COL = '_qg_child_position'
+
+
+def _spill_partitions(df, partition_codes, num_partitions, directory, prefix, position_col):
+    """
+    Write the rows of each partition of a dataframe, with their positions in
+    'position_col', to a pickle file. Returns the files' paths.
+
+    """
+    order = np.argsort(partition_codes, kind='mergesort')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(partition_codes, minlength=num_partitions))])
+    paths = list()
+    for partition in range(num_partitions):
+        path = os.path.join(directory, '%s_%d.pkl' % (prefix, partition))
+        positions = order[bounds[partition]:bounds[partition + 1]]
+        partition_df = df.take(positions)
+        partition_df.insert(len(partition_df.columns), position_col, positions, allow_duplicates=True)
+        partition_df.to_pickle(path)
+        paths.append(path)
+    return paths
+
+
+def _pop_positions(joined_df, position_col):
+    """ Remove a position column from a joined partition, returning the positions (-1 for no row). """
+    positions = joined_df.pop(position_col)
+    return positions.fillna(-1).values.astype(np.intp)
+
+
+def _join_partitions(parent_df, child_df, join_context, parent_codes, child_codes, num_partitions, spill_dir):
+    """
+    Hash partition both dataframes on their join key codes into spill files,
+    so that rows with equal keys land in partitions with the same number,
+    then load and join the partition pairs one at a time. Yields the joined
+    rows of each partition and the positions of their parent and child rows
+    (-1 for no row).
+
+    """
+    parent_paths = _spill_partitions(parent_df, parent_codes % num_partitions, num_partitions,
+                                     directory=spill_dir, prefix='parent', position_col=PARENT_POSITION_COL)
+    child_paths = _spill_partitions(child_df, child_codes % num_partitions, num_partitions,
+                                    directory=spill_dir, prefix='child', position_col=CHILD_POSITION_COL)
+    how = join_context.join_type
+    for parent_path, child_path in zip(parent_paths, child_paths):
+        parent_partition = pd.read_pickle(parent_path)
+        child_partition = pd.read_pickle(child_path)
+        # Skip partitions the join type gives no rows for.
+        if ((parent_partition.empty and how in ('inner', 'left')) or
+                (child_partition.empty and how in ('inner', 'right')) or
+                (parent_partition.empty and child_partition.empty)):
+            continue
+        joined_df = parent_partition.merge(child_partition, how=how, left_on=join_context.parent_cols,
+                                           right_on=join_context.child_cols, copy=False)
+        if parent_partition.empty and len(parent_df.index):
+            # Without parent rows, 'merge' keeps the child's same-named key columns instead of the parent's.
+            parent_columns = [(0, i, col) for i, col in enumerate(parent_partition.columns)]
+            joined_df = joined_df[[name for _, _, name in _joined_columns(parent_columns, join_context,
+                                                                           child_partition, frame=1)]]
+        del parent_partition, child_partition
+        parent_positions = _pop_positions(joined_df, PARENT_POSITION_COL)
+        child_positions = _pop_positions(joined_df, CHILD_POSITION_COL)
+        yield joined_df, parent_positions, child_positions
+        del joined_df
+
+
+def _merge_order(how, parent_positions, child_positions, parent_codes, child_codes):
+    """
+    Return the order 'merge' gives the joined rows, given the positions of
+    their parent and child rows (-1 for no row). Left joins keep the order
+    of the parent's rows. Other joins group rows by key, in order of the
+    keys' first appearance in the parent, then in the child; within a key,
+    right joins follow the child's rows, and inner and outer joins the
+    parent's.
+
+    """
+    if how == 'left':
+        return np.lexsort((child_positions, parent_positions))
+    key_ranks = pd.factorize(np.concatenate([parent_codes, child_codes]))[0]
+    has_parent = parent_positions >= 0
+    row_ranks = np.empty(len(parent_positions), dtype=np.intp)
+    row_ranks[has_parent] = key_ranks[parent_positions[has_parent]]
+    row_ranks[~has_parent] = key_ranks[len(parent_codes) + child_positions[~has_parent]]
+    if how == 'right':
+        return np.lexsort((parent_positions, child_positions, row_ranks))
+    return np.lexsort((child_positions, parent_positions, row_ranks))
+
+
+def _assemble(paths, columns_df, targets):
+    """
+    Build a dataframe from spilled dataframes, writing the rows of each into
+    the given target positions - reading one spilled dataframe at a time.
+    'columns_df' is an empty dataframe with the output's columns and dtypes.
+
+    """
+    num_rows = sum(len(target) for target in targets)
+    dtypes = list(columns_df.dtypes)
+    arrays = [np.empty(num_rows, dtype=dtype) if isinstance(dtype, np.dtype) else list() for dtype in dtypes]
+    for path, target in zip(paths, targets):
+        spilled_df = pd.read_pickle(path)
+        for i, dtype in enumerate(dtypes):
+            column = spilled_df.iloc[:, i]
+            if isinstance(arrays[i], list):
+                arrays[i].append(column)
+            else:
+                arrays[i][target] = column.values.astype(dtype, copy=False)
+        del spilled_df
+    all_targets = np.concatenate(targets)
+    joined_df = pd.DataFrame(index=pd.RangeIndex(num_rows))
+    for i, (name, dtype) in enumerate(zip(columns_df.columns, dtypes)):
+        values = arrays[i]
+        if isinstance(values, list):
+            # Columns of pandas dtypes (e.g. categoricals) are concatenated and reordered instead.
+            values = pd.concat(values, ignore_index=True).astype(dtype).take(np.argsort(all_targets))
+            values.index = joined_df.index
+        # Inserted one at a time, so that the filled arrays aren't copied into blocks.
+        joined_df.insert(i, name, values, allow_duplicates=True)
+        arrays[i] = None
+    if not num_rows:
+        # 'merge' gives empty results an empty object index.
+        joined_df.index = pd.Index([])
+    return joined_df
+
+
+def grace_join(parent_df, child_df, join_context, num_partitions=None):
+    """
+    Join two dataframes out of core, with the same result as 'merge' - rows
+    in the same order.
+
+    Both dataframes are hash partitioned on their join keys into spill
+    files, and the partition pairs are loaded and joined one at a time.
+    Each partition's result is spilled as soon as it's joined; the output
+    is then allocated once and filled from the spilled results, read one at
+    a time. So besides the inputs held by the caller, only the output, one
+    partition pair or result, and the positions of the output's rows are in
+    memory at once. Keys match as they do in 'merge' (see
+    '_factorize_keys'). Rows sharing a key are never split, so a key with
+    very many rows makes for a large partition. The spill files are removed
+    once the join is done.
+
+    Parameters
+    ----------
+    parent_df : pd.DataFrame
+        The parent's dataframe.
+    child_df : pd.DataFrame
+        The child's dataframe.
+    join_context : JoinContext
+        The join's columns, type, memory budget and spill directory.
+    num_partitions : int or None
+        Number of partitions. By default, enough for each partition pair to
+        take about a third of the memory budget (at most one per distinct key).
+
+    """
+    parent_codes, child_codes, num_codes = _factorize_keys(parent_df, child_df, join_context)
+    if num_partitions is None:
+        partition_budget = (join_context.memory_budget or 1) * PARTITION_BUDGET_FRACTION
+        num_partitions = int(math.ceil((_memory_usage(parent_df) + _memory_usage(child_df)) / partition_budget))
+        # More partitions than distinct keys would only add empty spill files.
+        num_partitions = max(MIN_PARTITIONS, min(MAX_PARTITIONS, num_codes, num_partitions))
+
+    spill_dir = tempfile.mkdtemp(prefix='querygraph_join_', dir=join_context.spill_dir)
+    try:
+        paths = list()
+        empty_dfs = list()
+        parent_positions = list()
+        child_positions = list()
+        for joined_df, joined_parent_positions, joined_child_positions in _join_partitions(
+                parent_df, child_df, join_context, parent_codes, child_codes, num_partitions, spill_dir):
+            path = os.path.join(spill_dir, 'joined_%d.pkl' % len(paths))
+            joined_df.to_pickle(path)
+            paths.append(path)
+            # A copy, as a slice would keep the result's columns in memory.
+            empty_dfs.append(joined_df.iloc[0:0].copy())
+            parent_positions.append(joined_parent_positions)
+            child_positions.append(joined_child_positions)
+            del joined_df
+        if not paths:
+            # The join gives no rows, which 'merge' finds in memory.
+            return parent_df.merge(child_df, how=join_context.join_type, left_on=join_context.parent_cols,
+                                   right_on=join_context.child_cols, copy=False)
+        # Output positions of the rows of each spilled result.
+        order = _merge_order(join_context.join_type, np.concatenate(parent_positions),
+                             np.concatenate(child_positions), parent_codes, child_codes)
+        output_positions = np.empty(len(order), dtype=np.intp)
+        output_positions[order] = np.arange(len(order))
+        bounds = np.cumsum([0] + [len(positions) for positions in parent_positions])
+        targets = [output_positions[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        # Concatenating the empty results gives the columns' dtypes, as concatenating the results would.
+        return _assemble(paths, pd.concat(empty_dfs, ignore_index=True), targets)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
 # =============================================
 # On Column Class
 # ---------------------------------------------
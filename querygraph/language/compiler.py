@@ -19,6 +19,10 @@ class ConnectBlock(object):
     Data for each connector is stored in the 'connector' dict. Actual
     DbConnector instances are created by the QGLCompiler class.
 
+    Keyword arguments prefixed with 'pool_' configure the connector's
+    connection pool (e.g. pool_min_size='2', see 'ConnectionPool') rather
+    than its connection.
+
     """
 
     def __init__(self):
@@ -176,6 +180,13 @@ class QGLCompiler(object):
                         'ms_sql': interfaces.MsSql,
                         'neo4j': interfaces.Neo4j}
 
+    # Connection pool settings given as connector keyword arguments, and their types.
+    pool_options = {'pool_min_size': int,
+                    'pool_max_size': int,
+                    'pool_max_idle_time': float,
+                    'pool_health_check_interval': float,
+                    'pool_acquire_timeout': float}
+
     def __init__(self, qgl_str, query_graph):
         self.qgl_str = qgl_str
         self.query_graph = query_graph
@@ -214,16 +225,33 @@ class QGLCompiler(object):
             raise QGLSyntaxError("Error: '%s' is not a valid database connector type." % conn_type)
 
     def _create_connectors(self):
+        """ Create the connectors, and open the connections their pools keep open (see 'ConnectionPool.warm_up'). """
         for conn_name, conn_dict in self.connect_block.connectors.items():
             conn_type = conn_dict['conn_type'].lower()
             conn_kwargs = conn_dict['conn_kwargs']
             conn_kwargs['name'] = conn_name
             self._validate_conn_type(conn_type=conn_type)
+            pool_options = self._pop_pool_options(conn_name=conn_name, conn_kwargs=conn_kwargs)
             try:
                 self.connectors[conn_name] = self.db_interface_map[conn_type](**conn_kwargs)
             except TypeError:
                 raise QGLSyntaxError("Missing arguments for connector '%s' for database type '%s'." % (conn_name,
                                                                                                        conn_type))
+            if pool_options:
+                self.connectors[conn_name].configure_pool(**pool_options)
+            self.connectors[conn_name].pool.warm_up()
+
+    def _pop_pool_options(self, conn_name, conn_kwargs):
+        pool_options = dict()
+        for kwarg in [kwarg for kwarg in conn_kwargs if kwarg.startswith('pool_')]:
+            if kwarg not in self.pool_options:
+                raise QGLSyntaxError("Unknown connection pool setting '%s' for connector '%s'." % (kwarg, conn_name))
+            value = conn_kwargs.pop(kwarg)
+            try:
+                pool_options[kwarg[len('pool_'):]] = self.pool_options[kwarg](value)
+            except ValueError:
+                raise QGLSyntaxError("Invalid value '%s' of '%s' for connector '%s'." % (value, kwarg, conn_name))
+        return pool_options
 
     def _create_query_nodes(self):
         for node_name, node_dict in self.retrieve_block.nodes.items():
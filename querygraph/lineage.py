@@ -0,0 +1,133 @@
+import re
+
+from querygraph.predicates import UnsupportedPredicate
+
+
+# =============================================
+# Column Lineage Analysis
+# ---------------------------------------------
+
+# Suffixes pandas gives overlapping column names when joining.
+JOIN_SUFFIX_RE = re.compile(r"^(.+)_[xy]$")
+
+
+def required_output_columns(query_node, required=None):
+    """
+    Return the set of columns a node's dataframe (after its manipulation
+    set) must have - None if all of them may be needed.
+
+    Parameters
+    ----------
+    query_node : QueryNode
+        The node.
+    required : set or None
+        Columns the graph's result must have. None stands for all columns.
+
+    """
+    if required is None:
+        return None
+    required = set(required)
+    # Columns renamed when joined with a dataframe with the same column.
+    required |= {match.group(1) for match in map(JOIN_SUFFIX_RE.match, required) if match is not None}
+    required |= set(query_node.join_context.child_cols)
+    for child in query_node.children:
+        required |= set(child.join_context.parent_cols)
+        required |= child.query_template.dependent_columns()
+    return required
+
+
+def required_query_columns(query_node, required=None):
+    """
+    Return the set of columns a node's query must return - the columns its
+    manipulation set needs to produce 'required_output_columns' - or None
+    if all of them may be needed.
+
+    """
+    return query_node.manipulation_set.required_columns(required_output_columns(query_node, required))
+
+
+def push_down_projections(root_node, required=None):
+    """
+    Set each node's 'projection' to the sorted list of columns its query
+    needs to return, or None if the query can't be narrowed.
+
+    The columns are pushed down as 'fields' into the queries of databases
+    that accept fields (Mongo DB, ElasticSearch), where asking for a column
+    that doesn't exist is harmless. SQL queries are wrapped in a select list
+    only if the node's manipulation set ends up selecting its columns (e.g.
+    'select' or a grouped summary), since only then are the columns known
+    to exist. Either way, the names of the query result's columns must be
+    known (see 'source_columns').
+
+    Parameters
+    ----------
+    root_node : QueryNode
+        Root of the query graph.
+    required : set or None
+        Columns the graph's result must have. None stands for all columns.
+
+    """
+    for query_node in root_node:
+        query_node.projection = None
+        query_columns = required_query_columns(query_node, required)
+        if not query_columns:
+            continue
+        db_interface = query_node.db_interface
+        if db_interface.fields_accepted:
+            if query_node.fields is not None:
+                query_node.projection = [field for field in query_node.fields
+                                         if query_node.clean_col_name(field) in query_columns] or None
+            else:
+                query_node.projection = source_columns(query_node, query_columns)
+        elif db_interface.supports_projection and query_node.manipulation_set.projects:
+            query_node.projection = source_columns(query_node, query_columns)
+
+
+def source_columns(query_node, columns):
+    """
+    Return the sorted names of the columns of a node's query result that
+    hold the given columns of its dataframe, whose names are cleaned (see
+    'QueryNode.clean_col_name') - or None if they aren't all known.
+
+    Cleaning replaces characters with underscores, so a name without any
+    is its own source name. Other names are only taken as source names if
+    they appear in the text of the node's query (e.g. 'SELECT price AS
+    unit_price'), since they may stand for e.g. 'unit price'.
+
+    """
+    query_words = None
+    names = list()
+    for column in columns:
+        if '_' in column:
+            if query_words is None:
+                query_words = query_node.query_template.text_words()
+            if column not in query_words:
+                return None
+        names.append(column)
+    return sorted(names)
+
+
+# =============================================
+# Predicate Pushdown
+# ---------------------------------------------
+
+def push_down_filters(root_node):
+    """
+    Set each node's 'source_conditions' to the list of conditions, in the
+    language of its database, translated from the Filters of its
+    manipulation set that only refer to columns of its query result (see
+    'ManipulationSet.source_filters'). Filters that can't be translated
+    are left out. The filters are still applied to the query result, so
+    conditions only need to hold for every row the filters keep.
+
+    """
+    for query_node in root_node:
+        query_node.source_conditions = list()
+        if not query_node.db_interface.supports_filters:
+            continue
+        for source_filter in query_node.manipulation_set.source_filters():
+            try:
+                condition = query_node.db_interface.predicate(source_filter.compiled_expression)
+            except UnsupportedPredicate:
+                continue
+            query_node.source_conditions.append(condition)
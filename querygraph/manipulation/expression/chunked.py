@@ -0,0 +1,225 @@
+import numbers
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from compiled import Constant, Name, UnaryMinus, BinaryOp, FunctionCall
+
+
+class UnsupportedExpression(Exception):
+    """ Raised when an expression can't be evaluated by the chunked backend. """
+    pass
+
+
+# =============================================
+# Chunked Evaluation Backend Class
+# ---------------------------------------------
+
+class ChunkedBackend(object):
+    """
+    Evaluates compiled arithmetic and comparison expressions over numeric
+    columns in cache-sized chunks of rows, spread across threads. Each chunk
+    is evaluated through the whole expression tree before the next one, so
+    intermediate results are chunk-sized and stay in cache instead of being
+    full-size temporary Series. numpy releases the GIL in its element-wise
+    loops, so the chunks run on all cores.
+
+    If the 'numexpr' package is installed and the expression only uses
+    functions it supports, the expression is handed to numexpr, which fuses
+    the operators into a single pass over the data.
+
+    Expressions over non-numeric columns or using other functions (e.g.
+    'lag' or string functions), and dataframes with fewer than 'min_rows'
+    rows, are evaluated by the regular expression tree.
+
+    Parameters
+    ----------
+    num_threads : int or None
+        Number of threads chunks are evaluated in. Defaults to the number of CPUs.
+    chunk_rows : int
+        Number of rows per chunk.
+    min_rows : int
+        Dataframes with fewer rows are evaluated by the regular expression tree.
+
+    """
+
+    CHUNK_ROWS = 16384
+
+    MIN_ROWS = 100000
+
+    # Functions that are element-wise numpy ufuncs.
+    UFUNCS = {'log': np.log,
+              'log10': np.log10,
+              'floor': np.floor,
+              'ceil': np.ceil,
+              'sin': np.sin,
+              'cos': np.cos,
+              'tan': np.tan,
+              'sqrt': np.sqrt,
+              'square': np.square,
+              'round': np.round_}
+
+    NUMEXPR_FUNCS = ('log', 'log10', 'sin', 'cos', 'tan', 'sqrt')
+
+    NUMEXPR_OPS = {'^': '**'}
+
+    def __init__(self, num_threads=None, chunk_rows=CHUNK_ROWS, min_rows=MIN_ROWS):
+        self.num_threads = num_threads
+        self.chunk_rows = chunk_rows
+        self.min_rows = min_rows
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Thread pools can't be pickled (e.g. when a manipulation set is sent to a worker process).
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pool_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            # A pool inherited through fork has no worker threads in the child process.
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(processes=self.num_threads)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def evaluate(self, compiled_expression, df=None, name_dict=None):
+        """ Evaluate a CompiledExpression, falling back to the expression tree if the backend can't. """
+        if df is None or len(df.index) < self.min_rows:
+            return compiled_expression.evaluate(df=df, name_dict=name_dict)
+        try:
+            values = self._bind(compiled_expression.root, df, name_dict, dict())
+        except UnsupportedExpression:
+            return compiled_expression.evaluate(df=df, name_dict=name_dict)
+        if not any(isinstance(value, np.ndarray) for value in values.values()):
+            return compiled_expression.evaluate(df=df, name_dict=name_dict)
+
+        result = None
+        if numexpr is not None:
+            result = self._evaluate_numexpr(compiled_expression.root, values)
+        if result is None:
+            result = self._evaluate_chunks(compiled_expression.root, values, num_rows=len(df.index))
+        return pd.Series(result, index=df.index)
+
+    def _bind(self, node, df, name_dict, values):
+        """
+        Check that the backend supports an expression tree and return a
+        dictionary mapping the ids of its Name nodes to numpy arrays or numbers.
+
+        """
+        if isinstance(node, Constant):
+            if not self._is_number(node.value):
+                raise UnsupportedExpression
+        elif isinstance(node, Name):
+            value = node.evaluate(df, name_dict)
+            if isinstance(value, pd.Series):
+                if value.dtype.kind not in 'biuf':
+                    raise UnsupportedExpression
+                value = value.values
+            elif not self._is_number(value):
+                raise UnsupportedExpression
+            values[id(node)] = value
+        elif isinstance(node, FunctionCall):
+            if node.func_name not in self.UFUNCS or node.kwargs:
+                raise UnsupportedExpression
+        elif not isinstance(node, (UnaryMinus, BinaryOp)):
+            raise UnsupportedExpression
+        for child in node.children:
+            self._bind(child, df, name_dict, values)
+        return values
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, (numbers.Number, np.number)) and not isinstance(value, complex)
+
+    # =============================================
+    # numpy Chunks
+    # ---------------------------------------------
+
+    def _evaluate_chunks(self, root, values, num_rows):
+        bounds = [(start, min(start + self.chunk_rows, num_rows)) for start in range(0, num_rows, self.chunk_rows)]
+        # Like pandas, don't warn about e.g. division by zero. Error states are per thread.
+        with np.errstate(all='ignore'):
+            # The first chunk determines the result's dtype.
+            first_chunk = np.asarray(self._evaluate_chunk(root, values, bounds[0][0], bounds[0][1], dict()))
+        result = np.empty(num_rows, dtype=first_chunk.dtype)
+        result[bounds[0][0]:bounds[0][1]] = first_chunk
+
+        def evaluate_chunk(chunk_bounds):
+            start, stop = chunk_bounds
+            with np.errstate(all='ignore'):
+                result[start:stop] = self._evaluate_chunk(root, values, start, stop, dict())
+
+        self.pool.map(evaluate_chunk, bounds[1:])
+        return result
+
+    def _evaluate_chunk(self, node, values, start, stop, memo):
+        if node.shared and id(node) in memo:
+            return memo[id(node)]
+        if isinstance(node, Constant):
+            value = node.value
+        elif isinstance(node, Name):
+            value = values[id(node)]
+            if isinstance(value, np.ndarray):
+                value = value[start:stop]
+        elif isinstance(node, UnaryMinus):
+            value = -self._evaluate_chunk(node.operand, values, start, stop, memo)
+        elif isinstance(node, BinaryOp):
+            value = node.opn[node.op](self._evaluate_chunk(node.left, values, start, stop, memo),
+                                      self._evaluate_chunk(node.right, values, start, stop, memo))
+        else:
+            value = self.UFUNCS[node.func_name](self._evaluate_chunk(node.operand, values, start, stop, memo),
+                                                *node.args)
+        if node.shared:
+            memo[id(node)] = value
+        return value
+
+    # =============================================
+    # numexpr
+    # ---------------------------------------------
+
+    def _evaluate_numexpr(self, root, values):
+        """ Evaluate the expression with numexpr. Returns None if numexpr can't. """
+        local_dict = dict()
+        try:
+            source = self._numexpr_source(root, values, local_dict)
+            return numexpr.evaluate(source, local_dict=local_dict, truediv=True)
+        except (UnsupportedExpression, KeyError, NotImplementedError, TypeError, ValueError):
+            return None
+
+    def _numexpr_source(self, node, values, local_dict):
+        if isinstance(node, Constant):
+            return repr(node.value)
+        if isinstance(node, Name):
+            variable = 'v%d' % len(local_dict)
+            local_dict[variable] = values[id(node)]
+            return variable
+        if isinstance(node, UnaryMinus):
+            return "(-%s)" % self._numexpr_source(node.operand, values, local_dict)
+        if isinstance(node, BinaryOp):
+            return "(%s %s %s)" % (self._numexpr_source(node.left, values, local_dict),
+                                   self.NUMEXPR_OPS.get(node.op, node.op),
+                                   self._numexpr_source(node.right, values, local_dict))
+        if node.func_name not in self.NUMEXPR_FUNCS or node.args:
+            raise UnsupportedExpression
+        return "%s(%s)" % (node.func_name, self._numexpr_source(node.operand, values, local_dict))
+
+
+default_backend = ChunkedBackend()
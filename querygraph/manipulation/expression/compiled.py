@@ -0,0 +1,387 @@
+from collections import OrderedDict
+import math
+import operator
+import re
+import threading
+from abc import ABCMeta, abstractmethod, abstractproperty
+
+from pyparsing import (Literal,
+                       Word,
+                       ZeroOrMore,
+                       Forward,
+                       Group,
+                       Regex,
+                       alphas,
+                       alphanums,
+                       quotedString,
+                       Suppress,
+                       FollowedBy)
+
+from functions import all_functions
+
+
+# =============================================
+# Expression Tree Nodes
+# ---------------------------------------------
+
+class UnknownName(Exception):
+    """ Raised when an expression refers to a name that is neither a column nor a named value. """
+    pass
+
+
+class ExpressionNode(object):
+    """
+    Node of a compiled manipulation expression. Nodes hold no data frame,
+    so a compiled expression can be evaluated against any number of data
+    frames - concurrently, if need be.
+
+    A node that occurs several times in an expression (a common
+    subexpression) is 'shared', and evaluated once per evaluation: its
+    value is kept in the 'memo' dictionary passed down the tree.
+
+    """
+
+    __metaclass__ = ABCMeta
+
+    shared = False
+
+    def evaluate(self, df=None, name_dict=None, memo=None):
+        if not self.shared or memo is None:
+            return self._evaluate(df, name_dict, memo)
+        if id(self) not in memo:
+            memo[id(self)] = self._evaluate(df, name_dict, memo)
+        return memo[id(self)]
+
+    @abstractmethod
+    def _evaluate(self, df, name_dict, memo):
+        pass
+
+    @abstractproperty
+    def key(self):
+        """ Hashable structural key - equal for equivalent subtrees. """
+        pass
+
+    @property
+    def children(self):
+        return list()
+
+    def with_children(self, children):
+        """ Return an equivalent node with the given children. """
+        return self
+
+
+class Constant(ExpressionNode):
+
+    def __init__(self, value):
+        self.value = value
+
+    def _evaluate(self, df, name_dict, memo):
+        return self.value
+
+    @property
+    def key(self):
+        return 'const', type(self.value), self.value
+
+
+class Name(ExpressionNode):
+
+    """ A data frame column or a named value. Columns take precedence. """
+
+    constants = {'PI': math.pi, 'E': math.e}
+
+    def __init__(self, name):
+        self.name = name
+
+    def _evaluate(self, df, name_dict, memo):
+        if df is not None:
+            if self.name in df.columns:
+                return df[self.name]
+            # Columns whose names aren't valid Python names are referred to by their cleaned name.
+            for col_name in df.columns:
+                if re.sub('\W|^(?=\d)', '_', col_name) == self.name:
+                    return df[col_name]
+        if self.name in self.constants:
+            return self.constants[self.name]
+        if name_dict is not None and self.name in name_dict:
+            return name_dict[self.name]
+        raise UnknownName("Unknown name '%s' - not a column or a named value." % self.name)
+
+    @property
+    def key(self):
+        return 'name', self.name
+
+
+class UnaryMinus(ExpressionNode):
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def _evaluate(self, df, name_dict, memo):
+        return -self.operand.evaluate(df, name_dict, memo)
+
+    @property
+    def key(self):
+        return 'neg', self.operand.key
+
+    @property
+    def children(self):
+        return [self.operand]
+
+    def with_children(self, children):
+        return UnaryMinus(operand=children[0])
+
+
+class BinaryOp(ExpressionNode):
+
+    opn = {"+": operator.add,
+           "-": operator.sub,
+           "*": operator.mul,
+           "/": operator.truediv,
+           "^": operator.pow,
+           "<": operator.lt,
+           ">": operator.gt,
+           "<=": operator.le,
+           ">=": operator.ge,
+           "==": operator.eq,
+           "!=": operator.ne,
+           "|": operator.or_,
+           "&": operator.and_}
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def _evaluate(self, df, name_dict, memo):
+        return self.opn[self.op](self.left.evaluate(df, name_dict, memo),
+                                 self.right.evaluate(df, name_dict, memo))
+
+    @property
+    def key(self):
+        return 'op', self.op, self.left.key, self.right.key
+
+    @property
+    def children(self):
+        return [self.left, self.right]
+
+    def with_children(self, children):
+        return BinaryOp(op=self.op, left=children[0], right=children[1])
+
+
+class FunctionCall(ExpressionNode):
+
+    funcs = {func.name: func for func in all_functions}
+
+    def __init__(self, func_name, operand, args=None, kwargs=None):
+        self.func_name = func_name
+        self.func = self.funcs[func_name]
+        self.operand = operand
+        self.args = args or list()
+        self.kwargs = kwargs or dict()
+
+    def _evaluate(self, df, name_dict, memo):
+        return self.func(self.operand.evaluate(df, name_dict, memo), *self.args, **self.kwargs)
+
+    @property
+    def key(self):
+        return 'func', self.func_name, self.operand.key, tuple(self.args), tuple(sorted(self.kwargs.items()))
+
+    @property
+    def children(self):
+        return [self.operand]
+
+    def with_children(self, children):
+        return FunctionCall(func_name=self.func_name, operand=children[0], args=self.args, kwargs=self.kwargs)
+
+
+# =============================================
+# Tree Optimization
+# ---------------------------------------------
+
+def fold_constants(node):
+    """
+    Return the tree with every subtree that only depends on constants
+    replaced by its value. Subtrees whose evaluation fails are left as they
+    are, so that the error surfaces at evaluation time.
+
+    """
+    children = node.children
+    if not children:
+        return node
+    node = node.with_children([fold_constants(child) for child in children])
+    if all(isinstance(child, Constant) for child in node.children):
+        try:
+            return Constant(node.evaluate())
+        except Exception:
+            return node
+    return node
+
+
+def eliminate_common_subexpressions(node, interned=None):
+    """
+    Return the tree with structurally equal subtrees replaced by a single
+    node, marked as 'shared' if it occurs more than once.
+
+    """
+    if interned is None:
+        interned = dict()
+    if node.children:
+        node = node.with_children([eliminate_common_subexpressions(child, interned) for child in node.children])
+    key = node.key
+    if key in interned:
+        interned[key].shared = bool(interned[key].children)
+        return interned[key]
+    interned[key] = node
+    return node
+
+
+# =============================================
+# Compiled Expression Class
+# ---------------------------------------------
+
+class CompiledExpression(object):
+    """
+    A manipulation expression parsed once into a tree of ExpressionNodes,
+    with constant subexpressions folded and common subexpressions shared.
+
+    Parameters
+    ----------
+    expr_str : str
+        The expression string.
+    root : ExpressionNode
+        Root of the expression tree.
+
+    """
+
+    def __init__(self, expr_str, root):
+        self.expr_str = expr_str
+        self.root = root
+
+    def evaluate(self, df=None, name_dict=None):
+        return self.root.evaluate(df, name_dict, dict())
+
+    @property
+    def row_local(self):
+        """ Whether each row's value only depends on that row (no 'lag', 'sum'...). """
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, FunctionCall) and not node.func.element_wise:
+                return False
+            nodes.extend(node.children)
+        return True
+
+    @property
+    def names(self):
+        """ Set of the names (columns or named values) the expression refers to. """
+        names = set()
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, Name) and node.name not in Name.constants:
+                names.add(node.name)
+            nodes.extend(node.children)
+        return names
+
+
+# =============================================
+# Expression Grammar
+# ---------------------------------------------
+
+def _fold_left(tokens):
+    """ Turn '[operand, op, operand, op, operand...]' into left-associative BinaryOps. """
+    tokens = tokens[0]
+    node = tokens[0]
+    for i in range(1, len(tokens), 2):
+        node = BinaryOp(op=tokens[i], left=node, right=tokens[i + 1])
+    return node
+
+
+def _fold_right(tokens):
+    """ Turn '[operand, op, operand, op, operand...]' into right-associative BinaryOps. """
+    tokens = tokens[0]
+    node = tokens[-1]
+    for i in range(len(tokens) - 2, 0, -2):
+        node = BinaryOp(op=tokens[i], left=tokens[i - 1], right=node)
+    return node
+
+
+def _function_call(tokens):
+    args = list()
+    kwargs = dict()
+    for func_input in tokens[2:]:
+        if isinstance(func_input, tuple):
+            kwargs[func_input[0]] = func_input[1]
+        else:
+            args.append(func_input)
+    return FunctionCall(func_name=tokens[0], operand=tokens[1], args=args, kwargs=kwargs)
+
+
+def expression_parser():
+    """
+    Return a parser for manipulation expressions whose parse result is the
+    root ExpressionNode of the expression. Operator precedence follows the
+    Evaluator: '^' (right-associative) binds tightest, then '*', '/', '|'
+    and '&', then '+', '-' and the comparisons ('==', '!=', '<', '<=', '>'
+    and '>='). Comparisons combined with '&' or '|' must be parenthesized,
+    e.g. (A > 1) & (B == 'x').
+
+    """
+    fnumber = Regex(r"[+-]?\d+(\.\d*)?([eE][+-]?\d+)?").setParseAction(lambda x: Constant(float(x[0])))
+
+    identifier = Word(alphas + "_", alphanums + "_$")
+
+    lpar = Suppress("(")
+    rpar = Suppress(")")
+    addop = (Literal("+") | Literal("-") | Literal("==") | Literal("!=") |
+             Literal("<=") | Literal("<") | Literal(">=") | Literal(">"))
+    multop = Literal("*") | Literal("/") | Literal("|") | Literal("&")
+    expop = Literal("^")
+
+    # Function arguments following the operand.
+    real = Regex(r"[+-]?\d+\.\d*([eE][+-]?\d+)?").setParseAction(lambda x: float(x[0]))
+    integer = Regex(r"[+-]?\d+").setParseAction(lambda x: int(x[0]))
+    string = quotedString.copy().setParseAction(lambda x: x[0][1:-1])
+    arg = real | integer | string
+    kwarg = (identifier + Suppress("=") + arg).setParseAction(lambda x: (x[0], x[1]))
+    func_input = kwarg | arg
+
+    expr = Forward()
+    func_call = (identifier + lpar + expr + ZeroOrMore(Suppress(",") + func_input) + rpar)
+    func_call.setParseAction(_function_call)
+    name = (identifier + ~FollowedBy("(")).setParseAction(lambda x: Name(name=x[0]))
+    negated = (Suppress("-") + (func_call | name | lpar + expr + rpar)).setParseAction(lambda x: UnaryMinus(x[0]))
+    string_constant = quotedString.copy().setParseAction(lambda x: Constant(x[0][1:-1]))
+    atom = fnumber | string_constant | func_call | name | negated | lpar + expr + rpar
+
+    factor = Forward()
+    factor << Group(atom + ZeroOrMore(expop + factor)).setParseAction(_fold_right)
+    term = Group(factor + ZeroOrMore(multop + factor)).setParseAction(_fold_left)
+    expr << Group(term + ZeroOrMore(addop + term)).setParseAction(_fold_left)
+    return expr
+
+
+# Maximum number of compiled expressions kept - least recently used ones are evicted first.
+MAX_COMPILED_EXPRESSIONS = 4096
+
+_parser = None
+_parser_lock = threading.Lock()
+_compiled_expressions = OrderedDict()
+
+
+def compile_expression(expr_str):
+    """ Compile an expression string into a CompiledExpression - cached by expression string. """
+    global _parser
+    with _parser_lock:
+        compiled_expression = _compiled_expressions.pop(expr_str, None)
+        if compiled_expression is None:
+            if _parser is None:
+                _parser = expression_parser()
+            root = _parser.parseString(expr_str, parseAll=True)[0]
+            root = eliminate_common_subexpressions(fold_constants(root))
+            compiled_expression = CompiledExpression(expr_str=expr_str, root=root)
+            while len(_compiled_expressions) >= MAX_COMPILED_EXPRESSIONS:
+                _compiled_expressions.popitem(last=False)
+        # (Re-)insert to mark the expression as most recently used.
+        _compiled_expressions[expr_str] = compiled_expression
+        return compiled_expression
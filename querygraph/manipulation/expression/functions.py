@@ -14,6 +14,9 @@ from querygraph.utils.multi_method import multimethod
 
 class ExprFunc(object):
 
+    # Whether each row's result only depends on that row's value (not, e.g., on preceding rows).
+    element_wise = True
+
     def __init__(self, name):
         self.name = name
 
@@ -31,6 +34,8 @@ class ExprFunc(object):
 
 class Lag(ExprFunc):
 
+    element_wise = False
+
     def __init__(self):
         ExprFunc.__init__(self, name='lag')
 
@@ -41,6 +46,8 @@ class Lag(ExprFunc):
 
 class Length(ExprFunc):
 
+    element_wise = False
+
     def __init__(self):
         ExprFunc.__init__(self, name='len')
 
@@ -239,6 +246,8 @@ class Round(ExprFunc):
 
 class Sum(ExprFunc):
 
+    element_wise = False
+
     def __init__(self):
         ExprFunc.__init__(self, name='sum')
 
@@ -253,6 +262,8 @@ class Sum(ExprFunc):
 
 class Mean(ExprFunc):
 
+    element_wise = False
+
     def __init__(self):
         ExprFunc.__init__(self, name='sum')
 
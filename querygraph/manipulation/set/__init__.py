@@ -4,4 +4,6 @@ from querygraph.manipulation.set.manipulation_set import (ManipulationSet,
                                                           Select,
                                                           Remove,
                                                           Flatten,
-                                                          Unpack)
+                                                          Unpack,
+                                                          GroupedSummary,
+                                                          Filter)
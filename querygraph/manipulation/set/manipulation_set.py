@@ -1,12 +1,16 @@
+import itertools
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
+import numpy as np
 import pandas as pd
 import pyparsing as pp
 
 from querygraph.exceptions import QueryGraphException
 from querygraph.manipulation.expression.evaluator import Evaluator
+from querygraph.manipulation.expression.compiled import expression_parser
 from querygraph.manipulation import common_parsers
+from querygraph.manipulation.set.summaries import make_summary
 from querygraph.utils.abstract_cls_method import abstractclassmethod
 
 
@@ -31,6 +35,12 @@ class ConfigurationException(ManipulationException):
 # ---------------------------------------------
 
 class Manipulation(object):
+    """
+    A step of a manipulation set. Manipulations don't modify the dataframe
+    they're given - it may be shared, e.g. with the result cache or with
+    query templates - and avoid copying columns they leave as they are.
+
+    """
 
     __metaclass__ = ABCMeta
 
@@ -44,10 +54,61 @@ class Manipulation(object):
     def _execute(self, df, evaluator=None):
         pass
 
+    @staticmethod
+    def _set_column(df, col_name, values):
+        """
+        Add or replace a column of a shallow copy of a dataframe (see
+        'DataFrame.copy(deep=False)') without writing into the memory it
+        shares with the original.
+
+        """
+        if col_name in df.columns:
+            # Replacing a column in place could write into the original's block.
+            loc = df.columns.get_loc(col_name)
+            del df[col_name]
+            df.insert(loc, col_name, values)
+        else:
+            df[col_name] = values
+
     @abstractclassmethod
     def parser(cls):
         pass
 
+    # Whether the manipulation's output columns don't depend on its input's (e.g. 'select').
+    projects = False
+
+    # Whether each output row only depends on one input row, so that the manipulation can be applied to
+    # the batches of a streamed query result one at a time (see 'ManipulationSet.execute_batches').
+    row_local = False
+
+    def key_local(self, key_cols):
+        """
+        Whether each output row only depends on input rows with the same
+        values of the given key columns, so that the manipulation can be
+        applied to any subset of the key values' rows separately (e.g. in
+        streamed executions - see 'QueryGraph.is_streamable').
+
+        """
+        return self.row_local
+
+    def required_columns(self, required):
+        """
+        Return the set of input columns the manipulation needs to produce the
+        given set of output columns. None stands for all columns. Used for
+        projection pushdown - the default assumes every column is needed.
+
+        """
+        return None
+
+    def preserves_columns(self, columns):
+        """
+        Whether the manipulation leaves the given columns' values unchanged
+        (row by row), so that a row filter on them can be applied before it.
+        Used for predicate pushdown - the default assumes it doesn't.
+
+        """
+        return False
+
 
 # =============================================
 # Manipulation Types
@@ -55,33 +116,56 @@ class Manipulation(object):
 
 class Mutate(Manipulation):
 
-    def __init__(self, mutations):
-        self.mutations = mutations
+    """
+    Add or replace columns with the values of manipulation expressions. Each
+    mutation is a dictionary with a 'col_name' and a 'col_expr' (expression
+    string). Expressions are compiled once per process and cached, so a
+    mutation never re-parses its expression or rebuilds a grammar.
+
+    """
+
+    def __init__(self, mutations=None, col_name=None, col_expr=None):
+        self.mutations = list(mutations) if mutations is not None else list()
+        if col_name is not None:
+            self.mutations.append({'col_name': col_name, 'col_expr': col_expr})
 
     def _execute(self, df, evaluator=None):
         if not isinstance(evaluator, Evaluator):
             raise ManipulationException
 
+        df = df.copy(deep=False)
         for mutation in self.mutations:
-            expr_evaluator = Evaluator(df=df)
-            df[mutation['col_name']] = expr_evaluator.eval(expr_str=mutation['col_expr'])
+            self._set_column(df, mutation['col_name'], evaluator.evaluate(Evaluator.compile(mutation['col_expr']),
+                                                                          df=df))
         return df
 
+    @property
+    def row_local(self):
+        return all(Evaluator.compile(mutation['col_expr']).row_local for mutation in self.mutations)
+
+    def required_columns(self, required):
+        if required is None:
+            return None
+        for mutation in reversed(self.mutations):
+            required = (required - {mutation['col_name']}) | Evaluator.compile(mutation['col_expr']).names
+        return required
+
+    def preserves_columns(self, columns):
+        return not any(mutation['col_name'] in columns for mutation in self.mutations)
+
     @classmethod
     def parser(cls):
         lpar = pp.Suppress("(")
         rpar = pp.Suppress(")")
         mutate = pp.Suppress('mutate')
         col_name = pp.Word(pp.alphas, pp.alphanums + "_$")
-
-        expr_evaluator = Evaluator(deferred_eval=True)
-        col_expr = expr_evaluator.parser()
+        col_expr = pp.originalTextFor(expression_parser())
 
         mutation = col_name + pp.Suppress("=") + col_expr
         mutation.setParseAction(lambda x: {'col_name': x[0], 'col_expr': x[1]})
         mutations = pp.Group(pp.delimitedList(mutation))
         parser = mutate + lpar + mutations + rpar
-        parser.setParseAction(lambda x: Mutate(mutations=x))
+        parser.setParseAction(lambda x: Mutate(mutations=x[0]))
         return parser
 
 
@@ -91,9 +175,20 @@ class Rename(Manipulation):
         self.columns = columns
 
     def _execute(self, df, evaluator=None):
-        df = df.rename(columns=self.columns)
+        df = df.rename(columns=self.columns, copy=False)
         return df
 
+    def required_columns(self, required):
+        if required is None:
+            return None
+        old_names = {new_name: old_name for old_name, new_name in self.columns.items()}
+        return {old_names.get(col_name, col_name) for col_name in required}
+
+    row_local = True
+
+    def preserves_columns(self, columns):
+        return not (set(self.columns.keys()) | set(self.columns.values())) & set(columns)
+
     @classmethod
     def parser(cls):
         rename = pp.Suppress("rename")
@@ -116,8 +211,22 @@ class Select(Manipulation):
     def _execute(self, df, evaluator=None):
         existing_columns = list(df.columns.values)
         unneeded_cols = list(set(existing_columns) - set(self.columns))
+        if not unneeded_cols:
+            return df
         return df.drop(unneeded_cols, inplace=False, axis=1)
 
+    projects = True
+
+    def required_columns(self, required):
+        if required is None:
+            return set(self.columns)
+        return set(self.columns) & required
+
+    row_local = True
+
+    def preserves_columns(self, columns):
+        return True
+
     @classmethod
     def parser(cls):
         select = pp.Suppress("select")
@@ -135,6 +244,17 @@ class Remove(Manipulation):
     def _execute(self, df, evaluator=None):
         return df.drop(self.columns, inplace=False, axis=1)
 
+    def required_columns(self, required):
+        if required is None:
+            return None
+        # Removed columns must exist.
+        return required | set(self.columns)
+
+    row_local = True
+
+    def preserves_columns(self, columns):
+        return True
+
     @classmethod
     def parser(cls):
         remove = pp.Suppress("remove")
@@ -146,30 +266,121 @@ class Remove(Manipulation):
 
 class Flatten(Manipulation):
 
-    def __init__(self, column):
-        self.column = column
+    """
+    Flatten list columns: each element of a row's list becomes a row of
+    its own, with the other columns' values repeated. Several columns can be
+    flattened together if their lists are aligned (have the same length in
+    every row).
+
+    The result is built from per-row lengths: the other columns are
+    gathered once with repeated row positions, and the list elements are
+    concatenated into new columns. Flattened columns keep their position,
+    and their dtype is inferred from the elements; the other columns keep
+    their dtypes.
+
+    Empty lists and nulls (None or NaN) hold no elements, so by default
+    their rows are dropped. With 'keep_empty', they are kept as a single
+    row with a null in the flattened columns (integer elements then become
+    floats). Values that aren't lists, tuples or arrays are treated as
+    lists of one element.
+
+    Parameters
+    ----------
+    column : str or None
+        The column to flatten.
+    columns : list or None
+        Aligned columns to flatten together.
+    keep_empty : bool
+        Whether rows with empty or null lists are kept.
+
+    """
+
+    list_types = (list, tuple, np.ndarray)
+
+    def __init__(self, column=None, columns=None, keep_empty=False):
+        self.columns = list(columns) if columns is not None else list()
+        if column is not None:
+            self.columns.insert(0, column)
+        self.keep_empty = keep_empty
+
+    @property
+    def column(self):
+        return self.columns[0]
+
+    @classmethod
+    def _is_null(cls, value):
+        return value is None or (isinstance(value, float) and value != value)
+
+    @classmethod
+    def _length(cls, value):
+        if isinstance(value, cls.list_types):
+            return len(value)
+        return 0 if cls._is_null(value) else 1
+
+    def _elements(self, value):
+        if isinstance(value, self.list_types):
+            if len(value) == 0 and self.keep_empty:
+                return [None]
+            return value
+        if self._is_null(value):
+            return [None] if self.keep_empty else []
+        return [value]
 
     def _execute(self, df, evaluator=None):
-        col_flat = pd.DataFrame([[i, x]
-                                 for i, y in df[self.column].apply(list).iteritems()
-                                 for x in y], columns=['I', self.column])
-        col_flat = col_flat.set_index('I')
-        df = df.drop(self.column, 1)
-        df = df.merge(col_flat, left_index=True, right_index=True)
-        df = df.reset_index(drop=True)
-        return df
+        lengths = None
+        for column in self.columns:
+            column_lengths = np.fromiter((self._length(x) for x in df[column].values), dtype=np.int64, count=len(df))
+            if lengths is not None and not np.array_equal(lengths, column_lengths):
+                raise ManipulationException("Can't flatten columns %s together: their lists aren't aligned."
+                                            % ", ".join(self.columns))
+            lengths = column_lengths
+        if self.keep_empty:
+            lengths = np.maximum(lengths, 1)
+
+        positions = np.repeat(np.arange(len(df)), lengths)
+        # Repeat the rows in a single take, then overwrite the flattened columns in place: the result is a
+        # new dataframe (not a view of 'df'), so this doesn't touch 'df'.
+        flat_df = pd.DataFrame(df.iloc[positions], copy=False)
+        flat_df.index = pd.RangeIndex(len(positions))
+        for column in self.columns:
+            elements = list(itertools.chain.from_iterable(self._elements(x) for x in df[column].values))
+            flat_df[column] = pd.Series(elements, index=flat_df.index, dtype=None if elements else object)
+        return flat_df
+
+    def required_columns(self, required):
+        if required is None:
+            return None
+        return required | set(self.columns)
+
+    row_local = True
+
+    def preserves_columns(self, columns):
+        return not set(self.columns) & set(columns)
 
     @classmethod
     def parser(cls):
         unpack = pp.Suppress("flatten")
         column = common_parsers.column
-        parser = unpack + pp.Suppress("(") + column + pp.Suppress(")")
-        parser.setParseAction(lambda x: Flatten(column=x[0]))
+        parser = unpack + pp.Suppress("(") + pp.Group(pp.delimitedList(column)) + pp.Suppress(")")
+        parser.setParseAction(lambda x: Flatten(columns=x[0]))
         return parser
 
 
 class Unpack(Manipulation):
 
+    """
+    Extract values of nested dictionaries into columns. Each item of
+    'unpack_list' is a dictionary with the 'packed_col' holding the nested
+    dictionaries, the 'key_list' path of the value and the 'new_col_name'.
+
+    All the key paths of a packed column are extracted in a single pass over
+    its values: the paths are merged into a tree of keys, so shared prefixes
+    are looked up once per row. Missing keys, and values that aren't
+    dictionaries, give nulls. The new columns' dtypes are inferred from the
+    extracted values.
+
+    """
+
     def __init__(self, unpack_list):
         self.unpack_list = unpack_list
 
@@ -177,14 +388,64 @@ class Unpack(Manipulation):
     def unpack_dict(row_dict, key_list):
         return reduce(dict.__getitem__, key_list, row_dict)
 
+    @staticmethod
+    def _key_tree(unpack_list):
+        """
+        Merge key paths into a tree. Each tree node is a pair of a dictionary
+        mapping keys to child nodes, and the list of the indices (into
+        'unpack_list') of the paths ending at the node.
+
+        """
+        root = (dict(), list())
+        for i, unpack_dict in enumerate(unpack_list):
+            node = root
+            for key in unpack_dict['key_list']:
+                node = node[0].setdefault(key, (dict(), list()))
+            node[1].append(i)
+        return root
+
+    @classmethod
+    def _extract(cls, value, node, row_values):
+        for i in node[1]:
+            row_values[i] = value
+        if not node[0] or not isinstance(value, dict):
+            return
+        for key, child in node[0].items():
+            if key in value:
+                cls._extract(value[key], child, row_values)
+
     def _execute(self, df, evaluator=None):
+        packed_cols = defaultdict(list)
         for unpack_dict in self.unpack_list:
-            packed_col = unpack_dict['packed_col']
-            key_list = unpack_dict['key_list']
-            new_col_name = unpack_dict['new_col_name']
-            df[new_col_name] = df[packed_col].apply(lambda x: self.unpack_dict(row_dict=x, key_list=key_list))
+            packed_cols[unpack_dict['packed_col']].append(unpack_dict)
+        new_cols = dict()
+        for packed_col, unpack_list in packed_cols.items():
+            key_tree = self._key_tree(unpack_list)
+            col_values = [list() for _ in unpack_list]
+            for value in df[packed_col].values:
+                row_values = [None] * len(unpack_list)
+                self._extract(value, key_tree, row_values)
+                for i, row_value in enumerate(row_values):
+                    col_values[i].append(row_value)
+            for unpack_dict, values in zip(unpack_list, col_values):
+                new_cols[unpack_dict['new_col_name']] = pd.Series(values, index=df.index,
+                                                                  dtype=None if values else object)
+        df = df.copy(deep=False)
+        for unpack_dict in self.unpack_list:
+            self._set_column(df, unpack_dict['new_col_name'], new_cols[unpack_dict['new_col_name']])
         return df
 
+    def required_columns(self, required):
+        if required is None:
+            return None
+        required = required - {unpack_dict['new_col_name'] for unpack_dict in self.unpack_list}
+        return required | {unpack_dict['packed_col'] for unpack_dict in self.unpack_list}
+
+    row_local = True
+
+    def preserves_columns(self, columns):
+        return not {unpack_dict['new_col_name'] for unpack_dict in self.unpack_list} & set(columns)
+
     @classmethod
     def parser(cls):
         unpack = pp.Suppress("unpack")
@@ -204,21 +465,31 @@ class Unpack(Manipulation):
 
 class GroupedSummary(Manipulation):
 
-    lambda_summaries = {'spread': lambda x: max(x) - min(x)}
+    """
+    Summarize columns over the groups of the 'group_by' columns. Each item of
+    'aggregations' is a dictionary with the 'summary_col_name', the
+    'summary_type' (e.g. 'mean', 'spread', 'approx_count_distinct' or
+    'approx_quantile'), the 'target_col' and optionally the summary's 'args'.
+    See 'querygraph.manipulation.set.summaries'.
+
+    Besides summarizing a whole dataframe, the summary can be computed in two
+    phases: 'partial' reduces each chunk or partition of the input to a
+    state, 'merge' combines states, and 'final' turns the combined state into
+    the result - so the full input never needs to be materialized.
+
+    """
+
+    # Number of partial states 'execute_partitioned' accumulates before merging them.
+    MERGE_EVERY = 8
 
     def __init__(self, group_by, aggregations):
-        self.group_by = group_by
+        self.group_by = list(group_by)
         self.aggregations = aggregations
-        self._aggregations = defaultdict(dict)
-        self._merge_aggregations()
-
-    def _merge_aggregations(self):
+        self.summaries = OrderedDict()
         for agg_dict in self.aggregations:
-            summary_type = agg_dict['summary_type']
-            if summary_type in self.lambda_summaries:
-                self._aggregations[agg_dict['target_col']][agg_dict['summary_col_name']] = self.lambda_summaries[summary_type]
-            else:
-                self._aggregations[agg_dict['target_col']][agg_dict['summary_col_name']] = agg_dict['summary_type']
+            self.summaries[agg_dict['summary_col_name']] = make_summary(summary_type=agg_dict['summary_type'],
+                                                                        target_col=agg_dict['target_col'],
+                                                                        args=agg_dict.get('args'))
 
     @classmethod
     def parser(cls):
@@ -230,9 +501,12 @@ class GroupedSummary(Manipulation):
         summary_col_name = common_parsers.column
         summary_type = pp.Word(pp.alphas, pp.alphanums + "_$")
         target_column = common_parsers.column
+        summary_arg = pp.Regex(r"[+-]?\d+(\.\d*)?([eE][+-]?\d+)?").setParseAction(lambda x: float(x[0]))
+        summary_args = pp.Group(pp.ZeroOrMore(pp.Suppress(",") + summary_arg))
         single_summary = summary_col_name + pp.Suppress("=") + summary_type +\
-                         pp.Suppress("(") + target_column + pp.Suppress(")")
-        single_summary.setParseAction(lambda x: {'summary_col_name': x[0], 'summary_type': x[1], 'target_col': x[2]})
+                         pp.Suppress("(") + target_column + summary_args + pp.Suppress(")")
+        single_summary.setParseAction(lambda x: {'summary_col_name': x[0], 'summary_type': x[1], 'target_col': x[2],
+                                                 'args': list(x[3])})
         summarize_block = summarize + pp.Suppress("(") + pp.Group(pp.delimitedList(single_summary)) + pp.Suppress(")")
 
         parser = group_by_block + pp.Suppress(">>") + summarize_block
@@ -240,7 +514,108 @@ class GroupedSummary(Manipulation):
         return parser
 
     def _execute(self, df, evaluator=None):
-        return df.groupby(self.group_by).agg(self._aggregations)
+        grouped = df.groupby(self.group_by)
+        return pd.DataFrame(OrderedDict((summary_col_name, summary.aggregate(grouped))
+                                        for summary_col_name, summary in self.summaries.items()))
+
+    projects = True
+
+    @property
+    def two_phase(self):
+        """ Whether all summaries can be computed in two phases (see 'partial', 'merge' and 'final'). """
+        return all(summary.two_phase for summary in self.summaries.values())
+
+    def key_local(self, key_cols):
+        return set(key_cols) <= set(self.group_by)
+
+    def required_columns(self, required):
+        return set(self.group_by) | {summary.target_col for summary in self.summaries.values()}
+
+    def partial(self, df):
+        """ Reduce a chunk or partition of the input to a partial state. """
+        grouped = df.groupby(self.group_by)
+        return {summary_col_name: summary.partial(grouped) for summary_col_name, summary in self.summaries.items()}
+
+    def merge(self, states):
+        """ Combine a list of partial states into one. """
+        return {summary_col_name: summary.merge([state[summary_col_name] for state in states])
+                for summary_col_name, summary in self.summaries.items()}
+
+    def final(self, state):
+        """ Return the summary dataframe of a (merged) partial state. """
+        return pd.DataFrame(OrderedDict((summary_col_name, summary.final(state[summary_col_name]))
+                                        for summary_col_name, summary in self.summaries.items()))
+
+    def execute_partitioned(self, dfs):
+        """
+        Summarize an iterable of dataframes (e.g. the chunks of a query result)
+        as if they were concatenated, holding at most 'MERGE_EVERY' partial
+        states at a time.
+
+        """
+        states = list()
+        for df in dfs:
+            states.append(self.partial(df))
+            if len(states) >= self.MERGE_EVERY:
+                states = [self.merge(states)]
+        if not states:
+            raise ManipulationException("Can't summarize an empty sequence of dataframes.")
+        return self.final(self.merge(states))
+
+
+class Filter(Manipulation):
+
+    """
+    Keep the rows for which a boolean manipulation expression is true, e.g.
+
+        filter((amount > 100) & (status == 'paid'))
+
+    The expression is evaluated into a boolean mask over the whole
+    dataframe. When the filter only refers to columns of the node's query
+    result, it is also pushed down into the query (see
+    'push_down_filters'), so that fewer rows are fetched.
+
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    @property
+    def compiled_expression(self):
+        return Evaluator.compile(self.expr)
+
+    @property
+    def columns(self):
+        return self.compiled_expression.names
+
+    @property
+    def row_local(self):
+        return self.compiled_expression.row_local
+
+    def _execute(self, df, evaluator=None):
+        if not isinstance(evaluator, Evaluator):
+            raise ManipulationException
+
+        mask = evaluator.evaluate(self.compiled_expression, df=df)
+        if isinstance(mask, pd.Series):
+            return df[mask.fillna(False).astype(bool).values]
+        return df if mask else df.iloc[0:0]
+
+    def required_columns(self, required):
+        if required is None:
+            return None
+        return required | self.columns
+
+    def preserves_columns(self, columns):
+        return True
+
+    @classmethod
+    def parser(cls):
+        _filter = pp.Suppress("filter")
+        expr = pp.originalTextFor(expression_parser())
+        parser = _filter + pp.Suppress("(") + expr + pp.Suppress(")")
+        parser.setParseAction(lambda x: Filter(expr=x[0]))
+        return parser
 
 
 class DropNa(Manipulation):
@@ -248,6 +623,11 @@ class DropNa(Manipulation):
     def _execute(self, df, evaluator=None):
         return df.dropna()
 
+    row_local = True
+
+    def preserves_columns(self, columns):
+        return True
+
     @classmethod
     def parser(cls):
         drop_na = pp.Suppress("group_by")
@@ -295,16 +675,104 @@ class ManipulationSet(object):
         else:
             return False
 
+    @property
+    def projects(self):
+        """ Whether the set's output columns don't depend on its input's. """
+        return any(manipulation.projects for manipulation in self)
+
+    def key_local(self, key_cols):
+        """ Whether every manipulation of the set is key local (see 'Manipulation.key_local'). """
+        return all(manipulation.key_local(key_cols) for manipulation in self)
+
+    def required_columns(self, required=None):
+        """
+        Return the set of input columns needed to produce the given set of
+        output columns (None meaning all columns) - or None if all input
+        columns may be needed.
+
+        """
+        for manipulation in reversed(self.manipulations):
+            required = manipulation.required_columns(required)
+        return required
+
+    def source_filters(self):
+        """
+        Return the set's Filters that could be applied to its input instead:
+        those every preceding manipulation preserves the columns of.
+
+        """
+        source_filters = list()
+        for i, manipulation in enumerate(self.manipulations):
+            if isinstance(manipulation, Filter):
+                columns = manipulation.columns
+                if all(preceding.preserves_columns(columns) for preceding in self.manipulations[:i]):
+                    source_filters.append(manipulation)
+        return source_filters
+
     def execute(self, df):
         evaluator = Evaluator()
         for manipulation in self:
             df = manipulation.execute(df, evaluator)
         return df
 
+    def execute_batches(self, batches):
+        """
+        Execute the manipulation set over an iterable of dataframes - e.g. the
+        record batches of a streamed query result - as if they were
+        concatenated, yielding the result in batches.
+
+        The leading row-local manipulations (see 'Manipulation.row_local')
+        are applied to each batch as it arrives, and the batches are yielded
+        one by one. If a manipulation that needs all rows follows, a single
+        dataframe is yielded at the end: a grouped summary that can be
+        computed in two phases reduces the batches to partial states as
+        they arrive; otherwise the batches are concatenated first.
+
+        """
+        evaluator = Evaluator()
+        num_row_local = 0
+        while num_row_local < len(self.manipulations) and self.manipulations[num_row_local].row_local:
+            num_row_local += 1
+        row_local, remaining = self.manipulations[:num_row_local], self.manipulations[num_row_local:]
+
+        def execute_row_local(df):
+            for manipulation in row_local:
+                df = manipulation.execute(df, evaluator)
+            return df
+
+        manipulated_batches = (execute_row_local(df) for df in batches)
+        if not remaining:
+            for df in manipulated_batches:
+                yield df
+            return
+        try:
+            first_batch = next(manipulated_batches)
+        except StopIteration:
+            return
+        manipulated_batches = itertools.chain([first_batch], manipulated_batches)
+        if isinstance(remaining[0], GroupedSummary) and remaining[0].two_phase:
+            df = remaining[0].execute_partitioned(manipulated_batches)
+            remaining = remaining[1:]
+        else:
+            df = pd.concat(list(manipulated_batches), ignore_index=True)
+        for manipulation in remaining:
+            df = manipulation.execute(df, evaluator)
+        yield df
+
+    def execute_in_pool(self, df, pool):
+        """
+        Execute the manipulation set in a worker process of the given
+        multiprocessing pool. The set and the dataframe are pickled to the
+        worker, which keeps CPU-bound manipulations from holding the calling
+        process's GIL.
+
+        """
+        return pool.apply(_execute_manipulation_set, args=(self, df))
+
     def parser(self):
         manipulation = (Unpack.parser() | Mutate.parser() | Flatten.parser() |
                         Select.parser() | Remove.parser() | GroupedSummary.parser() |
-                        DropNa.parser())
+                        Filter.parser() | DropNa.parser())
         manipulation_set = pp.delimitedList(manipulation, delim='>>')
         return manipulation_set
 
@@ -316,3 +784,6 @@ class ManipulationSet(object):
         return self
 
 
+def _execute_manipulation_set(manipulation_set, df):
+    """ Worker process entry point for 'ManipulationSet.execute_in_pool'. """
+    return manipulation_set.execute(df)
@@ -0,0 +1,372 @@
+import math
+from abc import ABCMeta, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+from querygraph.exceptions import QueryGraphException
+
+
+class SummaryException(QueryGraphException):
+    pass
+
+
+# =============================================
+# Summary Abstract Base Class
+# ---------------------------------------------
+
+class Summary(object):
+    """
+    An aggregation of a column over the groups of a dataframe.
+
+    Summaries whose 'two_phase' is True can be computed in two phases:
+    'partial' reduces a dataframe (e.g. one chunk or partition of the
+    input) to a 'state' dataframe indexed by the group keys, 'merge'
+    combines the states of several dataframes and 'final' turns a state
+    into the summary values. 'aggregate' computes the summary of a whole
+    dataframe directly.
+
+    Parameters
+    ----------
+    target_col : str
+        The summarized column.
+    args : list
+        Extra arguments of the summary, e.g. the quantile of 'approx_quantile'.
+
+    """
+
+    __metaclass__ = ABCMeta
+
+    two_phase = True
+
+    def __init__(self, target_col, args=None):
+        self.target_col = target_col
+        self.args = list(args) if args else list()
+
+    def aggregate(self, grouped):
+        """ Return the summary values of a DataFrameGroupBy, as a Series indexed by the group keys. """
+        return self.final(self.partial(grouped))
+
+    @abstractmethod
+    def partial(self, grouped):
+        pass
+
+    @abstractmethod
+    def merge(self, states):
+        pass
+
+    @abstractmethod
+    def final(self, state):
+        pass
+
+    @staticmethod
+    def _group_levels(state, num_extra_levels=0):
+        return list(range(state.index.nlevels - num_extra_levels))
+
+
+# =============================================
+# Exact Summaries
+# ---------------------------------------------
+
+class NativeSummary(Summary):
+
+    """ Summaries pandas computes natively, whose partial results merge with another native aggregation. """
+
+    merge_funcs = {'sum': 'sum',
+                   'count': 'sum',
+                   'min': 'min',
+                   'max': 'max',
+                   'prod': 'prod',
+                   'first': 'first',
+                   'last': 'last'}
+
+    def __init__(self, target_col, func_name, args=None):
+        Summary.__init__(self, target_col=target_col, args=args)
+        self.func_name = func_name
+
+    def aggregate(self, grouped):
+        return grouped[self.target_col].agg(self.func_name)
+
+    def partial(self, grouped):
+        return grouped[self.target_col].agg(self.func_name).to_frame('value')
+
+    def merge(self, states):
+        states = pd.concat(states)
+        return states.groupby(level=self._group_levels(states)).agg(self.merge_funcs[self.func_name])
+
+    def final(self, state):
+        return state['value']
+
+
+class Mean(Summary):
+
+    def aggregate(self, grouped):
+        return grouped[self.target_col].mean()
+
+    def partial(self, grouped):
+        column = grouped[self.target_col]
+        return pd.DataFrame({'sum': column.sum(), 'count': column.count()})
+
+    def merge(self, states):
+        states = pd.concat(states)
+        return states.groupby(level=self._group_levels(states)).sum()
+
+    def final(self, state):
+        return state['sum'] / state['count'].replace(0, np.nan)
+
+
+class Spread(Summary):
+
+    """ Difference between the maximum and the minimum. """
+
+    def aggregate(self, grouped):
+        column = grouped[self.target_col]
+        return column.max() - column.min()
+
+    def partial(self, grouped):
+        column = grouped[self.target_col]
+        return pd.DataFrame({'min': column.min(), 'max': column.max()})
+
+    def merge(self, states):
+        states = pd.concat(states)
+        return states.groupby(level=self._group_levels(states)).agg({'min': 'min', 'max': 'max'})
+
+    def final(self, state):
+        return state['max'] - state['min']
+
+
+class Variance(Summary):
+
+    """
+    Sample variance, or standard deviation if 'std'. States hold the count,
+    mean and sum of squared deviations, merged with Chan et al.'s pairwise
+    update, which is numerically stable.
+
+    """
+
+    def __init__(self, target_col, args=None, std=False):
+        Summary.__init__(self, target_col=target_col, args=args)
+        self.std = std
+
+    def aggregate(self, grouped):
+        column = grouped[self.target_col]
+        return column.std() if self.std else column.var()
+
+    def partial(self, grouped):
+        column = grouped[self.target_col]
+        count = column.count()
+        return pd.DataFrame({'count': count,
+                             'mean': column.mean(),
+                             'm2': (column.var() * (count - 1)).fillna(0.0)})
+
+    def merge(self, states):
+        states = pd.concat(states)
+        levels = self._group_levels(states)
+        grouped = states.groupby(level=levels)
+        count = grouped['count'].sum()
+        mean = (states['count'] * states['mean']).groupby(level=levels).sum() / count.replace(0, np.nan)
+        deviation = states['mean'] - mean.reindex(states.index)
+        m2 = grouped['m2'].sum() + (states['count'] * deviation ** 2).groupby(level=levels).sum()
+        return pd.DataFrame({'count': count, 'mean': mean, 'm2': m2})
+
+    def final(self, state):
+        variance = state['m2'] / (state['count'] - 1).where(state['count'] > 1)
+        return np.sqrt(variance) if self.std else variance
+
+
+class CountDistinct(Summary):
+
+    """
+    Exact number of distinct values. States are the distinct (group keys,
+    value) pairs, nulls included so that groups holding only nulls count 0.
+
+    """
+
+    def aggregate(self, grouped):
+        return grouped[self.target_col].nunique()
+
+    def partial(self, grouped):
+        pairs = grouped[self.target_col].value_counts(dropna=False).index
+        return pd.DataFrame({'not_null': pairs.get_level_values(-1).notnull()}, index=pairs)
+
+    def merge(self, states):
+        # Not a groupby, which would drop the pairs of null values.
+        states = pd.concat(states)
+        return states[~states.index.duplicated()]
+
+    def final(self, state):
+        grouped = state.groupby(level=self._group_levels(state, num_extra_levels=1))
+        return grouped['not_null'].sum().astype(np.int64)
+
+
+class PandasSummary(Summary):
+
+    """ Any other pandas aggregation (e.g. 'median'). These can't be computed in two phases. """
+
+    two_phase = False
+
+    def __init__(self, target_col, func_name, args=None):
+        Summary.__init__(self, target_col=target_col, args=args)
+        self.func_name = func_name
+
+    def aggregate(self, grouped):
+        return grouped[self.target_col].agg(self.func_name)
+
+    def partial(self, grouped):
+        raise SummaryException("Summary '%s' can't be computed in two phases." % self.func_name)
+
+    def merge(self, states):
+        raise SummaryException("Summary '%s' can't be computed in two phases." % self.func_name)
+
+    def final(self, state):
+        raise SummaryException("Summary '%s' can't be computed in two phases." % self.func_name)
+
+
+# =============================================
+# Sketch Summaries
+# ---------------------------------------------
+
+class ApproxCountDistinct(Summary):
+
+    """
+    Approximate number of distinct values, using a HyperLogLog sketch of
+    2^precision registers per group (standard error about 1.04 / sqrt(2^precision)).
+    States hold the non-zero registers, indexed by group keys and register.
+
+    Arguments: precision (default 12, between 4 and 16).
+
+    """
+
+    DEFAULT_PRECISION = 12
+
+    def __init__(self, target_col, args=None):
+        Summary.__init__(self, target_col=target_col, args=args)
+        self.precision = int(self.args[0]) if self.args else self.DEFAULT_PRECISION
+        if not 4 <= self.precision <= 16:
+            raise SummaryException("approx_count_distinct precision must be between 4 and 16.")
+
+    def partial(self, grouped):
+        values = grouped.obj[self.target_col]
+        not_null = values.notnull().values
+        hashes = pd.util.hash_pandas_object(values[not_null], index=False).values
+        registers = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        # Rank: position of the first 1 bit in the next 32 bits of the hash.
+        bits = ((hashes << np.uint64(self.precision)) >> np.uint64(32)).astype(np.float64)
+        ranks = np.where(bits > 0, 33 - np.frexp(bits)[1], 33)
+
+        codes = grouped.grouper.group_info[0][not_null]
+        valid = codes >= 0
+        state = pd.DataFrame({'group': codes[valid], 'register': registers[valid], 'rank': ranks[valid]})
+        # Groups holding only nulls are kept, with a rank 0 placeholder in register -1.
+        null_groups = np.setdiff1d(np.arange(grouped.ngroups), codes[valid])
+        state = state.append(pd.DataFrame({'group': null_groups, 'register': -1, 'rank': 0}), ignore_index=True)
+        state = state.groupby(['group', 'register'])['rank'].max()
+        group_index = grouped.grouper.result_index
+        keys = group_index.take(state.index.get_level_values('group'))
+        index = pd.MultiIndex.from_arrays([keys.get_level_values(i) for i in range(keys.nlevels)] +
+                                          [state.index.get_level_values('register')],
+                                          names=list(group_index.names) + ['register'])
+        return pd.DataFrame({'rank': state.values}, index=index)
+
+    def merge(self, states):
+        states = pd.concat(states)
+        return states.groupby(level=list(range(states.index.nlevels))).max()
+
+    def final(self, state):
+        group_keys = state.index.droplevel(-1).unique()
+        state = state[state.index.get_level_values(-1) >= 0]
+        num_registers = 2 ** self.precision
+        grouped = (2.0 ** -state['rank']).groupby(level=self._group_levels(state, num_extra_levels=1))
+        zero_registers = num_registers - grouped.size()
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / (grouped.sum() + zero_registers)
+        # Small range correction: linear counting.
+        linear_count = num_registers * np.log(float(num_registers) / zero_registers.replace(0, np.nan))
+        use_linear_count = (estimate <= 2.5 * num_registers) & (zero_registers > 0)
+        estimate = estimate.where(~use_linear_count, linear_count).round()
+        return estimate.reindex(group_keys, fill_value=0).astype(np.int64)
+
+
+class ApproxQuantile(Summary):
+
+    """
+    Approximate quantile, using a DDSketch: values are counted in buckets
+    whose bounds grow geometrically, so the returned value is within the
+    given relative accuracy of the exact value of rank floor(quantile * (n - 1))
+    (values are not interpolated). States hold the non-empty buckets,
+    indexed by group keys, sign and bucket.
+
+    Arguments: quantile (default 0.5), relative accuracy (default 0.01).
+
+    """
+
+    def __init__(self, target_col, args=None):
+        Summary.__init__(self, target_col=target_col, args=args)
+        self.quantile = float(self.args[0]) if self.args else 0.5
+        self.accuracy = float(self.args[1]) if len(self.args) > 1 else 0.01
+        if not 0 <= self.quantile <= 1:
+            raise SummaryException("approx_quantile quantile must be between 0 and 1.")
+        self.gamma = (1 + self.accuracy) / (1 - self.accuracy)
+
+    def partial(self, grouped):
+        values = grouped.obj[self.target_col].values.astype(np.float64)
+        codes = grouped.grouper.group_info[0]
+        valid = (codes >= 0) & ~np.isnan(values)
+        values = values[valid]
+        signs = np.sign(values).astype(np.int64)
+        with np.errstate(divide='ignore'):
+            buckets = np.ceil(np.log(np.abs(values)) / math.log(self.gamma))
+        buckets = np.where(signs == 0, 0, buckets).astype(np.int64)
+        state = pd.DataFrame({'group': codes[valid], 'sign': signs, 'bucket': buckets})
+        state = state.groupby(['group', 'sign', 'bucket']).size()
+        group_index = grouped.grouper.result_index
+        keys = group_index.take(state.index.get_level_values('group'))
+        index = pd.MultiIndex.from_arrays([keys.get_level_values(i) for i in range(keys.nlevels)] +
+                                          [state.index.get_level_values('sign'),
+                                           state.index.get_level_values('bucket')],
+                                          names=list(group_index.names) + ['sign', 'bucket'])
+        return pd.DataFrame({'count': state.values}, index=index)
+
+    def merge(self, states):
+        states = pd.concat(states)
+        return states.groupby(level=list(range(states.index.nlevels))).sum()
+
+    def final(self, state):
+        group_levels = self._group_levels(state, num_extra_levels=2)
+        state = state.reset_index(level=['sign', 'bucket'])
+        state['order'] = state['sign'] * state['bucket']
+        state = state.sort_values(['sign', 'order'], kind='mergesort')
+        state = state.sort_index(level=group_levels, kind='mergesort', sort_remaining=False)
+        grouped = state['count'].groupby(level=group_levels)
+        cumulative_count = grouped.cumsum()
+        rank = self.quantile * (grouped.transform('sum') - 1)
+        selected = state[cumulative_count > rank]
+        selected = selected[~selected.index.duplicated(keep='first')]
+        values = selected['sign'] * 2 * self.gamma ** selected['bucket'].astype(np.float64) / (self.gamma + 1)
+        return values.where(selected['sign'] != 0, 0.0)
+
+
+# =============================================
+# Summary Types
+# ---------------------------------------------
+
+def make_summary(summary_type, target_col, args=None):
+    """ Return the Summary for a summary type name, e.g. 'mean' or 'approx_quantile'. """
+    if summary_type in NativeSummary.merge_funcs:
+        return NativeSummary(target_col=target_col, func_name=summary_type, args=args)
+    elif summary_type == 'mean':
+        return Mean(target_col=target_col, args=args)
+    elif summary_type == 'spread':
+        return Spread(target_col=target_col, args=args)
+    elif summary_type in ('var', 'std'):
+        return Variance(target_col=target_col, args=args, std=summary_type == 'std')
+    elif summary_type == 'nunique':
+        return CountDistinct(target_col=target_col, args=args)
+    elif summary_type == 'approx_count_distinct':
+        return ApproxCountDistinct(target_col=target_col, args=args)
+    elif summary_type == 'approx_quantile':
+        return ApproxQuantile(target_col=target_col, args=args)
+    elif summary_type == 'approx_median':
+        return ApproxQuantile(target_col=target_col, args=[0.5] + list(args or list()))
+    else:
+        return PandasSummary(target_col=target_col, func_name=summary_type, args=args)
@@ -0,0 +1,144 @@
+from querygraph.exceptions import QueryGraphException
+from querygraph.manipulation.expression.compiled import Constant, Name, UnaryMinus, BinaryOp
+
+
+class UnsupportedPredicate(QueryGraphException):
+    """ Raised when a filter expression can't be translated into a database's query language. """
+    pass
+
+
+COMPARISONS = ('==', '!=', '<', '<=', '>', '>=')
+
+LOGICAL_OPS = ('&', '|')
+
+# Comparison with the operands swapped.
+FLIPPED_COMPARISONS = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+# Comparisons of strings that can be pushed down - databases order strings by their collation.
+STRING_COMPARISONS = ('==', '!=')
+
+
+def is_boolean(node):
+    """ Whether an expression node evaluates to booleans. """
+    return isinstance(node, BinaryOp) and (node.op in COMPARISONS or
+                                           (node.op in LOGICAL_OPS and
+                                            is_boolean(node.left) and is_boolean(node.right)))
+
+
+def _check_boolean(node):
+    if not is_boolean(node):
+        raise UnsupportedPredicate("Only comparisons combined with '&' and '|' can be pushed down.")
+
+
+def _check_string_comparison(node):
+    if node.op not in STRING_COMPARISONS and any(isinstance(operand, Constant) and
+                                                 isinstance(operand.value, basestring)
+                                                 for operand in (node.left, node.right)):
+        raise UnsupportedPredicate("Only equality comparisons of strings can be pushed down.")
+
+
+def _comparison(node):
+    """ Return the (column name, operator, value) of a comparison between a column and a constant. """
+    _check_string_comparison(node)
+    if isinstance(node.left, Name) and isinstance(node.right, Constant):
+        return node.left.name, node.op, node.right.value
+    if isinstance(node.left, Constant) and isinstance(node.right, Name):
+        return node.right.name, FLIPPED_COMPARISONS[node.op], node.left.value
+    raise UnsupportedPredicate("Only comparisons between a column and a constant can be pushed down.")
+
+
+# =============================================
+# SQL
+# ---------------------------------------------
+
+SQL_OPS = {'+': '+', '-': '-', '*': '*', '<': '<', '<=': '<=', '>': '>', '>=': '>=', '==': '=',
+           '&': 'AND', '|': 'OR'}
+
+
+def sql_predicate(root, quote_identifier):
+    """
+    Translate a boolean expression tree into an SQL condition.
+
+    Comparisons with nulls are false in pandas, as in SQL - except for '!=',
+    which is true in pandas and is translated accordingly.
+
+    """
+    _check_boolean(root)
+    return _sql(root, quote_identifier)
+
+
+def _sql(node, quote_identifier):
+    if isinstance(node, Name):
+        return quote_identifier(node.name)
+    if isinstance(node, Constant):
+        if isinstance(node.value, basestring):
+            return "'%s'" % node.value.replace("'", "''")
+        return repr(node.value)
+    if isinstance(node, UnaryMinus):
+        return "(-%s)" % _sql(node.operand, quote_identifier)
+    if isinstance(node, BinaryOp):
+        if node.op in LOGICAL_OPS and not (is_boolean(node.left) and is_boolean(node.right)):
+            raise UnsupportedPredicate("Bitwise '%s' can't be pushed down." % node.op)
+        if node.op in COMPARISONS:
+            _check_string_comparison(node)
+        left = _sql(node.left, quote_identifier)
+        right = _sql(node.right, quote_identifier)
+        if node.op == '!=':
+            not_null = ["%s IS NOT NULL" % sql for operand, sql in ((node.left, left), (node.right, right))
+                        if not isinstance(operand, Constant)]
+            return "(NOT (%s))" % " AND ".join(not_null + ["%s = %s" % (left, right)])
+        if node.op == '/':
+            # Manipulation expressions use true division.
+            return "(%s * 1.0 / %s)" % (left, right)
+        if node.op not in SQL_OPS:
+            raise UnsupportedPredicate("Operator '%s' can't be pushed down." % node.op)
+        return "(%s %s %s)" % (left, SQL_OPS[node.op], right)
+    raise UnsupportedPredicate("Function calls can't be pushed down.")
+
+
+# =============================================
+# Mongo DB
+# ---------------------------------------------
+
+MONGO_OPS = {'==': '$eq', '!=': '$ne', '<': '$lt', '<=': '$lte', '>': '$gt', '>=': '$gte'}
+
+
+def mongo_predicate(root):
+    """ Translate a boolean expression tree into a Mongo DB query filter. """
+    _check_boolean(root)
+    if root.op in LOGICAL_OPS:
+        return {'$and' if root.op == '&' else '$or': [mongo_predicate(root.left), mongo_predicate(root.right)]}
+    column, op, value = _comparison(root)
+    return {column: {MONGO_OPS[op]: value}}
+
+
+# =============================================
+# ElasticSearch
+# ---------------------------------------------
+
+ELASTIC_SEARCH_RANGE_OPS = {'<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+
+
+def elastic_search_predicate(root):
+    """
+    Translate a boolean expression tree into an ElasticSearch filter clause.
+
+    Comparisons with strings aren't translated: 'term' queries don't match
+    the values of analyzed text fields, and the index's mappings aren't
+    known.
+
+    """
+    _check_boolean(root)
+    if root.op == '&':
+        return {'bool': {'filter': [elastic_search_predicate(root.left), elastic_search_predicate(root.right)]}}
+    if root.op == '|':
+        return {'bool': {'should': [elastic_search_predicate(root.left), elastic_search_predicate(root.right)],
+                         'minimum_should_match': 1}}
+    column, op, value = _comparison(root)
+    if isinstance(value, basestring):
+        raise UnsupportedPredicate("Comparisons with strings can't be pushed down into ElasticSearch queries.")
+    if op == '==':
+        return {'term': {column: value}}
+    if op == '!=':
+        return {'bool': {'must_not': [{'term': {column: value}}]}}
+    return {'range': {column: {ELASTIC_SEARCH_RANGE_OPS[op]: value}}}
@@ -1,20 +1,28 @@
 from collections import OrderedDict
+import copy
+from multiprocessing.pool import ThreadPool
 import re
+import sys
+import threading
+import time
 
 import pandas as pd
 
 
 from querygraph.query_template import QueryTemplate
+from querygraph.semi_join import SemiJoinPlanner
 from querygraph.exceptions import (QueryGraphException,
                                    ConnectionError,
                                    ExecutionError,
                                    JoinContextException,
                                    ParameterError)
-from querygraph.join_context import JoinContext, OnColumn
-from querygraph import thread_tree
+from querygraph.join_context import JoinContext, OnColumn, multi_join
+from querygraph.stats import copied_bytes
+from querygraph import columnar
 from querygraph.db.interface import DatabaseInterface
 from querygraph.manipulation.set import ManipulationSet
 from querygraph.execution_log import ExecutionLog
+from querygraph.scheduler import shared_pool
 
 
 # =============================================
@@ -39,8 +47,33 @@ class QueryNode(object):
         A list of fields to return - only used for NoSql databases
         that do not return relational data.
 
+    Set 'adaptive_chunk_size' to an AdaptiveChunkSize instance to split
+    large dependent parameter containers into concurrently executed chunk
+    queries. The way each container is shipped to the database is chosen
+    by the node's 'semi_join_planner'.
+
+    Timings and sizes observed during the node's latest execution are kept
+    in 'execution_stats' (see ExecutionStatsStore).
+
+    'projection' is the list of columns the node's query needs to return,
+    as found by the graph's lineage analysis (see 'push_down_projections'),
+    or None if the query isn't narrowed. Likewise, 'source_conditions' are
+    row filter conditions pushed down into the node's query (see
+    'push_down_filters').
+
+    If 'result_cache' is set to a ResultCache, query results are served
+    from and added to it; they stay valid for 'cache_ttl' seconds (None
+    defers to the cache's default TTL).
+
     """
 
+    # Minimum number of rows for the manipulation set to be offloaded to
+    # the process pool - below this, pickling costs more than it saves.
+    PROCESS_OFFLOAD_MIN_ROWS = 10000
+
+    # Maximum number of chunk queries executed concurrently by a node.
+    MAX_CHUNK_WORKERS = 4
+
     def __init__(self, name, query, db_interface, log, fields=None):
         self.name = name
         self.query = query
@@ -50,6 +83,8 @@ class QueryNode(object):
         assert isinstance(db_interface, DatabaseInterface)
         self.db_interface = db_interface
         self.fields = fields
+        self.projection = None
+        self.source_conditions = list()
         self.children = list()
         self.parent = None
         self.join_context = JoinContext(child_node_name=self.name)
@@ -57,6 +92,13 @@ class QueryNode(object):
         self.already_executed = False
         self._new_columns = OrderedDict()
         self.manipulation_set = ManipulationSet()
+        self.process_pool = None
+        self.adaptive_chunk_size = None
+        self.semi_join_planner = SemiJoinPlanner(db_interface=db_interface)
+        self.execution_stats = dict()
+        self.result_cache = None
+        self.cache_ttl = None
+        self._query_template = None
 
     def __getitem__(self, item):
         return OnColumn(query_node=self, col_name=item)
@@ -82,16 +124,29 @@ class QueryNode(object):
     @df.setter
     def df(self, value):
         assert isinstance(value, pd.DataFrame)
-        cleaned_df = self.clean_df_col_names(df=value)
-        self._df = cleaned_df
+        self._df = value
 
     @staticmethod
     def clean_col_name(col_name):
         return re.sub('\W|^(?=\d)', '_', col_name)
 
     def clean_df_col_names(self, df):
+        """
+        Return the dataframe with column names made valid Python names. The
+        columns aren't copied; 'df' itself is left as is, as it may be shared
+        (e.g. with the result cache).
+
+        """
         rename_dict = {col_name: self.clean_col_name(col_name) for col_name in df.columns.values.tolist()}
-        return df.rename(columns=rename_dict)
+        rename_dict = {col_name: clean_name for col_name, clean_name in rename_dict.items() if clean_name != col_name}
+        if not rename_dict:
+            return df
+        return df.rename(columns=rename_dict, copy=False)
+
+    def _count_copied_bytes(self, source_dfs, df):
+        """ Add the bytes copied to make 'df' from 'source_dfs' to the node's execution statistics. """
+        self.execution_stats['bytes_copied'] = (self.execution_stats.get('bytes_copied', 0) +
+                                                copied_bytes(source_dfs, df))
 
     def is_independent(self):
         # Todo: this.
@@ -123,7 +178,15 @@ class QueryNode(object):
         return self in child_node
 
     def execute_manipulation_set(self):
-        self.df = self.manipulation_set.execute(self.df)
+        df = self.df
+        if self.process_pool is not None and len(df.index) >= self.PROCESS_OFFLOAD_MIN_ROWS:
+            self.log.node_info(source_node=self.name, msg="Executing manipulation set in process pool.")
+            manipulated_df = self.manipulation_set.execute_in_pool(df, pool=self.process_pool)
+        else:
+            manipulated_df = self.manipulation_set.execute(df)
+        # Manipulations (e.g. 'rename') may introduce column names that need cleaning.
+        self.df = self.clean_df_col_names(manipulated_df)
+        self._count_copied_bytes([df], self.df)
 
     def join_with_parent(self):
         """
@@ -136,6 +199,7 @@ class QueryNode(object):
         try:
             joined_df = self.join_context.apply_join(parent_df=self.parent.df, child_df=self.df)
             self.parent.df = joined_df
+            self.execution_stats['join_rows'] = len(joined_df.index)
             self.log.node_info(source_node=self.name, msg="Joined with parent node '%s' dataframe." % self.parent.name)
         except JoinContextException, e:
             self.log.node_error(source_node=self.name,
@@ -149,22 +213,74 @@ class QueryNode(object):
         should only be called by the root QueryNode.
 
         """
-        reverse_topological_ordering = list()
-        for child in self:
-            if child is not self:
-                reverse_topological_ordering.insert(0, child)
-        for query_node in reverse_topological_ordering:
-            query_node.join_with_parent()
+        for query_node in reversed(list(self)):
+            if query_node.children:
+                query_node.join_children()
+
+    def join_children(self):
+        """
+        Join this QueryNode's direct children with it, in the same order as
+        'fold_children' would, in a single multi-way join (see 'multi_join').
+        Each child must already have joined its own children.
+
+        """
+        if not self.children:
+            return
+        children = list(reversed(self.children))
+        for child in children:
+            self.log.node_info(source_node=child.name, msg="Attempting to join with parent node '%s'." % self.name)
+            if child.df is None:
+                raise QueryGraphException
+        try:
+            joined_df, row_counts = multi_join(parent_df=self.df,
+                                               joins=[(child.join_context, child.df) for child in children])
+        except JoinContextException, e:
+            self.log.node_error(source_node=self.name,
+                                msg="Couldn't join the dataframes of children %s with parent node '%s''s dataframe."
+                                    % (", ".join("'%s'" % child.name for child in children), self.name))
+            raise
+        self._count_copied_bytes([self.df] + [child.df for child in children], joined_df)
+        self.df = joined_df
+        for child, row_count in zip(children, row_counts):
+            child.execution_stats['join_rows'] = row_count
+            self.log.node_info(source_node=child.name, msg="Joined with parent node '%s' dataframe." % self.name)
 
     @property
     def query_template(self):
-        # return self._make_query_template()
-        return QueryTemplate(template_str=self.query,
-                             type_converter=self.db_interface.type_converter)
+        if self._query_template is None or self._query_template.template_str != self.query:
+            self._query_template = QueryTemplate(template_str=self.query,
+                                                 type_converter=self.db_interface.type_converter)
+        return self._query_template
+
+    def copy_tree(self, log):
+        """
+        Return a copy of the subtree rooted at this QueryNode, for an
+        independent execution. The copies share the nodes' configuration -
+        database interfaces, query templates, join contexts, manipulation
+        sets, chunk sizes and caches - but not their execution state.
+
+        Parameters
+        ----------
+        log : ExecutionLog
+            Log of the QueryGraph the copies belong to.
+
+        """
+        node_copy = copy.copy(self)
+        node_copy.log = log
+        node_copy.parent = None
+        node_copy._df = None
+        node_copy.execution_stats = dict()
+        node_copy.children = list()
+        for child in self.children:
+            child_copy = child.copy_tree(log=log)
+            child_copy.parent = node_copy
+            node_copy.children.append(child_copy)
+        return node_copy
 
     def retrieve_dataframe(self, independent_param_vals):
         self.log.node_info(source_node=self.name,
                            msg="Attempting to execute query using connector '%s'." % self.db_interface.name)
+        self.execution_stats = dict()
         try:
             self._execute_query(independent_param_vals=independent_param_vals)
         except ConnectionError, e:
@@ -175,29 +291,321 @@ class QueryNode(object):
             self.log.node_error(source_node=self.name, msg="Problem executing query on database using "
                                                            "connector '%s': \n %s" % (self.db_interface.name, e))
             raise
+
+    def retrieve_batches(self, independent_param_vals, batch_size):
+        """
+        Streaming counterpart of 'retrieve_dataframe': a generator yielding
+        the node's query result in record batches of at most 'batch_size'
+        rows (see 'DatabaseInterface.execute_query_batches'), passed through
+        the node's manipulation set as they arrive (see
+        'ManipulationSet.execute_batches'). The node's dataframe isn't set.
+        Streamed results bypass the result cache.
+
+        """
+        self.log.node_info(source_node=self.name,
+                           msg="Attempting to stream query results using connector '%s'." % self.db_interface.name)
+        self.execution_stats = {'rows': 0, 'bytes': 0}
+        rendered_queries, semi_joins = self._rendered_queries(independent_param_vals=independent_param_vals,
+                                                              chunk_size=None)
+        temp_tables = self._temp_tables(semi_joins)
+
+        def query_batches():
+            for rendered_query in rendered_queries:
+                for df in self.db_interface.execute_query_batches(rendered_query, batch_size,
+                                                                  **self._query_kwargs(temp_tables)):
+                    self.execution_stats['rows'] += len(df.index)
+                    self.execution_stats['bytes'] += int(df.memory_usage(index=True).sum())
+                    yield self.clean_df_col_names(self._post_filter(df, semi_joins))
+
+        try:
+            for df in self.manipulation_set.execute_batches(query_batches()):
+                yield self.clean_df_col_names(df)
+        except ConnectionError, e:
+            self.log.node_error(source_node=self.name, msg="Could not connect to database using connector '%s': \n %s"
+                                                           % (self.db_interface.name, e))
+            raise
+        except ExecutionError, e:
+            self.log.node_error(source_node=self.name, msg="Problem executing query on database using "
+                                                           "connector '%s': \n %s" % (self.db_interface.name, e))
+            raise
+
+    def retrieve_table(self, independent_param_vals):
+        """
+        Arrow counterpart of 'retrieve_dataframe' for a node without a parent:
+        return the node's query result as a pyarrow Table (see
+        'DatabaseInterface.execute_query_arrow'), with column names cleaned
+        as in 'receive_dataframe'. The node's manipulation set isn't applied
+        and its dataframe isn't set. Arrow results bypass the result cache.
+
+        """
+        self.log.node_info(source_node=self.name,
+                           msg="Attempting to retrieve Arrow table using connector '%s'." % self.db_interface.name)
+        self.execution_stats = dict()
+        rendered_queries, semi_joins = self._rendered_queries(independent_param_vals=independent_param_vals,
+                                                              chunk_size=None)
+        query_kwargs = self._query_kwargs(self._temp_tables(semi_joins))
+        query_start_time = time.time()
+        try:
+            tables = [self.db_interface.execute_query_arrow(rendered_query, **query_kwargs)
+                      for rendered_query in rendered_queries]
+        except ConnectionError, e:
+            self.log.node_error(source_node=self.name, msg="Could not connect to database using connector '%s': \n %s"
+                                                           % (self.db_interface.name, e))
+            raise
+        except ExecutionError, e:
+            self.log.node_error(source_node=self.name, msg="Problem executing query on database using "
+                                                           "connector '%s': \n %s" % (self.db_interface.name, e))
+            raise
+        table = columnar.concat_tables(tables)
+        clean_names = [self.clean_col_name(col_name) for col_name in table.column_names]
+        if clean_names != table.column_names:
+            table = columnar.rename_columns(table, clean_names)
+        self.execution_stats['query_latency'] = time.time() - query_start_time
+        self.execution_stats['rows'] = table.num_rows
+        self.execution_stats['bytes'] = table.nbytes
+        return table
+
+    def retrieve_dataframe_async(self, independent_param_vals, callback, errback):
+        """
+        Non-blocking counterpart of 'retrieve_dataframe'. The query is rendered
+        on the calling thread and handed to the connector's asynchronous hook.
+        The raw query result is passed to 'callback', which is responsible for
+        passing it on to 'receive_dataframe'; failures are passed to 'errback'
+        as an exception info tuple. Either may be called from a thread owned
+        by the database driver. Chunk queries of connectors without a native
+        asynchronous driver (see 'DatabaseInterface.supports_async') are run
+        concurrently by at most 'MAX_CHUNK_WORKERS' tasks of the shared pool.
+
+        """
+        self.log.node_info(source_node=self.name,
+                           msg="Attempting to execute async query using connector '%s'." % self.db_interface.name)
+        self.execution_stats = dict()
+        chunk_size = self._current_chunk_size()
+        rendered_queries, semi_joins = self._rendered_queries(independent_param_vals=independent_param_vals,
+                                                              chunk_size=chunk_size)
+        temp_tables = self._temp_tables(semi_joins)
+        query_start_time = time.time()
+
+        def result_callback(df):
+            self.execution_stats['query_latency'] = time.time() - query_start_time
+            callback(self._post_filter(df, semi_joins))
+
+        if len(rendered_queries) == 1:
+            self._query_database_async(rendered_queries[0], result_callback, errback, temp_tables=temp_tables)
+            return
+
+        chunk_dfs = [None] * len(rendered_queries)
+        lock = threading.Lock()
+        state = {'remaining': len(rendered_queries), 'failed': False}
+
+        def chunk_callback(i, start_time):
+            def _callback(df):
+                self.adaptive_chunk_size.observe(num_values=chunk_size, latency=time.time() - start_time)
+                with lock:
+                    chunk_dfs[i] = df
+                    state['remaining'] -= 1
+                    done = state['remaining'] == 0 and not state['failed']
+                if done:
+                    result_callback(pd.concat(chunk_dfs, ignore_index=True))
+            return _callback
+
+        def chunk_errback(exc_info):
+            with lock:
+                first_failure = not state['failed']
+                state['failed'] = True
+            if first_failure:
+                errback(exc_info)
+
+        def query_chunk(i, rendered_query):
+            try:
+                self._query_database_async(rendered_query, chunk_callback(i, time.time()), chunk_errback,
+                                           temp_tables=temp_tables)
+            except Exception:
+                chunk_errback(sys.exc_info())
+
+        if self.db_interface.supports_async:
+            for i, rendered_query in enumerate(rendered_queries):
+                query_chunk(i, rendered_query)
+            return
+        # The connector's asynchronous hook runs queries on the calling thread: chunks are dispatched on the
+        # shared pool, to at most 'MAX_CHUNK_WORKERS' tasks that each run chunks until none are left.
+        pending_chunks = iter(enumerate(rendered_queries))
+
+        def run_chunks():
+            while True:
+                with lock:
+                    chunk = next(pending_chunks, None)
+                    if chunk is None or state['failed']:
+                        return
+                query_chunk(*chunk)
+
+        pool = shared_pool()
+        for _ in range(min(len(rendered_queries), self.MAX_CHUNK_WORKERS)):
+            pool.apply_async(run_chunks)
+
+    def _query_database_async(self, rendered_query, callback, errback, temp_tables=None):
+        cache_key = self._cache_key(rendered_query, temp_tables)
+        if cache_key is not None:
+            df = self.result_cache.get(cache_key)
+            if df is not None:
+                self.log.node_info(source_node=self.name, msg="Query result served from cache.")
+                callback(df)
+                return
+
+            def cache_callback(df):
+                self.result_cache.put(cache_key, df, ttl=self.cache_ttl)
+                callback(df)
+
+            self.db_interface.execute_query_async(rendered_query, cache_callback, errback,
+                                                  **self._query_kwargs(temp_tables))
+        else:
+            self.db_interface.execute_query_async(rendered_query, callback, errback,
+                                                  **self._query_kwargs(temp_tables))
+
+    def receive_dataframe(self, df):
+        """
+        Set the node's dataframe from a query result and apply its manipulation
+        set. Column names are cleaned here, once; from then on dataframes are
+        passed along the node's data path without copying, and are shared
+        read-only with its children's query templates.
+
+        """
+        self.execution_stats['rows'] = len(df.index)
+        self.execution_stats['bytes'] = int(df.memory_usage(index=True).sum())
+        self.execution_stats['bytes_copied'] = 0
+        self.df = self.clean_df_col_names(df)
         if self.manipulation_set and not self.result_set_empty:
             self.execute_manipulation_set()
         self.log.node_dataframe_header(source_node=self.name, df=self.df)
 
-    def _rendered_query(self, independent_param_vals):
+    def _rendered_queries(self, independent_param_vals, chunk_size):
+        """
+        Render the node's query, shipping dependent parameter containers as
+        planned by the node's 'semi_join_planner' - split into several
+        queries if 'chunk_size' is not None and a container shipped as a
+        literal list holds more values. Queries of database interfaces that
+        take structured queries are rendered into structures when the
+        template allows it.
+
+        Returns
+        -------
+        tuple
+            The list of rendered queries, and the list of SemiJoins used.
+
+        """
+        start_time = time.time()
+        parent_df = self.parent.df if self.parent is not None else None
+        result_columns = self.projection if self.db_interface.supports_projection else None
         try:
-            query_template = self.query_template
-            if self.parent is not None:
-                rendered_query = query_template.render(df=self.parent.df, independent_param_vals=independent_param_vals)
-            else:
-                rendered_query = query_template.render(independent_param_vals=independent_param_vals)
-            return rendered_query
+            rendered = None
+            if self.db_interface.deserialize_query:
+                rendered = self.query_template.render_structures(deserialize=self.db_interface.deserialize,
+                                                                 df=parent_df,
+                                                                 independent_param_vals=independent_param_vals,
+                                                                 chunk_size=chunk_size)
+            if rendered is None:
+                rendered = self.query_template.render_queries(df=parent_df,
+                                                              independent_param_vals=independent_param_vals,
+                                                              chunk_size=chunk_size,
+                                                              semi_join_planner=self.semi_join_planner,
+                                                              result_columns=result_columns)
+            rendered_queries, semi_joins = rendered
         except ParameterError, e:
             self.log.node_error(source_node=self.name, msg="Couldn't render query template due to error(s): \n %s" % e)
             raise
+        if self.source_conditions:
+            rendered_queries = [self.db_interface.filter(rendered_query, self.source_conditions)
+                                for rendered_query in rendered_queries]
+        if self.projection is not None and self.db_interface.supports_projection:
+            rendered_queries = [self.db_interface.project(rendered_query, self.projection)
+                                for rendered_query in rendered_queries]
+        self.execution_stats['render_time'] = time.time() - start_time
+        for semi_join in semi_joins:
+            if semi_join.rewrites_predicate:
+                self.log.node_info(source_node=self.name,
+                                   msg="Shipping %s distinct values of '%s' using the '%s' semi-join strategy."
+                                       % (len(semi_join.keys), semi_join.column, semi_join.strategy))
+        if len(rendered_queries) > 1:
+            self.log.node_info(source_node=self.name,
+                               msg="Split dependent parameter values into %s chunk queries of up to %s values."
+                                   % (len(rendered_queries), chunk_size))
+        return rendered_queries, semi_joins
 
-    def _execute_query(self, independent_param_vals):
-        rendered_query = self._rendered_query(independent_param_vals=independent_param_vals)
+    @staticmethod
+    def _temp_tables(semi_joins):
+        return [temp_table for semi_join in semi_joins for temp_table in semi_join.temp_tables]
+
+    @staticmethod
+    def _post_filter(df, semi_joins):
+        """ Drop rows fetched by a semi-join's over-approximating predicate. """
+        for semi_join in semi_joins:
+            df = semi_join.post_filter(df)
+        return df
+
+    @property
+    def query_fields(self):
+        """ Fields the node's query returns, for databases that accept fields. """
+        return self.projection if self.projection is not None else self.fields
+
+    def _query_kwargs(self, temp_tables):
+        kwargs = dict()
         if self.db_interface.fields_accepted:
-            df = self.db_interface.execute_query(query=rendered_query, fields=self.fields)
+            kwargs['fields'] = self.query_fields
+        if temp_tables:
+            kwargs['temp_tables'] = temp_tables
+        return kwargs
+
+    def _cache_key(self, rendered_query, temp_tables):
+        """ Key of the query's result in the node's result cache - None if the result can't be cached. """
+        if self.result_cache is None or temp_tables:
+            return None
+        return self.result_cache.key(self.db_interface, rendered_query, fields=self.query_fields)
+
+    def _query_database(self, rendered_query, temp_tables=None):
+        cache_key = self._cache_key(rendered_query, temp_tables)
+        if cache_key is not None:
+            df = self.result_cache.get(cache_key)
+            if df is not None:
+                self.log.node_info(source_node=self.name, msg="Query result served from cache.")
+                return df
+        df = self.db_interface.execute_query(query=rendered_query, **self._query_kwargs(temp_tables))
+        if cache_key is not None:
+            self.result_cache.put(cache_key, df, ttl=self.cache_ttl)
+        return df
+
+    def _query_database_chunk(self, rendered_query, chunk_size, temp_tables=None):
+        start_time = time.time()
+        df = self._query_database(rendered_query, temp_tables=temp_tables)
+        self.adaptive_chunk_size.observe(num_values=chunk_size, latency=time.time() - start_time)
+        return df
+
+    def _query_database_chunks(self, rendered_queries, chunk_size, temp_tables=None):
+        """ Execute chunk queries concurrently and concatenate their results. """
+        pool = ThreadPool(processes=min(len(rendered_queries), self.MAX_CHUNK_WORKERS))
+        try:
+            chunk_dfs = pool.map(lambda rendered_query: self._query_database_chunk(rendered_query, chunk_size,
+                                                                                   temp_tables=temp_tables),
+                                 rendered_queries)
+        finally:
+            pool.close()
+            pool.join()
+        return pd.concat(chunk_dfs, ignore_index=True)
+
+    def _current_chunk_size(self):
+        return self.adaptive_chunk_size.value if self.adaptive_chunk_size is not None else None
+
+    def _execute_query(self, independent_param_vals):
+        chunk_size = self._current_chunk_size()
+        rendered_queries, semi_joins = self._rendered_queries(independent_param_vals=independent_param_vals,
+                                                              chunk_size=chunk_size)
+        temp_tables = self._temp_tables(semi_joins)
+        query_start_time = time.time()
+        if len(rendered_queries) == 1:
+            df = self._query_database(rendered_queries[0], temp_tables=temp_tables)
         else:
-            df = self.db_interface.execute_query(query=rendered_query)
-        self.df = df
+            df = self._query_database_chunks(rendered_queries, chunk_size=chunk_size, temp_tables=temp_tables)
+        self.execution_stats['query_latency'] = time.time() - query_start_time
+        self.receive_dataframe(self._post_filter(df, semi_joins))
 
     def _execute(self, **independent_param_vals):
         """
@@ -217,14 +625,6 @@ class QueryNode(object):
         """
         pass
 
-    def root_execution_thread(self, threads, independent_param_vals):
-        if not self.is_root_node:
-            raise QueryGraphException("Trying to get root execution thread from node that is not root node.")
-        root_thread = thread_tree.ExecutionThread(query_node=self,
-                                                  threads=threads,
-                                                  independent_param_vals=independent_param_vals)
-        return root_thread
-
     def execute(self, **independent_param_vals):
         """
         Execute the QueryGraph. If this QueryNode is the root node, then also
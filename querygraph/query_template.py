@@ -1,6 +1,10 @@
 import re
 
+import pyparsing as pp
+
 from querygraph.template_parameter import TemplateParameter
+from querygraph.utils.deserializer import Deserializer, Placeholder
+from querygraph.semi_join import InListSemiJoin, SemiJoinPlanner
 from querygraph.exceptions import MissingDataError
 
 
@@ -9,44 +13,334 @@ from querygraph.exceptions import MissingDataError
 # ---------------------------------------------
 
 class QueryTemplate(object):
+    """
+    A query template string containing dependent ('{{ ... }}') and
+    independent ('{% ... %}') parameters, and comments ('{# ... #}').
+
+    The template is compiled once, on first use, into a list of text pieces
+    and compiled TemplateParameters; rendering evaluates the parameters and
+    joins the pieces.
+
+    Templates of document stores (Mongo DB, ElasticSearch) can also be
+    compiled into a query structure - dicts and lists with a Placeholder
+    for each parameter - into which parameter values are substituted as
+    Python values, with no text rendering or deserialization per query.
+
+    """
+
+    DEPENDENT = 'dependent'
+    INDEPENDENT = 'independent'
 
     def __init__(self, template_str, type_converter):
         self.template_str = template_str
         self.type_converter = type_converter
+        self._pieces = None
+        self._structure = None
+        self._structure_compiled = False
+
+    def _tokens(self):
+        return re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", self.template_str)
+
+    def text_words(self):
+        """ The set of words of the template's text, outside of its parameters and comments. """
+        return {word for token in self._tokens() if not token.startswith(('{{', '{%', '{#'))
+                for word in re.findall(r'\w+', token)}
+
+    def compile(self):
+        """
+        Return the compiled template: a list whose items are either text
+        pieces, or (kind, TemplateParameter) tuples where kind is DEPENDENT
+        or INDEPENDENT.
+
+        """
+        if self._pieces is None:
+            pieces = list()
+            for token in self._tokens():
+                if token.startswith('{#'):
+                    continue
+                elif token.startswith('{{') or token.startswith('{%'):
+                    template_parameter = TemplateParameter(parameter_str=token[2:-2].strip(),
+                                                           type_converter=self.type_converter)
+                    template_parameter.compile()
+                    pieces.append((self.DEPENDENT if token.startswith('{{') else self.INDEPENDENT,
+                                   template_parameter))
+                elif token:
+                    pieces.append(token)
+            self._pieces = pieces
+        return self._pieces
+
+    def dependent_columns(self):
+        """ Set of the parent dataframe columns the template's dependent parameters refer to. """
+        columns = set()
+        for piece in self.compile():
+            if isinstance(piece, tuple) and piece[0] == self.DEPENDENT:
+                columns |= piece[1].param_expr.names
+        return columns
 
-    def _render_independent_param(self, param_str, independent_param_vals):
+    @staticmethod
+    def _text(rendered_value):
+        return rendered_value if isinstance(rendered_value, basestring) else str(rendered_value)
+
+    def _evaluate(self, kind, template_parameter, df, independent_param_vals):
+        if kind == self.DEPENDENT:
+            if df is None:
+                raise MissingDataError("No parent dataframe provided to render dependent parameter.")
+            return template_parameter.evaluate(df=df)
         if independent_param_vals is None:
             raise MissingDataError("No independent parameter values provided.")
-        independent_parameter = TemplateParameter(parameter_str=param_str, type_converter=self.type_converter)
-        return str(independent_parameter.render(independent_param_vals=independent_param_vals))
-
-    def _render_dependent_param(self, param_str, df):
-        if df is None:
-            raise MissingDataError("No parent dataframe provided to render dependent parameter.")
-        dependent_parameter = TemplateParameter(parameter_str=param_str, type_converter=self.type_converter)
-        return dependent_parameter.render(df=df)
+        return template_parameter.evaluate(independent_param_vals=independent_param_vals)
 
     def render(self, df=None, independent_param_vals=None):
         """
         Returns parsed query template string.
 
         """
-        parsed_query = ""
-        tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", self.template_str)
-        for token in tokens:
-            # Dependent parameter.
-            if token.startswith('{{'):
-                tok_expr = token[2:-2].strip()
-                parsed_query += self._render_dependent_param(param_str=tok_expr, df=df)
-            # Comment.
-            elif token.startswith('{#'):
-                pass
-            # Independent parameter.
-            elif token.startswith('{%'):
-                tok_expr = token[2:-2].strip()
-                parsed_query += self._render_independent_param(param_str=tok_expr,
-                                                               independent_param_vals=independent_param_vals)
+        rendered_pieces = list()
+        for piece in self.compile():
+            if isinstance(piece, basestring):
+                rendered_pieces.append(piece)
             else:
-                parsed_query += token
-        return parsed_query
+                kind, template_parameter = piece
+                python_value = self._evaluate(kind, template_parameter, df, independent_param_vals)
+                rendered_pieces.append(self._text(template_parameter.convert(python_value)))
+        return "".join(rendered_pieces)
+
+    def compile_structure(self, deserialize):
+        """
+        Return the template deserialized into a query structure with a
+        Placeholder in place of each parameter (the n-th Placeholder stands
+        for the n-th parameter of 'compile'), or None if the template can't
+        be deserialized that way - e.g. because a parameter is rendered
+        inside a quoted string.
+
+        Parameters
+        ----------
+        deserialize : Deserializer
+            The database interface's deserializer.
+
+        """
+        if not self._structure_compiled:
+            marked_pieces = list()
+            num_parameters = 0
+            for piece in self.compile():
+                if isinstance(piece, basestring):
+                    marked_pieces.append(piece)
+                else:
+                    marked_pieces.append("%s%s" % (Deserializer.PLACEHOLDER_PREFIX, num_parameters))
+                    num_parameters += 1
+            try:
+                structure = deserialize("".join(marked_pieces))
+            except pp.ParseException:
+                structure = None
+            if structure is not None:
+                placeholders = list()
+                self._substitute(structure, values=None, found=placeholders)
+                if sorted(placeholders) != range(0, num_parameters):
+                    structure = None
+            self._structure = structure
+            self._structure_compiled = True
+        return self._structure
+
+    @classmethod
+    def _substitute(cls, structure, values, found=None):
+        """ Return a copy of 'structure' with each Placeholder replaced by its value. """
+        if isinstance(structure, Placeholder):
+            if found is not None:
+                found.append(structure.index)
+            return values[structure.index] if values is not None else structure
+        if isinstance(structure, dict):
+            return {cls._substitute(key, values, found): cls._substitute(value, values, found)
+                    for key, value in structure.items()}
+        if isinstance(structure, (list, pp.ParseResults)):
+            return [cls._substitute(item, values, found) for item in structure]
+        if isinstance(structure, tuple):
+            return tuple(cls._substitute(item, values, found) for item in structure)
+        return structure
+
+    def render_structures(self, deserialize, df=None, independent_param_vals=None, chunk_size=None):
+        """
+        Structured counterpart of 'render_queries': render the template into
+        query structures, or return None if it can't be compiled into one.
+        Container values are de-duplicated and substituted as lists, and the
+        first dependent container of more than 'chunk_size' values is
+        chunked.
+
+        Returns
+        -------
+        tuple or None
+            The list of query structures, and the list of SemiJoins used.
 
+        """
+        structure = self.compile_structure(deserialize)
+        if structure is None:
+            return None
+        values = list()
+        semi_joins = list()
+        chunked_value = None
+        for piece in self.compile():
+            if isinstance(piece, basestring):
+                continue
+            kind, template_parameter = piece
+            python_value = self._evaluate(kind, template_parameter, df, independent_param_vals)
+            if kind == self.INDEPENDENT or template_parameter.render_as_container is None:
+                values.append(template_parameter.to_python(python_value))
+                continue
+            semi_join = InListSemiJoin(keys=SemiJoinPlanner.distinct_keys(python_value))
+            semi_joins.append(semi_join)
+            keys = template_parameter.to_python(semi_join.keys)
+            if chunked_value is None and chunk_size is not None and len(keys) > chunk_size:
+                chunked_value = len(values)
+                values.append([keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)])
+            else:
+                values.append(keys)
+        if chunked_value is None:
+            return [self._substitute(structure, values)], semi_joins
+        structures = list()
+        for chunk in values[chunked_value]:
+            chunk_values = list(values)
+            chunk_values[chunked_value] = chunk
+            structures.append(self._substitute(structure, chunk_values))
+        return structures, semi_joins
+
+    # Matches a template text piece ending in '<column> IN ', capturing the column.
+    IN_PREDICATE_RE = re.compile(r'(?i)(?:^|(?<=[\s(]))((?!not\b)[\w."`\[\]]+)\s+IN\s*$')
+
+    # Matches a (possibly qualified and quoted) column reference, optionally aliased, or a (qualified) '*'.
+    SELECT_ITEM_RE = re.compile(r'(?i)^(?P<ref>(?:[\w"`\[\]]+\.)*(?:[\w"`\[\]]+|\*))'
+                                r'(?:\s+(?:AS\s+)?(?P<alias>[\w"`\[\]]+))?$')
+
+    @staticmethod
+    def _identifier_names(reference):
+        return [re.sub(r'["`\[\]]', '', name).lower() for name in reference.split('.')]
+
+    @classmethod
+    def selects_column(cls, query_prefix, column):
+        """
+        Whether a query is known to return 'column' under its unqualified
+        name, given the query text up to a '<column> IN' predicate: the
+        predicate must be in the outermost query, whose select list has a
+        '*', the column's table '*' or the column itself (not renamed).
+
+        """
+        text = re.sub(r"'(?:[^']|'')*'", "''", query_prefix)
+        # The outermost query, with the contents of parentheses dropped.
+        depth = 0
+        outer = list()
+        for char in text:
+            if char == ')':
+                depth -= 1
+            if depth == 0:
+                outer.append(char)
+            if char == '(':
+                depth += 1
+        if depth != 0:
+            return False
+        outer = "".join(outer)
+        # Compound queries (e.g. UNION) take their column names from their first query.
+        if len(re.findall(r'(?i)\bSELECT\b', outer)) != 1:
+            return False
+        select = re.search(r'(?is)\bSELECT\s+(?:(?:DISTINCT|ALL)\s+)?(.+?)\s+FROM\b', outer)
+        if select is None:
+            return False
+        names = cls._identifier_names(column)
+        for item in select.group(1).split(','):
+            match = cls.SELECT_ITEM_RE.match(item.strip())
+            if match is None:
+                continue
+            ref_names = cls._identifier_names(match.group('ref'))
+            if ref_names == ['*']:
+                return True
+            if ref_names[-1] == '*':
+                if len(names) > 1 and names[-2] == ref_names[-2]:
+                    return True
+                continue
+            if match.group('alias') is not None and cls._identifier_names(match.group('alias')) != ref_names[-1:]:
+                continue
+            if ref_names[-1] == names[-1] and (len(names) == 1 or len(ref_names) == 1 or
+                                               names[-2] == ref_names[-2]):
+                return True
+        return False
+
+    def render_chunked(self, chunk_size, df=None, independent_param_vals=None):
+        """
+        Render the template once per chunk of values of its first dependent
+        parameter that renders a container holding more than 'chunk_size'
+        values. Executing every returned query and concatenating the results
+        is equivalent to executing the unchunked query, as long as the query
+        only filters on the parameter (no aggregation, DISTINCT or LIMIT).
+
+        Returns
+        -------
+        list of str
+            The rendered queries - a single query if no parameter needed
+            chunking.
+
+        """
+        rendered_queries, _ = self.render_queries(df=df,
+                                                  independent_param_vals=independent_param_vals,
+                                                  chunk_size=chunk_size)
+        return rendered_queries
+
+    def render_queries(self, df=None, independent_param_vals=None, chunk_size=None, semi_join_planner=None,
+                       result_columns=None):
+        """
+        Render the template, shipping the values of container dependent
+        parameters as semi-joins. Container values are de-duplicated; if a
+        'semi_join_planner' is given, it picks the strategy used for each
+        parameter - a parameter that is the right-hand side of a
+        '<column> IN' predicate may have the whole predicate replaced by a
+        range predicate or a temporary table lookup. If the rendered query
+        is narrowed to 'result_columns' (see 'QueryNode.projection'), only
+        predicates on those columns are planned as if the query returned them.
+
+        If 'chunk_size' is not None, the first parameter still shipped as a
+        literal list of more than 'chunk_size' values is chunked as in
+        'render_chunked'.
+
+        Returns
+        -------
+        tuple
+            The list of rendered queries, and the list of SemiJoins used.
+
+        """
+        pieces = list()
+        semi_joins = list()
+        chunked_piece = None
+        for piece in self.compile():
+            if isinstance(piece, basestring):
+                pieces.append(piece)
+                continue
+            kind, template_parameter = piece
+            python_value = self._evaluate(kind, template_parameter, df, independent_param_vals)
+            if kind == self.INDEPENDENT or template_parameter.render_as_container is None:
+                pieces.append(self._text(template_parameter.convert(python_value)))
+                continue
+            in_predicate = None
+            if pieces and isinstance(pieces[-1], basestring):
+                in_predicate = self.IN_PREDICATE_RE.search(pieces[-1])
+            column = in_predicate.group(1) if in_predicate is not None else None
+            if semi_join_planner is not None:
+                column_selected = column is not None and self.selects_column(
+                    "".join(piece for piece in pieces if isinstance(piece, basestring)), column)
+                if column_selected and result_columns is not None:
+                    column_selected = self._identifier_names(column)[-1] in [name.lower() for name in result_columns]
+                semi_join = semi_join_planner.plan(python_value, template_parameter, column=column,
+                                                   column_selected=column_selected)
+            else:
+                semi_join = InListSemiJoin(keys=SemiJoinPlanner.distinct_keys(python_value), column=column)
+            semi_joins.append(semi_join)
+            if semi_join.rewrites_predicate:
+                pieces[-1] = pieces[-1][:in_predicate.start(1)]
+                pieces.append(semi_join.predicate(template_parameter))
+            elif chunked_piece is None and chunk_size is not None and len(semi_join.keys) > chunk_size:
+                keys = semi_join.keys
+                chunked_piece = len(pieces)
+                pieces.append([self._text(template_parameter.convert(keys[i:i + chunk_size]))
+                               for i in range(0, len(keys), chunk_size)])
+            else:
+                pieces.append(semi_join.predicate(template_parameter))
+        if chunked_piece is None:
+            return ["".join(pieces)], semi_joins
+        prefix = "".join(pieces[:chunked_piece])
+        suffix = "".join(pieces[chunked_piece + 1:])
+        return [prefix + chunk + suffix for chunk in pieces[chunked_piece]], semi_joins
@@ -0,0 +1,344 @@
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from querygraph import exceptions
+
+
+# =============================================
+# Node Execution States
+# ---------------------------------------------
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETE = 'complete'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+# =============================================
+# Execution Scheduler Class
+# ---------------------------------------------
+
+class ExecutionScheduler(object):
+    """
+    Executes the QueryNodes of a query graph on a bounded pool of worker
+    threads, and folds them into the root node. The root node is submitted
+    first; when a node finishes, its children are submitted from the
+    completion callback. No thread ever waits on another node.
+
+    Folding is pipelined: as soon as every child of a node has finished
+    and joined its own children, a task joining the children into the node
+    is submitted. Disjoint subtrees are therefore folded concurrently, and
+    while other nodes' queries are still running.
+
+    A node whose result set is empty has its whole subtree marked as
+    'skipped', since there is nothing to render the children's dependent
+    parameters with. The first node or join to fail cancels every node
+    that has not started yet, and its exception is re-raised by 'execute'.
+
+    Parameters
+    ----------
+    root_node : QueryNode
+        The root node of the graph to execute.
+    log : ExecutionLog
+        Log of the host QueryGraph.
+    max_workers : int
+        Maximum number of nodes executed concurrently. Ignored if 'pool'
+        is given.
+    pool : ThreadPool or None
+        Pool to run nodes on. If None, 'execute' creates a private pool
+        for the duration of the execution.
+    async_queries : bool
+        Whether to run queries through the connectors' asynchronous hook,
+        so that connectors with a native asynchronous driver do not hold
+        a worker thread while their query is in flight.
+    priorities : dict or None
+        Dictionary mapping node names to priorities, e.g. the estimated
+        length of the critical path below each node. Of the children of a
+        finished node, those with the highest priority are started first.
+
+    """
+
+    def __init__(self, root_node, log, max_workers, pool=None, async_queries=False, priorities=None):
+        self.root_node = root_node
+        self.log = log
+        self.max_workers = max_workers
+        self.pool = pool
+        self.async_queries = async_queries
+        self.priorities = priorities
+        self.states = dict()
+        self.exc_info = None
+        self._lock = threading.Lock()
+        self._callback = None
+        self._num_unfinished = 0
+        self._num_folding = 0
+        self._unfolded_children = dict()
+        self._root_folded = False
+
+    def nodes_in_state(self, state):
+        return [query_node for query_node in self.root_node if self.states.get(query_node.name) == state]
+
+    @property
+    def skipped_nodes(self):
+        return self.nodes_in_state(SKIPPED)
+
+    def execute(self, independent_param_vals):
+        """
+        Execute and fold every node of the graph, blocking until the root
+        node holds the final result or execution has failed.
+
+        Parameters
+        ----------
+        independent_param_vals : dict
+            Dictionary mapping independent parameter names to values - for
+            use in template rendering.
+
+        """
+        finished = threading.Event()
+        private_pool = self.pool is None
+        if private_pool:
+            self.pool = ThreadPool(processes=max(1, min(self.max_workers, len(list(self.root_node)))))
+        try:
+            self.start(independent_param_vals=independent_param_vals, callback=lambda scheduler: finished.set())
+            finished.wait()
+        finally:
+            if private_pool:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_traceback = self.exc_info
+            raise exc_type, exc_value, exc_traceback
+        return self.states
+
+    def start(self, independent_param_vals, callback):
+        """
+        Start executing the graph without blocking. 'callback' is called with
+        this scheduler once the root node holds the final result, or once a
+        node has failed and no more work is in flight - 'exc_info' is then set.
+
+        """
+        query_nodes = list(self.root_node)
+        self.states = {query_node.name: PENDING for query_node in query_nodes}
+        self.exc_info = None
+        self._callback = callback
+        self._num_unfinished = len(query_nodes)
+        self._num_folding = 0
+        self._unfolded_children = dict()
+        self._root_folded = False
+        with self._lock:
+            self._submit(self.root_node, independent_param_vals)
+
+    def _submit(self, query_node, independent_param_vals):
+        self.states[query_node.name] = RUNNING
+        if self.async_queries:
+            self.pool.apply_async(self._start_node_query, args=(query_node, independent_param_vals))
+        else:
+            self.pool.apply_async(self._run_node,
+                                  args=(query_node, independent_param_vals),
+                                  callback=lambda result: self._on_node_finished(result, independent_param_vals))
+
+    def _run_node(self, query_node, independent_param_vals):
+        """ Runs on a worker thread. Never raises - the outcome is passed to the callback. """
+        if self.exc_info is not None:
+            return query_node, CANCELLED, None
+        try:
+            query_node.retrieve_dataframe(independent_param_vals=independent_param_vals)
+        except Exception:
+            return query_node, FAILED, sys.exc_info()
+        return query_node, COMPLETE, None
+
+    def _start_node_query(self, query_node, independent_param_vals):
+        """
+        Runs on a worker thread. Renders the node's query and hands it to the
+        connector's asynchronous hook; the result is processed by another
+        worker task once it arrives.
+
+        """
+        if self.exc_info is not None:
+            self._on_node_finished((query_node, CANCELLED, None), independent_param_vals)
+            return
+
+        def callback(df):
+            self.pool.apply_async(self._receive_node_dataframe, args=(query_node, df, independent_param_vals))
+
+        def errback(exc_info):
+            self._on_node_finished((query_node, FAILED, exc_info), independent_param_vals)
+
+        try:
+            query_node.retrieve_dataframe_async(independent_param_vals=independent_param_vals,
+                                                callback=callback,
+                                                errback=errback)
+        except Exception:
+            errback(sys.exc_info())
+
+    def _receive_node_dataframe(self, query_node, df, independent_param_vals):
+        try:
+            query_node.receive_dataframe(df)
+        except Exception:
+            self._on_node_finished((query_node, FAILED, sys.exc_info()), independent_param_vals)
+        else:
+            self._on_node_finished((query_node, COMPLETE, None), independent_param_vals)
+
+    def _on_node_finished(self, result, independent_param_vals):
+        """ Runs on the pool's result handler thread, or a worker thread for async queries. """
+        query_node, state, exc_info = result
+        with self._lock:
+            self._mark(query_node, state)
+            if state == FAILED:
+                self._fail(query_node, exc_info)
+            elif state == COMPLETE and self.exc_info is None:
+                if query_node.result_set_empty or not query_node.children:
+                    self._skip_descendants(query_node)
+                    self._subtree_done(query_node)
+                else:
+                    self._unfolded_children[query_node.name] = len(query_node.children)
+                    for child_node in self._by_priority(query_node.children):
+                        self._submit(child_node, independent_param_vals)
+            finished = self._is_finished()
+        if finished:
+            self._callback(self)
+
+    def _by_priority(self, query_nodes):
+        if not self.priorities:
+            return query_nodes
+        return sorted(query_nodes, key=lambda query_node: self.priorities.get(query_node.name, 0), reverse=True)
+
+    def _fold_node(self, query_node):
+        """ Runs on a worker thread. Joins the node's children with it. """
+        exc_info = None
+        if self.exc_info is None:
+            try:
+                query_node.join_children()
+            except Exception:
+                exc_info = sys.exc_info()
+        with self._lock:
+            self._num_folding -= 1
+            if exc_info is not None:
+                self._fail(query_node, exc_info)
+            elif self.exc_info is None:
+                self._subtree_done(query_node)
+            finished = self._is_finished()
+        if finished:
+            self._callback(self)
+
+    def _subtree_done(self, query_node):
+        """ Called once a node has joined all of its children. """
+        if query_node is self.root_node:
+            self._root_folded = True
+            return
+        parent_node = query_node.parent
+        self._unfolded_children[parent_node.name] -= 1
+        if self._unfolded_children[parent_node.name] == 0:
+            self._num_folding += 1
+            self.pool.apply_async(self._fold_node, args=(parent_node,))
+
+    def _fail(self, query_node, exc_info):
+        if self.exc_info is None:
+            self.log.graph_error(msg="Execution failed on node '%s' - cancelling remaining nodes." % query_node.name)
+            self.exc_info = exc_info
+            self._cancel_pending()
+
+    def _is_finished(self):
+        if self.exc_info is None:
+            return self._root_folded
+        return self._num_unfinished == 0 and self._num_folding == 0
+
+    def _mark(self, query_node, state):
+        self.states[query_node.name] = state
+        self._num_unfinished -= 1
+
+    def _skip_descendants(self, query_node):
+        for child_node in query_node.children:
+            self.log.node_info(source_node=child_node.name,
+                               msg="Skipped because parent node '%s' returned no rows." % query_node.name)
+            for descendant in child_node:
+                self._mark(descendant, SKIPPED)
+
+    def _cancel_pending(self):
+        for query_node in self.root_node:
+            if self.states[query_node.name] == PENDING:
+                self._mark(query_node, CANCELLED)
+
+
+# =============================================
+# Execution Future Class
+# ---------------------------------------------
+
+class ExecutionFuture(object):
+    """
+    Handle for a query graph execution started with 'QueryGraph.execute_async'.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._done_callbacks = list()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Return the execution's result dataframe, blocking until it is available.
+        If the execution failed, its exception is re-raised.
+
+        """
+        if not self._done.wait(timeout):
+            raise exceptions.ExecutionTimeout("Query graph execution did not finish within %s seconds." % timeout)
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            raise exc_type, exc_value, exc_traceback
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise exceptions.ExecutionTimeout("Query graph execution did not finish within %s seconds." % timeout)
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """ Call 'fn' with this future once it is done - immediately if it already is. """
+        with self._lock:
+            if not self.done():
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        with self._lock:
+            self._done.set()
+            done_callbacks, self._done_callbacks = self._done_callbacks, list()
+        for fn in done_callbacks:
+            fn(self)
+
+
+# =============================================
+# Shared Pool
+# ---------------------------------------------
+
+SHARED_POOL_SIZE = 16
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    """ Bounded pool shared by all asynchronous query graph executions. """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ThreadPool(processes=SHARED_POOL_SIZE)
+        return _shared_pool
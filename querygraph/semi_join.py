@@ -0,0 +1,243 @@
+import re
+import uuid
+from abc import ABCMeta, abstractmethod
+
+import pandas as pd
+
+from querygraph.exceptions import ExecutionError
+
+
+# =============================================
+# Semi-Join Base Class
+# ---------------------------------------------
+
+class SemiJoin(object):
+    """
+    A way of shipping the key set of a dependent parameter - the values of
+    a parent node column - to the child node's query.
+
+    Parameters
+    ----------
+    keys : list
+        The distinct parent key values.
+    column : str or None
+        The query expression the keys are compared with, e.g. '"AlbumId"' in
+        '"AlbumId" IN {{ AlbumId -> list:int }}'. None if the parameter is not
+        used as the right-hand side of an IN predicate.
+
+    """
+
+    __metaclass__ = ABCMeta
+
+    strategy = None
+
+    def __init__(self, keys, column=None):
+        self.keys = keys
+        self.column = column
+
+    @property
+    def rewrites_predicate(self):
+        """ Whether the whole '<column> IN <parameter>' predicate is replaced by 'predicate'. """
+        return True
+
+    @abstractmethod
+    def predicate(self, template_parameter):
+        pass
+
+    @property
+    def temp_tables(self):
+        return list()
+
+    def post_filter(self, df):
+        return df
+
+    @property
+    def df_column(self):
+        """ Name of the result column 'column' refers to - unqualified and unquoted. """
+        return re.sub(r'["`\[\]]', '', self.column.split('.')[-1])
+
+    @staticmethod
+    def _render_value(template_parameter, value):
+        return str(template_parameter.type_converter.convert(rendered_type=template_parameter.render_as_type,
+                                                             python_value=value))
+
+
+# =============================================
+# Semi-Join Strategies
+# ---------------------------------------------
+
+class InListSemiJoin(SemiJoin):
+
+    """ Literal list of the distinct keys, rendered by the parameter's container converter. """
+
+    strategy = 'in_list'
+
+    @property
+    def rewrites_predicate(self):
+        return False
+
+    def predicate(self, template_parameter):
+        return str(template_parameter.convert(self.keys))
+
+
+class RangeSemiJoin(SemiJoin):
+
+    """ Runs of consecutive integer keys compacted into BETWEEN ranges, plus an IN list of the rest. """
+
+    strategy = 'ranges'
+
+    def __init__(self, keys, column, runs):
+        SemiJoin.__init__(self, keys=keys, column=column)
+        self.runs = runs
+
+    def predicate(self, template_parameter):
+        terms = list()
+        singles = list()
+        for start, stop in self.runs:
+            if start == stop:
+                singles.append(start)
+            else:
+                terms.append("%s BETWEEN %s AND %s" % (self.column,
+                                                       self._render_value(template_parameter, start),
+                                                       self._render_value(template_parameter, stop)))
+        if singles:
+            terms.append("%s IN %s" % (self.column, template_parameter.convert(singles)))
+        return "(%s)" % " OR ".join(terms)
+
+
+class MinMaxSemiJoin(SemiJoin):
+
+    """ A single BETWEEN predicate over the key range; rows outside the key set are filtered client-side. """
+
+    strategy = 'min_max'
+
+    def predicate(self, template_parameter):
+        return "%s BETWEEN %s AND %s" % (self.column,
+                                         self._render_value(template_parameter, min(self.keys)),
+                                         self._render_value(template_parameter, max(self.keys)))
+
+    def post_filter(self, df):
+        df_column = self.df_column
+        if df_column not in df:
+            # Unquoted identifiers may come back in another case (e.g. lowercased by Postgres).
+            df_column = next((col for col in df.columns if str(col).lower() == df_column.lower()), None)
+            if df_column is None:
+                raise ExecutionError("Column '%s' of the min/max semi-join is not in the query result, so "
+                                     "rows outside the key set can't be filtered out." % self.df_column)
+        return df[df[df_column].isin(self.keys)]
+
+
+class TempTableSemiJoin(SemiJoin):
+
+    """ Keys bulk-uploaded to a session temporary table that the query joins with server-side. """
+
+    strategy = 'temp_table'
+
+    def __init__(self, keys, column, key_type):
+        SemiJoin.__init__(self, keys=keys, column=column)
+        self.key_type = key_type
+        self.table_name = 'qg_keys_%s' % uuid.uuid4().hex[:16]
+
+    def predicate(self, template_parameter):
+        return "%s IN (SELECT k FROM %s)" % (self.column, self.table_name)
+
+    @property
+    def temp_tables(self):
+        return [self]
+
+
+# =============================================
+# Semi-Join Planner Class
+# ---------------------------------------------
+
+class SemiJoinPlanner(object):
+    """
+    Chooses the cheapest SemiJoin for a dependent parameter, based on the
+    number and type of distinct keys and on what the child node's database
+    interface supports.
+
+    Parameters
+    ----------
+    db_interface : DatabaseInterface
+        The child node's database interface.
+
+    """
+
+    # Key sets up to this size are always shipped as a literal IN list.
+    IN_LIST_MAX_KEYS = 1000
+
+    # Integer runs are used if they need at most this fraction of the terms of an IN list.
+    RANGE_MAX_TERM_RATIO = 0.5
+
+    # Otherwise a min/max range is used if at least this fraction of the integers in the range are keys.
+    MIN_MAX_MIN_DENSITY = 0.5
+
+    # Key sets at least this large are uploaded to a temporary table, if supported.
+    TEMP_TABLE_MIN_KEYS = 10000
+
+    TEMP_TABLE_KEY_TYPES = {'int': 'BIGINT', 'float': 'DOUBLE PRECISION', 'str': 'TEXT'}
+
+    def __init__(self, db_interface):
+        self.db_interface = db_interface
+
+    @staticmethod
+    def distinct_keys(python_value):
+        """ Distinct values of a container parameter value, in order of first appearance. """
+        try:
+            return pd.Series(list(python_value)).drop_duplicates().tolist()
+        except TypeError:
+            return list(python_value)
+
+    @staticmethod
+    def integer_runs(keys):
+        """ Return the (start, stop) runs of consecutive values in a list of integers. """
+        runs = list()
+        for key in sorted(keys):
+            if runs and key == runs[-1][1] + 1:
+                runs[-1][1] = key
+            else:
+                runs.append([key, key])
+        return [tuple(run) for run in runs]
+
+    @staticmethod
+    def _all_instances(keys, types):
+        return all(isinstance(key, types) and not isinstance(key, bool) for key in keys)
+
+    def plan(self, python_value, template_parameter, column=None, column_selected=False):
+        """
+        Return the SemiJoin to use for a container dependent parameter.
+
+        Parameters
+        ----------
+        python_value : iterable
+            The evaluated parameter value.
+        template_parameter : TemplateParameter
+            The parameter, with its render and container types resolved.
+        column : str or None
+            The expression the parameter is compared with by an IN predicate.
+        column_selected : bool
+            Whether the query is known to return 'column' (see
+            'QueryTemplate.selects_column'). A min/max range is only used
+            if it is, since its result is filtered on the column.
+
+        """
+        keys = self.distinct_keys(python_value)
+        num_keys = len(keys)
+        if column is None or num_keys <= self.IN_LIST_MAX_KEYS:
+            return InListSemiJoin(keys=keys, column=column)
+        render_type = template_parameter.render_as_type
+        integer_keys = render_type == 'int' and self._all_instances(keys, (int, long))
+
+        if self.db_interface.supports_range_predicates and integer_keys:
+            runs = self.integer_runs(keys)
+            if len(runs) <= self.RANGE_MAX_TERM_RATIO * num_keys:
+                return RangeSemiJoin(keys=keys, column=column, runs=runs)
+            if column_selected and num_keys >= self.MIN_MAX_MIN_DENSITY * (max(keys) - min(keys) + 1):
+                return MinMaxSemiJoin(keys=keys, column=column)
+
+        if self.db_interface.supports_temp_tables and num_keys >= self.TEMP_TABLE_MIN_KEYS:
+            key_types = {'int': (int, long), 'float': (int, long, float), 'str': basestring}
+            if render_type in key_types and self._all_instances(keys, key_types[render_type]):
+                return TempTableSemiJoin(keys=keys, column=column, key_type=self.TEMP_TABLE_KEY_TYPES[render_type])
+
+        return InListSemiJoin(keys=keys, column=column)
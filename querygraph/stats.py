@@ -0,0 +1,217 @@
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+# =============================================
+# Execution Statistics Store Class
+# ---------------------------------------------
+
+class ExecutionStatsStore(object):
+    """
+    Persists per-node execution statistics of query graphs to a local
+    SQLite file, keyed by graph fingerprint and node name. Each statistic
+    is an exponentially smoothed average over previous executions.
+
+    Recorded statistics are:
+
+        render_time   : seconds spent rendering the node's query.
+        query_latency : seconds between sending the query and receiving the result.
+        rows          : number of rows returned by the query.
+        bytes         : (shallow) in-memory size of the returned dataframe.
+        join_rows     : number of rows the parent's dataframe had after joining the node.
+        chunk_size    : the node's adaptive chunk size at the end of execution.
+        bytes_copied  : bytes of dataframe columns copied on the node's data path -
+                        by its manipulation set and by joining its children (see 'copied_bytes').
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file. Created if it does not exist.
+
+    """
+
+    STATS = ('render_time', 'query_latency', 'rows', 'bytes', 'join_rows', 'chunk_size', 'bytes_copied')
+
+    # Weight of the newest execution in the smoothed statistics.
+    SMOOTHING = 0.3
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        connector = self._conn()
+        connector.execute("CREATE TABLE IF NOT EXISTS node_stats ("
+                          "graph_fingerprint TEXT NOT NULL, "
+                          "node_name TEXT NOT NULL, "
+                          "runs INTEGER NOT NULL, "
+                          "updated REAL NOT NULL, "
+                          "%s, "
+                          "PRIMARY KEY (graph_fingerprint, node_name))"
+                          % ", ".join("%s REAL" % stat for stat in self.STATS))
+        # Stores created before a statistic was introduced lack its column.
+        columns = [row[1] for row in connector.execute("PRAGMA table_info(node_stats)")]
+        for stat in self.STATS:
+            if stat not in columns:
+                connector.execute("ALTER TABLE node_stats ADD COLUMN %s REAL" % stat)
+        connector.commit()
+        connector.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def node_stats(self, graph_fingerprint):
+        """
+        Return the statistics of every node of a graph, as a dictionary mapping
+        node names to dictionaries of statistics. Statistics never recorded are None.
+
+        """
+        connector = self._conn()
+        try:
+            cursor = connector.execute("SELECT node_name, runs, %s FROM node_stats WHERE graph_fingerprint = ?"
+                                       % ", ".join(self.STATS), (graph_fingerprint,))
+            rows = cursor.fetchall()
+        finally:
+            connector.close()
+        node_stats = dict()
+        for row in rows:
+            stats = dict(zip(self.STATS, row[2:]))
+            stats['runs'] = row[1]
+            node_stats[row[0]] = stats
+        return node_stats
+
+    def record(self, graph_fingerprint, node_stats):
+        """
+        Fold one execution's statistics into the store.
+
+        Parameters
+        ----------
+        graph_fingerprint : str
+            Fingerprint of the executed graph.
+        node_stats : dict
+            Dictionary mapping node names to dictionaries of the statistics
+            observed for the node. Missing or None statistics are left unchanged.
+
+        """
+        with self._lock:
+            previous_stats = self.node_stats(graph_fingerprint)
+            connector = self._conn()
+            try:
+                for node_name, stats in node_stats.items():
+                    if not stats:
+                        continue
+                    previous = previous_stats.get(node_name, dict())
+                    merged = [self._smooth(previous.get(stat), stats.get(stat)) for stat in self.STATS]
+                    connector.execute("INSERT OR REPLACE INTO node_stats (graph_fingerprint, node_name, runs, "
+                                      "updated, %s) VALUES (?, ?, ?, ?, %s)"
+                                      % (", ".join(self.STATS), ", ".join("?" for stat in self.STATS)),
+                                      [graph_fingerprint, node_name, previous.get('runs', 0) + 1, time.time()] + merged)
+                connector.commit()
+            finally:
+                connector.close()
+
+    def _smooth(self, previous_value, value):
+        if value is None:
+            return previous_value
+        if previous_value is None:
+            return value
+        return (1 - self.SMOOTHING) * previous_value + self.SMOOTHING * value
+
+
+# =============================================
+# Statistics Helpers
+# ---------------------------------------------
+
+def graph_fingerprint(root_node):
+    """
+    Fingerprint of a query graph's structure: the nodes' names, query
+    templates, connectors, fields and join contexts. Two graphs with the
+    same fingerprint run the same queries for the same parameter values.
+
+    """
+    fingerprint = hashlib.sha1()
+    for query_node in root_node:
+        join_context = query_node.join_context
+        parts = [query_node.name,
+                 query_node.query,
+                 query_node.db_interface.db_type,
+                 query_node.db_interface.name,
+                 repr(query_node.fields),
+                 query_node.parent.name if query_node.parent is not None else '',
+                 repr(join_context.join_type),
+                 repr(join_context.parent_cols),
+                 repr(join_context.child_cols)]
+        for part in parts:
+            fingerprint.update(unicode(part).encode('utf-8'))
+            fingerprint.update('\0')
+    return fingerprint.hexdigest()
+
+
+def _base_buffer(values):
+    """ The array owning the memory of a (view of an) array. """
+    while isinstance(getattr(values, 'base', None), np.ndarray):
+        values = values.base
+    return values
+
+
+def copied_bytes(source_dfs, df):
+    """
+    Number of bytes of a dataframe's columns that are not views of the
+    columns of the dataframes it was made from - i.e. the bytes copied to
+    make it. Object columns count their pointers, not the objects.
+
+    Parameters
+    ----------
+    source_dfs : list
+        The dataframes 'df' was made from.
+    df : pd.DataFrame
+        The resulting dataframe.
+
+    """
+    source_buffers = {id(_base_buffer(series.values)) for source_df in source_dfs
+                      for col_name, series in source_df.iteritems()}
+    num_bytes = 0
+    for col_name, series in df.iteritems():
+        values = series.values
+        if isinstance(values, np.ndarray) and id(_base_buffer(values)) not in source_buffers:
+            num_bytes += values.nbytes
+    return num_bytes
+
+
+def node_cost(stats):
+    """ Estimated seconds a node occupies a worker for, from its statistics. """
+    if not stats:
+        return 0.0
+    return (stats.get('render_time') or 0.0) + (stats.get('query_latency') or 0.0)
+
+
+def critical_paths(root_node, node_stats):
+    """
+    Return a dictionary mapping each node's name to the estimated length,
+    in seconds, of the longest path from the node to a leaf of its subtree.
+
+    """
+    lengths = dict()
+    for query_node in reversed(list(root_node)):
+        longest_child_path = max([lengths[child.name] for child in query_node.children] or [0.0])
+        lengths[query_node.name] = node_cost(node_stats.get(query_node.name)) + longest_child_path
+    return lengths
+
+
+def parallelism(root_node, node_stats):
+    """
+    Estimated number of workers that keeps the graph's critical path busy:
+    the total work divided by the length of the critical path. None if
+    there are no statistics for the graph.
+
+    """
+    if not node_stats:
+        return None
+    total_cost = sum(node_cost(node_stats.get(query_node.name)) for query_node in root_node)
+    critical_path = critical_paths(root_node, node_stats)[root_node.name]
+    if critical_path <= 0:
+        return None
+    return int(math.ceil(total_cost / critical_path))
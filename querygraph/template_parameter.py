@@ -1,7 +1,8 @@
+import re
+
 import pyparsing as pp
 
-from querygraph.manipulation.expression.evaluator import Evaluator
-from querygraph.manipulation.expression import ManipulationExpression
+from querygraph.manipulation.expression.compiled import compile_expression, UnknownName
 from querygraph.db.type_converter import TypeConverter
 from querygraph.exceptions import ParameterRenderError
 
@@ -12,6 +13,21 @@ from querygraph.exceptions import ParameterRenderError
 
 
 class TemplateParameter(object):
+    """
+    A query template parameter of the form:
+
+        <expression> -> <render_as_type>
+        <expression> -> <container_type>:<render_as_type>
+
+    The parameter string is compiled once - on first use - into an
+    expression tree and its render and container types. Evaluating the
+    parameter then only walks the tree against the given data frame and
+    independent parameter values, so a compiled parameter can be rendered
+    any number of times, from several threads.
+
+    """
+
+    TYPE_SPEC_RE = re.compile(r"^\s*(?:([A-Za-z][\w$]*)\s*:\s*)?([A-Za-z][\w$]*)\s*$")
 
     def __init__(self, parameter_str, type_converter):
         self.parameter_str = parameter_str
@@ -22,39 +38,45 @@ class TemplateParameter(object):
         self.render_as_type = None
         self.render_as_container = None
 
-    def _set_param_expr(self, value):
-        self.param_expr = value
-
-    def _set_render_type(self, value):
-        self.render_as_type = value
-
-    def _set_container_type(self, value):
-        self.render_as_container = value
-
-    def _parse(self, df=None, independent_param_vals=None):
-        expr_evaluator = Evaluator(df=df, name_dict=independent_param_vals)
-        param_expr = expr_evaluator.parser()
-
-        render_as_type = pp.Word(pp.alphas, pp.alphanums + "_$")
-        render_as_type.setParseAction(lambda x: self._set_render_type(value=x[0]))
-
-        container_type = pp.Optional(pp.Word(pp.alphas, pp.alphanums + "_$") + pp.Suppress(":"), default=None)
-        container_type.setParseAction(lambda x: self._set_container_type(value=x[0]))
-
-        parser = param_expr + pp.Suppress("->") + container_type + render_as_type
-
+    def compile(self):
+        """ Parse the parameter string, if it hasn't been parsed yet. """
+        if self.param_expr is not None:
+            return
+        if '->' not in self.parameter_str:
+            raise ParameterRenderError("Error parsing parameter string '%s': missing '->'." % self.parameter_str)
+        expr_str, type_str = self.parameter_str.rsplit('->', 1)
+        type_spec = self.TYPE_SPEC_RE.match(type_str)
+        if type_spec is None:
+            raise ParameterRenderError("Error parsing parameter string '%s': invalid render type '%s'."
+                                       % (self.parameter_str, type_str.strip()))
         try:
-            parser.parseString(self.parameter_str)
+            param_expr = compile_expression(expr_str.strip())
         except pp.ParseException, e:
             raise ParameterRenderError("Error parsing parameter string: \n %s" % e)
+        self.render_as_container, self.render_as_type = type_spec.groups()
+        self.param_expr = param_expr
 
-        python_value = expr_evaluator.output_value()
-        return python_value
+    def evaluate(self, df=None, independent_param_vals=None):
+        """ Return the Python value of the parameter expression, before rendering. """
+        self.compile()
+        try:
+            return self.param_expr.evaluate(df=df, name_dict=independent_param_vals)
+        except UnknownName, e:
+            raise ParameterRenderError("Error evaluating parameter string '%s': %s" % (self.parameter_str, e))
 
-    def render(self, df=None, independent_param_vals=None):
-        python_value = self._parse(df=df, independent_param_vals=independent_param_vals)
+    def convert(self, python_value):
+        """ Render an evaluated Python value using the parameter's render and container types. """
         rendered_value = self.type_converter.convert(rendered_type=self.render_as_type,
                                                      container_type=self.render_as_container,
                                                      python_value=python_value)
         return rendered_value
 
+    def to_python(self, python_value):
+        """ Convert an evaluated Python value into the value placed in a structured query. """
+        return self.type_converter.to_python(rendered_type=self.render_as_type,
+                                             container_type=self.render_as_container,
+                                             python_value=python_value)
+
+    def render(self, df=None, independent_param_vals=None):
+        python_value = self.evaluate(df=df, independent_param_vals=independent_param_vals)
+        return self.convert(python_value)
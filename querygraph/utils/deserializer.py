@@ -1,16 +1,39 @@
 import datetime
+import threading
 
 import pyparsing as pp
 
 
+class Placeholder(object):
+    """ Stands in for the value of a query template parameter in a deserialized query structure. """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return "Placeholder(%s)" % self.index
+
+
 class Deserializer(object):
+    """
+    Parses the text representation of a Python value - as rendered for
+    Mongo DB and ElasticSearch queries - back into the value. Bare
+    placeholder names ('<PLACEHOLDER_PREFIX><n>') are parsed into
+    Placeholder instances.
+
+    """
+
+    PLACEHOLDER_PREFIX = '__qg_placeholder_'
 
     def __init__(self):
-        pass
+        self._parser = None
+        self._lock = threading.Lock()
 
     def __call__(self, value_str):
-        parser = self.parser()
-        return parser.parseString(value_str)[0]
+        with self._lock:
+            if self._parser is None:
+                self._parser = self.parser()
+            return self._parser.parseString(value_str)[0]
 
     @staticmethod
     def _make_datetime(toks):
@@ -40,8 +63,11 @@ class Deserializer(object):
         list_str = pp.Forward()
         dict_str = pp.Forward()
 
+        placeholder = pp.Regex(r"%s(\d+)" % self.PLACEHOLDER_PREFIX)
+        placeholder.setParseAction(lambda toks: Placeholder(int(toks[0][len(self.PLACEHOLDER_PREFIX):])))
+
         list_item = real | integer | _datetime | pp.quotedString.setParseAction(pp.removeQuotes) | \
-                    pp.Group(list_str) | tuple_str | dict_str
+                    pp.Group(list_str) | tuple_str | dict_str | placeholder
 
         tuple_str << (pp.Suppress("(") + pp.Optional(pp.delimitedList(list_item)) +
                       pp.Optional(pp.Suppress(",")) + pp.Suppress(")"))
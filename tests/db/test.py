@@ -0,0 +1,149 @@
+import threading
+import unittest
+
+from querygraph.exceptions import ExecutionError
+from querygraph.utils import optional_import
+
+try:
+    from querygraph.db.interfaces import _cassandra
+except ImportError:
+    _cassandra = optional_import.NotInstalled(name='cassandra-driver')
+
+
+class FakeResponseFuture(object):
+    """ ResponseFuture serving rows in pages of 'page_size', each delivered on a new thread. """
+
+    def __init__(self, rows, page_size):
+        self.rows = rows
+        self.page_size = page_size
+        self.position = 0
+        self.callback = None
+
+    @property
+    def has_more_pages(self):
+        return self.position < len(self.rows)
+
+    def add_callbacks(self, callback, errback):
+        self.callback = callback
+        self.start_fetching_next_page()
+
+    def start_fetching_next_page(self):
+        page = self.rows[self.position:self.position + self.page_size]
+        self.position += self.page_size
+        threading.Thread(target=self.callback, args=(_cassandra.columnar_factory(['pk', 'val'], page),)).start()
+
+
+class FakeSession(object):
+    """ Session over (pk, val) rows, whose token is the partition key 'pk' itself. """
+
+    def __init__(self, rows, page_size=2):
+        self.rows = rows
+        self.page_size = page_size
+        self.queries = list()
+        self.lock = threading.Lock()
+
+    def prepare(self, query):
+        return query
+
+    def execute_async(self, statement, params):
+        start, end = params
+        with self.lock:
+            self.queries.append(params)
+        return FakeResponseFuture([row for row in self.rows if start < row[0] <= end], self.page_size)
+
+    def submit(self, fn):
+        threading.Thread(target=fn).start()
+
+
+class Record(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@unittest.skipIf(isinstance(_cassandra, optional_import.NotInstalled), "cassandra-driver is not installed.")
+class CassandraTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cassandra = _cassandra.Cassandra(name='cassandra', contact_point='localhost', port=9042, keyspace='ks')
+        self.rows = [(token, 'v%s' % token) for token in range(-50, 50, 3)]
+
+    def _metadata_session(self, partitioner='org.apache.cassandra.dht.Murmur3Partitioner'):
+        table = Record(partition_key=[Record(name='pk'), Record(name='Region')])
+        metadata = Record(partitioner=partitioner,
+                          keyspaces={'ks': Record(tables={'t': table})},
+                          token_map=Record(ring=[Record(value=-10), Record(value=20)]))
+        return Record(cluster=Record(metadata=metadata))
+
+    def test_split_token_ring(self):
+        token_ranges = _cassandra.split_token_ring([20, -10, 20, _cassandra.MIN_TOKEN], 2)
+        self.assertEquals(len(token_ranges), 6)
+        self.assertEquals(token_ranges[0][0], _cassandra.MIN_TOKEN)
+        self.assertEquals(token_ranges[-1][1], _cassandra.MAX_TOKEN)
+        self.assertTrue(all(previous[1] == current[0] for previous, current in zip(token_ranges, token_ranges[1:])))
+        self.assertEquals(token_ranges[2:4], [(-10, 5), (5, 20)])
+        # Ranges narrower than the number of splits aren't split into empty ranges.
+        token_ranges = _cassandra.split_token_ring([0, 1], 4)
+        self.assertEquals(len(token_ranges), 9)
+        self.assertEquals(token_ranges[4], (0, 1))
+
+    def test_scan_query(self):
+        session = self._metadata_session()
+        scan = self.cassandra.token_range_scan(session, "SELECT val FROM t WHERE val > 3 ALLOW FILTERING;")
+        self.assertEquals(scan.query, 'SELECT val FROM t WHERE val > 3 AND token("pk", "Region") > ? AND '
+                                      'token("pk", "Region") <= ? ALLOW FILTERING')
+        self.assertEquals(len(scan.token_ranges), 3)
+        scan = self.cassandra.token_range_scan(session, 'select * from ks."t"')
+        self.assertEquals(scan.query, 'SELECT * FROM ks."t" WHERE token("pk", "Region") > ? AND '
+                                      'token("pk", "Region") <= ?')
+        self.assertTrue(self.cassandra.token_range_scan(session, "SELECT * FROM t WHERE pk_val = 1") is not None)
+        for query in ("SELECT COUNT(*) FROM t", "SELECT * FROM t LIMIT 3", "SELECT * FROM t ORDER BY val",
+                      "SELECT * FROM t WHERE token(pk) > 0", "SELECT * FROM other", "DELETE FROM t",
+                      # Restrictions of the partition key.
+                      "SELECT * FROM t WHERE pk = 1", 'SELECT * FROM t WHERE "Region" IN (\'a\')'):
+            self.assertTrue(self.cassandra.token_range_scan(session, query) is None, query)
+        self.assertTrue(self.cassandra.token_range_scan(self._metadata_session(partitioner='RandomPartitioner'),
+                                                        "SELECT * FROM t") is None)
+
+    def test_columnar_pages(self):
+        pages = _cassandra.ColumnarPages()
+        self.assertTrue(pages.to_df().empty)
+        pages.add(_cassandra.columnar_factory(['a', 'b'], [(1, 'x'), (2, 'y')]))
+        pages.add(_cassandra.columnar_factory(['a', 'b'], []))
+        pages.add(_cassandra.columnar_factory(['a', 'b'], [(3, 'z')]))
+        df = pages.to_df()
+        self.assertEquals(list(df.columns), ['a', 'b'])
+        self.assertEquals(list(df['a']), [1, 2, 3])
+
+    def test_token_range_scan(self):
+        session = FakeSession(self.rows)
+        token_ranges = _cassandra.split_token_ring(range(-40, 40, 7), 2)
+        scan = _cassandra.TokenRangeScan(session, "query", token_ranges, max_in_flight=3)
+        df = scan.execute(timeout=30)
+        self.assertEquals(sorted(df['pk']), [token for token, val in self.rows])
+        self.assertEquals(len(session.queries), len(token_ranges))
+
+    def test_token_range_scan_page_error(self):
+        session = FakeSession(self.rows)
+        scan = _cassandra.TokenRangeScan(session, "query", _cassandra.split_token_ring([], 4), max_in_flight=2)
+
+        def add(page):
+            raise ValueError("Malformed page.")
+
+        # Errors raised by the page callback fail the scan instead of leaving it waiting.
+        scan.pages.add = add
+        self.assertRaises(ValueError, scan.execute, timeout=30)
+
+    def test_token_range_scan_timeout(self):
+        session = FakeSession(self.rows)
+        session.execute_async = lambda statement, params: Record(add_callbacks=lambda callback, errback: None)
+        scan = _cassandra.TokenRangeScan(session, "query", _cassandra.split_token_ring([], 2), max_in_flight=2)
+        self.assertRaises(ExecutionError, scan.execute, timeout=0.05)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
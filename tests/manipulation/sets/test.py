@@ -1,9 +1,17 @@
 import unittest
 import datetime
+import multiprocessing
 
+import numpy as np
 import pandas as pd
 
-from querygraph.manipulation.set import ManipulationSet, Mutate, Rename, Select, Remove, Flatten, Unpack
+from querygraph.manipulation.set import (ManipulationSet, Mutate, Rename, Select, Remove, Flatten, Unpack,
+                                         GroupedSummary)
+from querygraph.manipulation.expression import compiled
+from querygraph.manipulation.expression.compiled import compile_expression, Constant
+from querygraph.manipulation.expression.evaluator import Evaluator
+from querygraph.manipulation.expression.chunked import ChunkedBackend
+from querygraph.stats import copied_bytes
 
 
 test_df = pd.DataFrame({'A': [1, 2, 3, 4],
@@ -57,6 +65,21 @@ class ExecutionTests(unittest.TestCase):
         result_df = manipulation_set.execute(df=test_df)
         self.assertTrue(len(result_df.index) == 2 * len(test_df.index))
 
+    def test_flatten_aligned_columns(self):
+        df = pd.DataFrame({'A': [1, 2, 3], 'K': [[1, 2], [], None], 'L': [['a', 'b'], [], None]})
+        result_df = Flatten(columns=['K', 'L']).execute(df)
+        self.assertEqual(result_df['A'].tolist(), [1, 1])
+        self.assertEqual(result_df['K'].tolist(), [1, 2])
+        self.assertEqual(result_df['L'].tolist(), ['a', 'b'])
+        self.assertEqual(list(result_df.columns), ['A', 'K', 'L'])
+        self.assertEqual(result_df['K'].dtype, np.int64)
+
+    def test_flatten_keep_empty(self):
+        df = pd.DataFrame({'A': [1, 2, 3], 'K': [[1, 2], [], None]})
+        result_df = Flatten(column='K', keep_empty=True).execute(df)
+        self.assertEqual(result_df['A'].tolist(), [1, 1, 2, 3])
+        self.assertEqual(result_df['K'].isnull().tolist(), [False, False, True, True])
+
     def test_unpack(self):
         manipulation_set = ManipulationSet()
         unpack_parser = Unpack.parser()
@@ -64,6 +87,142 @@ class ExecutionTests(unittest.TestCase):
         result_df = manipulation_set.execute(df=test_df)
         self.assertTrue(series_equal(result_df['test_col'], test_df['A']))
 
+    def test_unpack_missing_paths(self):
+        df = pd.DataFrame({'L': [{'a': {'b': 1, 'c': 'x'}}, {'a': {'c': 'y'}}, None]})
+        unpack = Unpack.parser().parseString("unpack(b=L['a']['b'], c=L['a']['c'])")[0]
+        result_df = unpack.execute(df)
+        self.assertEqual(result_df['b'].dtype, np.float64)
+        self.assertEqual(result_df['b'].isnull().tolist(), [False, True, True])
+        self.assertEqual(result_df['c'].tolist(), ['x', 'y', None])
+
+    def test_input_not_copied(self):
+        df = pd.DataFrame({'A': [1.0, 2.0], 'B': [3.0, 4.0], 'S': ['a', 'b']})
+        manipulation_set = ManipulationSet()
+        manipulation_set.append_from_str("mutate(C = A + B) >> select(A, B, C)")
+        result_df = manipulation_set.execute(df=df)
+        self.assertEquals(list(df.columns), ['A', 'B', 'S'])
+        self.assertEquals(list(result_df['C']), [4.0, 6.0])
+        # Only the new column is allocated.
+        self.assertEquals(copied_bytes([df], Mutate(col_name='C', col_expr='A + B').execute(df, Evaluator())), 16)
+
+        result_df = Mutate(col_name='A', col_expr='A * 2').execute(df, Evaluator())
+        self.assertEquals(list(result_df['A']), [2.0, 4.0])
+        self.assertEquals(list(df['A']), [1.0, 2.0])
+
+
+class GroupedSummaryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({'G': ['a', 'a', 'b', 'b', 'b', 'b'],
+                                'X': [1.0, 2.0, 3.0, 4.0, 10.0, 4.0]})
+        self.grouped_summary = GroupedSummary.parser().parseString(
+            "group_by(G) >> summarize(s=spread(X), m=mean(X), v=var(X), n=nunique(X), "
+            "an=approx_count_distinct(X), q=approx_quantile(X, 0.5, 0.01))")[0]
+
+    def test_summaries(self):
+        result_df = self.grouped_summary.execute(self.df)
+        self.assertEqual(list(result_df.columns), ['s', 'm', 'v', 'n', 'an', 'q'])
+        self.assertEqual(result_df['s'].tolist(), [1.0, 7.0])
+        self.assertEqual(result_df['n'].tolist(), [2, 3])
+        self.assertEqual(result_df['an'].tolist(), [2, 3])
+        self.assertAlmostEqual(result_df.loc['b', 'q'], 4.0, delta=0.04)
+
+    def test_execute_batches(self):
+        manipulation_set = ManipulationSet()
+        manipulation_set.append_from_str("mutate(W = X * 2) >> group_by(G) >> summarize(total = sum(W))")
+        self.assertTrue(manipulation_set.manipulations[0].row_local)
+        batches = [self.df.iloc[:3], self.df.iloc[3:]]
+        result_dfs = list(manipulation_set.execute_batches(batches))
+        self.assertEquals(len(result_dfs), 1)
+        pd.util.testing.assert_frame_equal(result_dfs[0], manipulation_set.execute(self.df))
+
+    def test_two_phase(self):
+        result_df = self.grouped_summary.execute(self.df)
+        partitions = [self.df.iloc[:3], self.df.iloc[3:5], self.df.iloc[5:]]
+        partitioned_df = self.grouped_summary.execute_partitioned(partitions)
+        self.assertTrue(np.allclose(result_df.values, partitioned_df.values))
+
+    def test_count_distinct_null_group(self):
+        df = pd.DataFrame({'G': ['a', 'c', 'a', 'c', 'a'], 'X': [1.0, np.nan, 2.0, np.nan, np.nan]})
+        grouped_summary = GroupedSummary.parser().parseString(
+            "group_by(G) >> summarize(n=nunique(X), an=approx_count_distinct(X))")[0]
+        result_df = grouped_summary.execute(df)
+        self.assertEqual(result_df['n'].tolist(), [2, 0])
+        self.assertEqual(result_df['an'].tolist(), [2, 0])
+        partitioned_df = grouped_summary.execute_partitioned([df.iloc[:2], df.iloc[2:4], df.iloc[4:]])
+        pd.util.testing.assert_frame_equal(partitioned_df, result_df)
+
+
+class CompiledExpressionTests(unittest.TestCase):
+
+    def test_constant_folding(self):
+        compiled_expression = compile_expression("2 * 3 + log(1)")
+        self.assertTrue(isinstance(compiled_expression.root, Constant))
+        self.assertEqual(compiled_expression.evaluate(), 6.0)
+
+    def test_common_subexpressions(self):
+        compiled_expression = compile_expression("(A + 1) * (A + 1)")
+        self.assertTrue(compiled_expression.root.left is compiled_expression.root.right)
+        result = compiled_expression.evaluate(df=test_df)
+        self.assertEqual(result.tolist(), [4.0, 9.0, 16.0, 25.0])
+
+    def test_cached(self):
+        self.assertTrue(compile_expression("A * 2") is compile_expression("A * 2"))
+
+    def test_cache_bounded(self):
+        max_compiled_expressions = compiled.MAX_COMPILED_EXPRESSIONS
+        compiled.MAX_COMPILED_EXPRESSIONS = 2
+        try:
+            first_expression = compile_expression("A * 3")
+            compile_expression("A * 4")
+            self.assertTrue(compile_expression("A * 3") is first_expression)
+            compile_expression("A * 5")
+            self.assertTrue(len(compiled._compiled_expressions) <= 2)
+            # The least recently used expression was evicted, not the one just reused.
+            self.assertTrue("A * 4" not in compiled._compiled_expressions)
+            self.assertTrue(compile_expression("A * 3") is first_expression)
+        finally:
+            compiled.MAX_COMPILED_EXPRESSIONS = max_compiled_expressions
+
+    def test_mutate_parser(self):
+        manipulation_set = ManipulationSet()
+        manipulation_set.append_from_str("mutate(x=A * 2, y=round(A / 3, 2))")
+        result_df = manipulation_set.execute(df=test_df.copy())
+        self.assertEqual(result_df['x'].tolist(), [2, 4, 6, 8])
+        self.assertEqual(result_df['y'].tolist(), [0.33, 0.67, 1.0, 1.33])
+
+
+class ChunkedBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = ChunkedBackend(num_threads=2, chunk_rows=3, min_rows=0)
+        self.df = pd.DataFrame({'A': range(10), 'B': [x / 2.0 for x in range(10)], 'C': list('abcdefghij')})
+
+    def test_matches_tree(self):
+        for expr_str in ["A * 2 + B ^ 2 - sqrt(B) * (A + 1)", "(A + B) * (A + B) > 50", "round(B / 3, 2) + x"]:
+            compiled_expression = compile_expression(expr_str)
+            expected = compiled_expression.evaluate(df=self.df, name_dict={'x': 1})
+            result = self.backend.evaluate(compiled_expression, df=self.df, name_dict={'x': 1})
+            self.assertTrue(result.equals(expected))
+
+    def test_fallback(self):
+        compiled_expression = compile_expression("lag(A, 1)")
+        result = self.backend.evaluate(compiled_expression, df=self.df)
+        self.assertTrue(result.equals(compiled_expression.evaluate(df=self.df)))
+
+
+class ProcessPoolTests(unittest.TestCase):
+
+    def test_execute_in_pool(self):
+        manipulation_set = ManipulationSet()
+        manipulation_set.append_from_str("flatten(K) >> remove(L)")
+        pool = multiprocessing.Pool(processes=1)
+        try:
+            result_df = manipulation_set.execute_in_pool(df=test_df, pool=pool)
+        finally:
+            pool.terminate()
+        self.assertTrue(result_df.equals(manipulation_set.execute(df=test_df)))
+
 
 def main():
     unittest.main()
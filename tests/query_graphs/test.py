@@ -1,7 +1,32 @@
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import weakref
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
 
 from tests import config
 from querygraph.graph import QueryGraph
+from querygraph.template_parameter import TemplateParameter
+from querygraph.query_template import QueryTemplate
+from querygraph.exceptions import ParameterRenderError, ConnectionError, ExecutionError, JoinContextException
+from querygraph.db.interface import DatabaseInterface
+from querygraph.db.interfaces import Sqlite
+from querygraph.semi_join import SemiJoinPlanner, MinMaxSemiJoin, TempTableSemiJoin
+from querygraph.stats import ExecutionStatsStore
+from querygraph.cache import ResultCache
+from querygraph.db.pool import ConnectionPool, close_pools
+from querygraph.join_context import JoinContext, multi_join, grace_join
+from querygraph import predicates
+from querygraph import columnar
+from querygraph.utils import optional_import
+from querygraph.manipulation.expression.compiled import compile_expression
 
 
 class MongoDbPostgresTests(unittest.TestCase):
@@ -133,6 +158,716 @@ class ElasticSearchPostgresTests(unittest.TestCase):
                            'For Those About To Rock We Salute You'})
 
 
+class ThreadedExecutionTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            SELECT 1 AS id, 'a' AS name
+            UNION ALL SELECT 2, 'b'
+            %s;
+        USING sqlite_conn
+        AS parent_node
+        ---
+        QUERY |
+            SELECT *
+            FROM (SELECT 1 AS parent_id, 10 AS val UNION ALL SELECT 2, 20)
+            WHERE parent_id IN {{ id -> list:int }};
+        USING sqlite_conn
+        AS child_node
+        ---
+        QUERY |
+            SELECT 1 AS parent_id, 'x' AS grandchild_val %s;
+        USING sqlite_conn
+        AS grandchild_node
+    JOIN
+        LEFT (child_node[parent_id] ==> parent_node[id])
+        LEFT (grandchild_node[parent_id] ==> child_node[parent_id])
+    """
+
+    def test_execute(self):
+        query_graph = QueryGraph(qgl_str=self.query % ('', ''), max_workers=2)
+        df = query_graph.execute()
+        self.assertEquals(list(df['val']), [10, 20])
+        self.assertEquals(list(df['grandchild_val'].fillna('')), ['x', ''])
+
+    def test_matches_sequential_execution(self):
+        threaded_df = QueryGraph(qgl_str=self.query % ('', '')).execute()
+        sequential_df = QueryGraph(qgl_str=self.query % ('', ''), use_threads=False).execute()
+        self.assertTrue(threaded_df.equals(sequential_df))
+
+    def test_chunked_dependent_param(self):
+        query_graph = QueryGraph(qgl_str=self.query % ('', ''), param_chunk_size=1)
+        self.assertEquals(list(query_graph.execute()['val']), [10, 20])
+        self.assertEquals(list(query_graph.execute_async().result(timeout=30)['val']), [10, 20])
+
+    def test_async_chunks_run_concurrently(self):
+        query_graph = QueryGraph(qgl_str=self.query % ('', ''), param_chunk_size=1)
+        db_interface = query_graph.nodes['child_node'].db_interface
+        execute_query = db_interface._execute_query
+        started = list()
+        overlapped = list()
+        condition = threading.Condition()
+
+        def _execute_query(query, *args, **kwargs):
+            if '10 AS val' in query:
+                # Each chunk query waits (a while at most) for the other one to start.
+                with condition:
+                    started.append(query)
+                    condition.notify_all()
+                    deadline = time.time() + 5
+                    while len(started) < 2 and time.time() < deadline:
+                        condition.wait(deadline - time.time())
+                    overlapped.append(len(started) == 2)
+            return execute_query(query, *args, **kwargs)
+
+        db_interface._execute_query = _execute_query
+        self.assertEquals(list(query_graph.execute_async().result(timeout=30)['val']), [10, 20])
+        self.assertEquals(overlapped, [True, True])
+
+    def test_context_manager_releases_process_pool(self):
+        with QueryGraph(qgl_str=self.query % ('', ''), manipulation_processes=1) as query_graph:
+            self.assertEquals(list(query_graph.execute()['val']), [10, 20])
+        self.assertIsNone(query_graph.process_pool)
+
+    def test_empty_parent_skips_children(self):
+        query_graph = QueryGraph(qgl_str=self.query % ('LIMIT 0', ''))
+        df = query_graph.execute()
+        self.assertTrue(df.empty)
+        self.assertTrue('val' not in df)
+
+    def test_error_cancels_execution(self):
+        query_graph = QueryGraph(qgl_str=self.query % ('', 'WHERE {{ missing_col -> int }}'))
+        self.assertRaises(ParameterRenderError, query_graph.execute)
+
+    def test_execute_async(self):
+        futures = [QueryGraph(qgl_str=self.query % ('', '')).execute_async() for i in range(0, 10)]
+        for future in futures:
+            self.assertEquals(list(future.result(timeout=30)['val']), [10, 20])
+
+    def test_execute_async_error(self):
+        future = QueryGraph(qgl_str=self.query % ('', 'WHERE {{ missing_col -> int }}')).execute_async()
+        self.assertRaises(ParameterRenderError, future.result, 30)
+
+
+class SemiJoinTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < %s)
+            SELECT x AS id FROM c UNION ALL SELECT 1;
+        USING sqlite_conn
+        AS parent_node
+        ---
+        QUERY |
+            WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 5000)
+            SELECT x AS parent_id, x * 10 AS val FROM c
+            WHERE x IN {{ id -> list:int }};
+        USING sqlite_conn
+        AS child_node
+    JOIN
+        LEFT (child_node[parent_id] ==> parent_node[id])
+    """
+
+    def setUp(self):
+        self.sqlite = Sqlite(name='sqlite_memory', host=':memory:')
+        self.planner = SemiJoinPlanner(db_interface=self.sqlite)
+
+    def test_in_list_deduplicated(self):
+        query_graph = QueryGraph(qgl_str=self.query % 3)
+        df = query_graph.execute()
+        self.assertEquals(list(df['val']), [10, 20, 30, 10])
+        child_node = query_graph.root_node.children[0]
+        rendered_queries, semi_joins = child_node.query_template.render_queries(df=pd.DataFrame({'id': [1, 2, 2, 1]}))
+        self.assertTrue(rendered_queries[0].strip().endswith("WHERE x IN (1, 2)"))
+
+    def test_integer_ranges(self):
+        query_graph = QueryGraph(qgl_str=self.query % 3000)
+        df = query_graph.execute()
+        self.assertEquals(len(df.index), 3001)
+        self.assertEquals(df['val'].sum(), 10 * (3000 * 3001 / 2 + 1))
+        self.assertTrue(any("'ranges' semi-join strategy" in entry for entry in query_graph.log.entries))
+
+    def test_plan_min_max(self):
+        semi_join = self.planner.plan(range(0, 4000, 2), self._parameter(), column='x', column_selected=True)
+        self.assertTrue(isinstance(semi_join, MinMaxSemiJoin))
+        self.assertEquals(semi_join.predicate(self._parameter()), "x BETWEEN 0 AND 3998")
+        df = pd.DataFrame({'x': [1, 2, 3, 4]})
+        self.assertEquals(list(semi_join.post_filter(df)['x']), [2, 4])
+        self.assertRaises(ExecutionError, semi_join.post_filter, pd.DataFrame({'y': [1, 2]}))
+        self.assertFalse(isinstance(self.planner.plan(range(0, 4000, 2), self._parameter(), column='x'),
+                                    MinMaxSemiJoin))
+
+    def test_min_max_requires_selected_column(self):
+        # The child's filter column is renamed, so its result can't be filtered on it.
+        query = self.query.replace("SELECT x AS id FROM c UNION ALL SELECT 1", "SELECT 2 * x AS id FROM c")
+        df = QueryGraph(qgl_str=query % 2000).execute()
+        self.assertEquals(len(df.index), 2000)
+        self.assertEquals(df['val'].sum(), 10 * 2 * (2000 * 2001 / 2))
+
+        query = query.replace("x * 10 AS val FROM c", "x * 10 AS val, x FROM c")
+        query_graph = QueryGraph(qgl_str=query % 2000)
+        self.assertEquals(len(query_graph.execute().index), 2000)
+        self.assertTrue(any("'min_max' semi-join strategy" in entry for entry in query_graph.log.entries))
+
+    def test_selects_column(self):
+        self.assertTrue(QueryTemplate.selects_column("SELECT * FROM (SELECT 1 AS x) WHERE ", 'x'))
+        self.assertTrue(QueryTemplate.selects_column("SELECT t.x, COUNT(y) AS n FROM t WHERE ", 't.x'))
+        self.assertTrue(QueryTemplate.selects_column("SELECT a.* FROM a JOIN b ON a.i = b.i WHERE ", 'a.x'))
+        self.assertFalse(QueryTemplate.selects_column("SELECT a.* FROM a JOIN b ON a.i = b.i WHERE ", 'b.x'))
+        self.assertFalse(QueryTemplate.selects_column("SELECT x AS parent_id FROM t WHERE ", 'x'))
+        self.assertFalse(QueryTemplate.selects_column("SELECT * FROM t WHERE y IN (SELECT z FROM u WHERE ", 'z'))
+        self.assertFalse(QueryTemplate.selects_column("SELECT y FROM t UNION ALL SELECT x FROM u WHERE ", 'x'))
+
+    def test_plan_temp_table(self):
+        keys = range(0, 10 * SemiJoinPlanner.TEMP_TABLE_MIN_KEYS, 10)
+        semi_join = self.planner.plan(keys, self._parameter(), column='x')
+        self.assertTrue(isinstance(semi_join, TempTableSemiJoin))
+        query = "SELECT COUNT(*) AS n FROM (SELECT 10 AS x UNION ALL SELECT 11) WHERE %s" \
+                % semi_join.predicate(self._parameter())
+        df = self.sqlite.execute_query(query, temp_tables=semi_join.temp_tables)
+        self.assertEquals(df['n'][0], 1)
+
+    def _parameter(self):
+        template_parameter = TemplateParameter(parameter_str='x -> list:int', type_converter=self.sqlite.type_converter)
+        template_parameter.render_as_type = 'int'
+        template_parameter.render_as_container = 'list'
+        return template_parameter
+
+
+class ExecutionStatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stats_store = ExecutionStatsStore(path=os.path.join(self.tmp_dir, 'stats.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_stats(self):
+        query = ThreadedExecutionTests.query % ('', '')
+        query_graph = QueryGraph(qgl_str=query, stats_store=self.stats_store, param_chunk_size=100)
+        query_graph.execute()
+        query_graph.execute()
+        node_stats = self.stats_store.node_stats(query_graph.fingerprint)
+        self.assertEquals(sorted(node_stats.keys()), ['child_node', 'grandchild_node', 'parent_node'])
+        self.assertEquals(node_stats['child_node']['runs'], 2)
+        self.assertEquals(node_stats['child_node']['rows'], 2)
+        self.assertEquals(node_stats['child_node']['join_rows'], 2)
+        self.assertEquals(node_stats['child_node']['chunk_size'], 100)
+        self.assertEquals(node_stats['grandchild_node']['bytes_copied'], 0)
+        self.assertTrue(node_stats['parent_node']['bytes_copied'] > 0)
+        self.assertTrue(node_stats['parent_node']['query_latency'] > 0)
+
+        # A new instance of the same graph picks up the history.
+        query_graph = QueryGraph(qgl_str=query, stats_store=self.stats_store)
+        query_graph.execute()
+        self.assertEquals(set(query_graph._priorities().keys()), {'child_node', 'grandchild_node', 'parent_node'})
+        self.assertEquals(self.stats_store.node_stats(query_graph.fingerprint)['parent_node']['runs'], 3)
+
+    def test_skipped_nodes_not_recorded(self):
+        query_graph = QueryGraph(qgl_str=ThreadedExecutionTests.query % ('LIMIT 0', ''),
+                                 stats_store=self.stats_store)
+        query_graph.execute()
+        self.assertEquals(self.stats_store.node_stats(query_graph.fingerprint).keys(), ['parent_node'])
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sqlite = Sqlite(name='sqlite_memory', host=':memory:')
+        self.df = pd.DataFrame({'a': range(0, 100)})
+        self.df_bytes = int(self.df.memory_usage(index=True, deep=True).sum())
+
+    def test_lru_eviction(self):
+        result_cache = ResultCache(max_bytes=2 * self.df_bytes)
+        keys = [ResultCache.key(self.sqlite, "SELECT %s" % i) for i in range(0, 3)]
+        result_cache.put(keys[0], self.df)
+        result_cache.put(keys[1], self.df)
+        self.assertTrue(result_cache.get(keys[0]) is self.df)
+        result_cache.put(keys[2], self.df)
+        self.assertTrue(result_cache.get(keys[1]) is None)
+        self.assertTrue(result_cache.get(keys[0]) is self.df)
+        self.assertEquals(result_cache.stats(), {'entries': 2, 'bytes': 2 * self.df_bytes, 'hits': 2, 'misses': 1,
+                                                 'evictions': 1, 'expirations': 0})
+
+    def test_ttl(self):
+        result_cache = ResultCache(max_bytes=10 * self.df_bytes, default_ttl=60)
+        key = ResultCache.key(self.sqlite, "SELECT 1")
+        result_cache.put(key, self.df, ttl=-1)
+        self.assertTrue(result_cache.get(key) is None)
+        result_cache.put(key, self.df)
+        self.assertTrue(result_cache.get(key) is self.df)
+        self.assertEquals(result_cache.expirations, 1)
+
+    def test_graph_execution(self):
+        result_cache = ResultCache(max_bytes=10 ** 6)
+        query = ThreadedExecutionTests.query % ('', '')
+        first_df = QueryGraph(qgl_str=query, result_cache=result_cache).execute()
+        self.assertEquals(result_cache.stats()['misses'], 3)
+        second_df = QueryGraph(qgl_str=query, result_cache=result_cache).execute_async().result(timeout=30)
+        self.assertEquals(result_cache.stats()['hits'], 3)
+        self.assertTrue(first_df.equals(second_df))
+
+    def test_results_not_shared_with_cache(self):
+        result_cache = ResultCache(max_bytes=10 ** 6)
+        query = ConnectionPoolTests.query % ':memory:'
+        for execute in (lambda query_graph: query_graph.execute(),
+                        lambda query_graph: query_graph.execute_async().result(timeout=30)):
+            # Modifying a result (served from the cache or not) leaves the cached result untouched.
+            df = execute(QueryGraph(qgl_str=query, result_cache=result_cache))
+            df['id'] = 2
+            df.iloc[0, 0] = 3
+            self.assertEquals(list(execute(QueryGraph(qgl_str=query, result_cache=result_cache))['id']), [1])
+        self.assertEquals(result_cache.stats()['hits'], 3)
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host='%s', pool_min_size='1')
+    RETRIEVE
+        QUERY |
+            SELECT 1 AS id;
+        USING sqlite_conn
+        AS root_node
+    """
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def test_shared_across_graphs(self):
+        query = self.query % os.path.join(self.db_dir, 'pool.db')
+        first_graph = QueryGraph(qgl_str=query)
+        second_graph = QueryGraph(qgl_str=query)
+        self.assertEquals(first_graph.pool_metrics()['sqlite_conn']['idle'], 1)
+        first_graph.execute()
+        second_graph.execute()
+        metrics = second_graph.pool_metrics()['sqlite_conn']
+        self.assertEquals((metrics['created'], metrics['reused'], metrics['size']), (1, 2, 1))
+
+    def test_limits(self):
+        connection_pool = ConnectionPool(connect=object, close=lambda connection: None, max_size=2,
+                                         acquire_timeout=0.01)
+        first, second = connection_pool.acquire(), connection_pool.acquire()
+        self.assertRaises(ConnectionError, connection_pool.acquire)
+        connection_pool.release(first)
+        self.assertTrue(connection_pool.acquire() is first)
+        connection_pool.release(first)
+        connection_pool.release(second, discard=True)
+        connection_pool.configure(max_idle_time=0)
+        time.sleep(0.01)
+        connection_pool.evict_idle()
+        metrics = connection_pool.metrics()
+        self.assertEquals((metrics['size'], metrics['evicted'], metrics['discarded'], metrics['closed']),
+                          (0, 1, 1, 2))
+
+    def test_idle_connections_closed_without_acquire(self):
+        closed = list()
+        connection_pool = ConnectionPool(connect=object, close=closed.append, max_idle_time=0.05)
+        connection = connection_pool.acquire()
+        connection_pool.release(connection)
+        time.sleep(0.5)
+        self.assertEquals((connection_pool.size, closed), (0, [connection]))
+
+    def test_close_pools(self):
+        query_graph = QueryGraph(qgl_str=self.query % os.path.join(self.db_dir, 'pool.db'))
+        query_graph.execute()
+        db_interface = query_graph.root_node.db_interface
+        connection_pool = db_interface.pool
+        close_pools()
+        self.assertEquals((connection_pool.size, connection_pool.metrics()['closed']), (0, 1))
+        self.assertFalse(db_interface.pool is connection_pool)
+
+    def test_unclosed_connection_in_cycle_returned(self):
+        query_graph = QueryGraph(qgl_str=self.query % os.path.join(self.db_dir, 'pool.db'))
+        db_interface = query_graph.root_node.db_interface
+        connection = db_interface.pooled_conn()
+        connection.cycle = connection
+        del connection
+        gc.collect()
+        self.assertEquals(gc.garbage, [])
+        self.assertEquals(db_interface.pool.metrics()['idle'], 1)
+
+
+class PreparedGraphTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            SELECT {% n -> int %} AS id;
+        USING sqlite_conn
+        AS parent_node
+        ---
+        QUERY |
+            WITH RECURSIVE c(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM c WHERE x < 19)
+            SELECT x * 10 AS val, x AS parent_id FROM c
+            WHERE x IN {{ id -> list:int }};
+        USING sqlite_conn
+        AS child_node
+    JOIN
+        LEFT (child_node[parent_id] ==> parent_node[id])
+    """
+
+    def test_execute_concurrently(self):
+        prepared_graph = QueryGraph(qgl_str=self.query).prepare()
+        pool = ThreadPool(processes=4)
+        dfs = pool.map(lambda n: prepared_graph.execute(n=n), range(0, 20))
+        pool.close()
+        pool.join()
+        self.assertEquals([list(df['val']) for df in dfs], [[n * 10] for n in range(0, 20)])
+        self.assertEquals(prepared_graph.execute_async(n=3).result(timeout=30)['val'][0], 30)
+        self.assertTrue(prepared_graph.query_graph.root_node.df is None)
+
+
+class ProjectionPushdownTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            SELECT 1 AS id, 'a' AS unused;
+        USING sqlite_conn
+        AS parent_node
+        ---
+        QUERY |
+            SELECT 1 AS parent_id, 10 AS val, 20 AS other, 'wide' AS unused
+            WHERE parent_id IN {{ id -> list:int }};
+        USING sqlite_conn
+        THEN |
+            mutate(doubled=val * 2) >> select(parent_id, doubled);
+        AS child_node
+    JOIN
+        LEFT (child_node[parent_id] ==> parent_node[id])
+    """
+
+    def test_select_pushed_down(self):
+        query_graph = QueryGraph(qgl_str=self.query)
+        df = query_graph.execute()
+        self.assertEqual(query_graph.nodes['parent_node'].projection, None)
+        self.assertEqual(query_graph.nodes['child_node'].projection, ['parent_id', 'val'])
+        self.assertEqual(sorted(df.columns), ['doubled', 'id', 'parent_id', 'unused'])
+        self.assertEqual(list(df['doubled']), [20])
+
+    def test_cleaned_column_names(self):
+        query_graph = QueryGraph(qgl_str="""
+        CONNECT
+            sqlite_conn <- Sqlite(host=':memory:')
+        RETRIEVE
+            QUERY |
+                SELECT 1 AS "unit price", 2 AS "2019", 3 AS unused;
+            USING sqlite_conn
+            THEN |
+                select(unit_price, _2019);
+            AS node
+        """)
+        df = query_graph.execute()
+        # The query's columns aren't named like the dataframe's columns, so the query isn't narrowed.
+        self.assertEqual(query_graph.nodes['node'].projection, None)
+        self.assertEqual(list(df.columns), ['unit_price', '_2019'])
+        self.assertEqual(df.values.tolist(), [[1, 2]])
+
+
+class FilterPushdownTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            WITH RECURSIVE c(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM c WHERE x < 9)
+            SELECT x AS id, x % 3 AS bucket, CASE WHEN x % 2 = 0 THEN 'even' ELSE 'odd' END AS parity FROM c;
+        USING sqlite_conn
+        THEN |
+            filter((bucket != 1) & (parity == 'even')) >> filter(lag(id, 1) > 0);
+        AS node
+    """
+
+    def test_filter_pushed_down(self):
+        query_graph = QueryGraph(qgl_str=self.query)
+        df = query_graph.execute()
+        query_node = query_graph.nodes['node']
+        self.assertEqual(query_node.source_conditions,
+                         ['((NOT ("bucket" IS NOT NULL AND "bucket" = 1.0)) AND '
+                          '("parity" = \'even\'))'])
+        rendered_queries, _ = query_node._rendered_queries(independent_param_vals=dict(), chunk_size=None)
+        self.assertEqual(len(Sqlite(name='test', host=':memory:').execute_query(rendered_queries[0]).index), 4)
+        self.assertEqual(list(df['id']), [6, 8])
+
+    def test_document_store_predicates(self):
+        root = compile_expression("(a >= 1) & ((2 > b) | (c != 'x'))").root
+        self.assertEqual(predicates.mongo_predicate(root),
+                         {'$and': [{'a': {'$gte': 1.0}},
+                                   {'$or': [{'b': {'$lt': 2.0}}, {'c': {'$ne': 'x'}}]}]})
+        numeric_root = compile_expression("(a >= 1) & ((2 > b) | (c != 3))").root
+        self.assertEqual(predicates.elastic_search_predicate(numeric_root),
+                         {'bool': {'filter': [{'range': {'a': {'gte': 1.0}}},
+                                              {'bool': {'should': [{'range': {'b': {'lt': 2.0}}},
+                                                                   {'bool': {'must_not': [{'term': {'c': 3}}]}}],
+                                                        'minimum_should_match': 1}}]}})
+        self.assertRaises(predicates.UnsupportedPredicate, predicates.mongo_predicate,
+                          compile_expression("a + 1 > b").root)
+        # Strings are only compared for equality, and not at all in ElasticSearch ('term' misses text fields).
+        self.assertRaises(predicates.UnsupportedPredicate, predicates.elastic_search_predicate, root)
+        for expr_str in ("c < 'x'", "'x' <= c"):
+            root = compile_expression(expr_str).root
+            self.assertRaises(predicates.UnsupportedPredicate, predicates.mongo_predicate, root)
+            self.assertRaises(predicates.UnsupportedPredicate, predicates.sql_predicate, root,
+                              quote_identifier=lambda name: name)
+
+
+class NamedCursor(object):
+    """ DB-API cursor whose description is only set by a fetch, like a Postgres named cursor. """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.fetched = False
+
+    @property
+    def description(self):
+        return self.cursor.description if self.fetched else None
+
+    def execute(self, query):
+        self.cursor.execute(query)
+
+    def fetchmany(self, size):
+        self.fetched = True
+        return self.cursor.fetchmany(size)
+
+
+class StreamingExecutionTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            WITH RECURSIVE seq(id) AS (SELECT 0 UNION ALL SELECT id + 1 FROM seq WHERE id < 249)
+            SELECT id FROM seq;
+        USING sqlite_conn
+        THEN |
+            mutate(double = id * 2);
+        AS parent_node
+        ---
+        QUERY |
+            WITH RECURSIVE seq(parent_id) AS (SELECT 0 UNION ALL SELECT parent_id + 2 FROM seq WHERE parent_id < 248)
+            SELECT parent_id, parent_id * 10 AS val FROM seq
+            WHERE parent_id IN {{ id -> list:int }};
+        USING sqlite_conn
+        AS child_node
+    JOIN
+        LEFT (child_node[parent_id] ==> parent_node[id])
+    """
+
+    def test_execute_iter(self):
+        batch_dfs = list(QueryGraph(qgl_str=self.query).execute_iter(batch_size=100))
+        self.assertEquals([len(batch_df.index) for batch_df in batch_dfs], [100, 100, 50])
+        streamed_df = pd.concat(batch_dfs, ignore_index=True)
+        df = QueryGraph(qgl_str=self.query, use_threads=False).execute()
+        pd.util.testing.assert_frame_equal(streamed_df, df)
+        self.assertEquals(list(streamed_df['val'].fillna(-1)[:4]), [0, -1, 20, -1])
+
+    def test_fetch_batches_named_cursor(self):
+        connector = sqlite3.connect(':memory:')
+        query = "WITH RECURSIVE seq(id) AS (SELECT 0 UNION ALL SELECT id + 1 FROM seq WHERE id < 4) SELECT id FROM seq"
+        batch_dfs = list(DatabaseInterface._fetch_batches(connector, NamedCursor(connector.cursor()), query, 2))
+        self.assertEquals([list(batch_df['id']) for batch_df in batch_dfs], [[0, 1], [2, 3], [4]])
+
+    def test_child_manipulations_needing_all_rows(self):
+        query = self.query.replace("AS child_node", "THEN |\n            mutate(total = sum(val));\n"
+                                                    "        AS child_node")
+        query_graph = QueryGraph(qgl_str=query)
+        self.assertFalse(query_graph.is_streamable)
+        streamed_df = pd.concat(list(query_graph.execute_iter(batch_size=100)), ignore_index=True)
+        df = QueryGraph(qgl_str=query).execute()
+        pd.util.testing.assert_frame_equal(streamed_df, df)
+        self.assertEquals(len(set(streamed_df['total'].dropna())), 1)
+
+        query = self.query.replace("AS child_node", "THEN |\n            group_by(parent_id) >> "
+                                                    "summarize(total = sum(val));\n        AS child_node")
+        self.assertTrue(QueryGraph(qgl_str=query).is_streamable)
+
+
+@unittest.skipIf(isinstance(columnar.pa, optional_import.NotInstalled), "pyarrow is not installed.")
+class ArrowExecutionTests(unittest.TestCase):
+
+    query = """
+    CONNECT
+        sqlite_conn <- Sqlite(host=':memory:')
+    RETRIEVE
+        QUERY |
+            WITH RECURSIVE seq(id) AS (SELECT 0 UNION ALL SELECT id + 1 FROM seq WHERE id < 99)
+            SELECT id, 'name_' || id AS name, CASE WHEN id % 3 = 0 THEN NULL ELSE id * 0.5 END AS val FROM seq;
+        USING sqlite_conn
+        AS parent_node
+    """
+
+    child_query = """
+        ---
+        QUERY |
+            SELECT 0 AS parent_id, 'a' AS tag UNION ALL SELECT 2, 'b';
+        USING sqlite_conn
+        AS child_node
+    JOIN
+        LEFT (child_node[parent_id] ==> parent_node[id])
+    """
+
+    def test_arrow_native(self):
+        query_graph = QueryGraph(qgl_str=self.query)
+        self.assertTrue(query_graph.is_arrow_native)
+        table = query_graph.execute_arrow()
+        self.assertEquals(table.column_names, ['id', 'name', 'val'])
+        self.assertEquals(table.num_rows, 100)
+        self.assertEquals(table.column('val').null_count, 34)
+        df = QueryGraph(qgl_str=self.query).execute()
+        pd.util.testing.assert_frame_equal(columnar.table_to_df(table), df)
+
+    def test_converted_at_edge(self):
+        query_graph = QueryGraph(qgl_str=self.query + self.child_query)
+        self.assertFalse(query_graph.is_arrow_native)
+        table = query_graph.execute_arrow()
+        df = QueryGraph(qgl_str=self.query + self.child_query).execute()
+        pd.util.testing.assert_frame_equal(columnar.table_to_df(table), df)
+
+    def test_column_names_cleaned(self):
+        query = self.query.replace("AS name,", 'AS "item name",')
+        table = QueryGraph(qgl_str=query).execute_arrow()
+        self.assertEquals(table.column_names, ['id', 'item_name', 'val'])
+        self.assertEquals(table.column_names, list(QueryGraph(qgl_str=query).execute().columns))
+
+    def test_conversion_error(self):
+        query = self.query.replace("'name_' || id AS name", "CASE WHEN id = 0 THEN 'a' ELSE id END AS name")
+        self.assertRaises(ExecutionError, QueryGraph(qgl_str=query).execute_arrow)
+
+    def test_fetch_table_named_cursor(self):
+        connector = sqlite3.connect(':memory:')
+        table = DatabaseInterface._fetch_table(connector, NamedCursor(connector.cursor()),
+                                               "SELECT 1 AS id UNION ALL SELECT 2", 1)
+        self.assertEquals(table.column('id').to_pylist(), [1, 2])
+
+
+class MultiJoinTests(unittest.TestCase):
+
+    @staticmethod
+    def _join_context(parent_col, child_col, join_type):
+        join_context = JoinContext(child_node_name='child')
+        join_context.join_type = join_type
+        join_context.add_on_column_pair(parent_col, child_col)
+        return join_context
+
+    def test_matches_sequential_joins(self):
+        # Inner joins group rows by key, so the parent's keys are unsorted.
+        parent_df = pd.DataFrame({'id': [2, 1, None, 3, 1, 2], 'v': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+        joins = [(self._join_context('id', 'id', 'left'), pd.DataFrame({'id': [1, 2, 2], 'v': [10, 20, 21]})),
+                 (self._join_context('id', 'pid', 'inner'), pd.DataFrame({'pid': [3, 2, None, 1],
+                                                                          'w': ['c', 'b', 'n', 'a']})),
+                 (self._join_context('v_x', 'v', 'outer'), pd.DataFrame({'v': [4.0, 5.0], 'z': [True, False]})),
+                 (self._join_context('id', 'id', 'left'), pd.DataFrame({'id': [3], 'u': [30]}))]
+        expected_df = parent_df
+        for join_context, child_df in joins:
+            expected_df = join_context.apply_join(expected_df, child_df)
+        joined_df, row_counts = multi_join(parent_df, joins)
+        pd.util.testing.assert_frame_equal(joined_df, expected_df)
+        self.assertEqual(row_counts, [8, 8, 8, 8])
+
+    def test_column_order(self):
+        parent_df = pd.DataFrame({'a': [1, 2, 1], 'b': [1, 1, 2], 'v': [1.0, 2.0, 3.0]})
+        multi_key = JoinContext(child_node_name='child')
+        multi_key.join_type = 'left'
+        multi_key.add_on_column_pair('a', 'a')
+        multi_key.add_on_column_pair('b', 'bc')
+        same_named_keys = JoinContext(child_node_name='child')
+        same_named_keys.join_type = 'left'
+        same_named_keys.add_on_column_pair('a_x', 'a_x')
+        same_named_keys.add_on_column_pair('b_x', 'b_x')
+        joins = [(multi_key, pd.DataFrame({'bc': [1, 2], 'v': [5, 6], 'a': [1, 1], 'b': [7, 8]})),
+                 # Joined on the parent's 'v', renamed 'v_x' by the first join.
+                 (self._join_context('v_x', 'v', 'inner'), pd.DataFrame({'v': [1.0, 3.0], 'w': [9, 10]})),
+                 (self._join_context('a', 'a', 'left'), pd.DataFrame({'v': [0], 'a': [2]})),
+                 (self._join_context('b_x', 'b', 'inner'), pd.DataFrame({'a': [1, 2], 'b': [1, 2]})),
+                 # Leaves no rows, after which 'merge' keeps the child's key columns rather than the parent's.
+                 (self._join_context('w', 'w', 'inner'), pd.DataFrame({'w': [0], 'u': [1]})),
+                 (same_named_keys, pd.DataFrame({'z': [2], 'b_x': [1], 'a_x': [1]}))]
+        for num_joins in range(1, len(joins) + 1):
+            expected_df = parent_df
+            for join_context, child_df in joins[:num_joins]:
+                expected_df = join_context.apply_join(expected_df, child_df)
+            joined_df, row_counts = multi_join(parent_df, joins[:num_joins])
+            pd.util.testing.assert_frame_equal(joined_df, expected_df, check_like=False)
+        # The parent's 'a' is renamed 'a_x' by the fourth join.
+        joins.insert(4, (self._join_context('a', 'a', 'left'), pd.DataFrame({'a': [1]})))
+        self.assertRaises(JoinContextException, multi_join, parent_df, joins)
+
+    def test_incompatible_key_dtypes(self):
+        parent_df = pd.DataFrame({'id': [1, 2]})
+        join_context = self._join_context('id', 'id', 'inner')
+        self.assertRaises(ValueError, multi_join, parent_df, [(join_context, pd.DataFrame({'id': ['1', '2']}))])
+        joined_df, row_counts = multi_join(parent_df, [(join_context, pd.DataFrame({'id': [2.0, 3.0]}))])
+        self.assertEqual(row_counts, [1])
+
+
+class GraceHashJoinTests(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_matches_merge(self):
+        parent_df = pd.DataFrame({'id': [1, 2, 2, 3, None, 4], 'v': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+        child_df = pd.DataFrame({'cid': [2, 3, 3, 5, None], 'v': [10, 20, 21, 30, 40]})
+        for join_type in ('inner', 'left', 'right', 'outer'):
+            join_context = JoinContext(child_node_name='child')
+            join_context.join_type = join_type
+            join_context.add_on_column_pair('id', 'cid')
+            join_context.memory_budget = 1
+            join_context.spill_dir = self.spill_dir
+            expected_df = parent_df.merge(child_df, how=join_type, left_on=['id'], right_on=['cid'])
+            pd.util.testing.assert_frame_equal(join_context.apply_join(parent_df, child_df), expected_df)
+            pd.util.testing.assert_frame_equal(grace_join(parent_df, child_df, join_context, num_partitions=3),
+                                               expected_df)
+            self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_partition_results_spilled(self):
+        parent_df = pd.DataFrame({'id': range(0, 40), 'v': range(0, 40)})
+        child_df = pd.DataFrame({'cid': range(0, 40), 'w': range(0, 40)})
+        join_context = JoinContext(child_node_name='child')
+        join_context.join_type = 'inner'
+        join_context.add_on_column_pair('id', 'cid')
+        join_context.spill_dir = self.spill_dir
+        merge = pd.DataFrame.merge
+        partition_results = list()
+        held = list()
+
+        def tracked_merge(df, *args, **kwargs):
+            gc.collect()
+            held.append(len([ref for ref in partition_results if ref() is not None]))
+            joined_df = merge(df, *args, **kwargs)
+            partition_results.append(weakref.ref(joined_df))
+            return joined_df
+
+        pd.DataFrame.merge = tracked_merge
+        try:
+            joined_df = grace_join(parent_df, child_df, join_context, num_partitions=8)
+        finally:
+            pd.DataFrame.merge = merge
+        self.assertEqual(list(joined_df['w']), range(0, 40))
+        # Each partition's result is spilled before the next partition pair is joined.
+        self.assertEqual(held, [0] * 8)
+
 
 def main():
     unittest.main()
@@ -1,6 +1,11 @@
+import datetime
 import unittest
 
+import pandas as pd
+
 from querygraph.query_template import QueryTemplate
+from querygraph.db.type_converter import TypeConverter
+from querygraph.utils.deserializer import Deserializer
 from querygraph.db import interfaces
 from tests import config
 from tests.db import interfaces as test_db_interfaces
@@ -94,6 +99,55 @@ class ElasticSearchTests(unittest.TestCase):
         self.assertEquals(df['album'].unique(), ['Jagged Little Pill'])
 
 
+# =================================================
+# Chunked Rendering
+# -------------------------------------------------
+
+class ChunkedRenderingTests(unittest.TestCase):
+
+    query = "SELECT * FROM Album WHERE AlbumId IN {{ A -> list:int }} AND ArtistId = {% artist_id -> int %}"
+
+    def test_render_chunked(self):
+        query_template = QueryTemplate(template_str=self.query, type_converter=TypeConverter())
+        rendered_queries = query_template.render_chunked(chunk_size=2,
+                                                         df=pd.DataFrame({'A': [1, 2, 3]}),
+                                                         independent_param_vals={'artist_id': 4})
+        self.assertEquals(rendered_queries,
+                          ["SELECT * FROM Album WHERE AlbumId IN (1, 2) AND ArtistId = 4",
+                           "SELECT * FROM Album WHERE AlbumId IN (3) AND ArtistId = 4"])
+
+    def test_render_unchunked(self):
+        query_template = QueryTemplate(template_str=self.query, type_converter=TypeConverter())
+        rendered_queries = query_template.render_chunked(chunk_size=3,
+                                                         df=pd.DataFrame({'A': [1, 2, 3]}),
+                                                         independent_param_vals={'artist_id': 4})
+        self.assertEquals(rendered_queries, ["SELECT * FROM Album WHERE AlbumId IN (1, 2, 3) AND ArtistId = 4"])
+
+
+class StructuredRenderingTests(unittest.TestCase):
+
+    type_converter = TypeConverter(value_converters={'datetime': {datetime.datetime: lambda x: x}})
+
+    def test_render_structures(self):
+        query_template = QueryTemplate(template_str="{'tags': {'$in': {{ A -> list:str }}}, "
+                                                    "'date': {'$gt': {% start -> datetime %}}}",
+                                       type_converter=self.type_converter)
+        structures, semi_joins = query_template.render_structures(
+            deserialize=Deserializer(),
+            df=pd.DataFrame({'A': ['rock', 'pop', 'rock']}),
+            independent_param_vals={'start': datetime.datetime(2009, 1, 6)},
+            chunk_size=1)
+        self.assertEquals(structures, [{'tags': {'$in': ['rock']}, 'date': {'$gt': datetime.datetime(2009, 1, 6)}},
+                                       {'tags': {'$in': ['pop']}, 'date': {'$gt': datetime.datetime(2009, 1, 6)}}])
+        self.assertEquals(semi_joins[0].keys, ['rock', 'pop'])
+
+    def test_quoted_parameter_not_structured(self):
+        query_template = QueryTemplate(template_str="{'name': '{% name -> str %}'}",
+                                       type_converter=self.type_converter)
+        self.assertEquals(query_template.render_structures(deserialize=Deserializer(),
+                                                           independent_param_vals={'name': 'x'}), None)
+
+
 def main():
     unittest.main()
 
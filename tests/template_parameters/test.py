@@ -6,6 +6,7 @@ import numpy as np
 
 from querygraph.template_parameter import TemplateParameter
 from querygraph.db.type_converter import TypeConverter
+from querygraph.exceptions import ParameterRenderError
 
 
 test_df = pd.DataFrame({'A': [1, 2, 3, 4],
@@ -156,6 +157,26 @@ class GenericExprTests(unittest.TestCase):
         self.assertEquals(result, 2)
 
 
+class CompiledParameterTests(unittest.TestCase):
+
+    type_converter = TypeConverter()
+
+    def test_compile_once(self):
+        test_param = TemplateParameter(parameter_str="A * 2 -> list:int", type_converter=self.type_converter)
+        test_param.compile()
+        self.assertEquals((test_param.render_as_container, test_param.render_as_type), ('list', 'int'))
+        self.assertEquals(test_param.render(df=test_df), "(2, 4, 6, 8)")
+        self.assertEquals(test_param.render(df=pd.DataFrame({'X': [0], 'A': [5]})), "(10)")
+
+    def test_unknown_name(self):
+        test_param = TemplateParameter(parameter_str="missing_col -> int", type_converter=self.type_converter)
+        self.assertRaises(ParameterRenderError, test_param.render, df=test_df)
+
+    def test_invalid_render_type(self):
+        test_param = TemplateParameter(parameter_str="A -> list:", type_converter=self.type_converter)
+        self.assertRaises(ParameterRenderError, test_param.compile)
+
+
 def main():
     unittest.main()
 